@@ -1,14 +1,28 @@
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, Request, render_template, request, jsonify, Response, stream_with_context, g
+import io
 import os
-from werkzeug.utils import secure_filename
 from flask_cors import CORS
-from model import get_prediction
-from together import Together
+from werkzeug.exceptions import RequestEntityTooLarge
+from model import predict_batch, get_draft_size, load_model, reload_model, registry
+from preprocess import open_image
+from inference import create_engine, EngineBusy
+from jobs import create_job_queue, QueueFull
+from volumes import is_volume_name, save_volume, classify_volume_file
+from cache import create_prediction_cache, create_llm_cache
+from uploads import create_upload_writer
+from bulk import classify_study, start_decode_pool, iter_zip, iter_uploads, is_image_name, spool, to_ndjson
+from sessions import Session, create_session_store
+from search import serper_search, cached_search, doctors_payload, parse_doctors, find_care, get_search_cache
+from geocode import reverse_geocode, GeocodeError, get_geocode_cache
+from upstream import CircuitOpen, clients as upstream_clients
+import metrics
+from metrics import timed_stage
 from dotenv import load_dotenv
 import requests  # Add this import
-from datetime import datetime, timedelta
-import random
-import re
+import zipfile
+import json
+import threading
+import time
 
 
 
@@ -17,67 +31,291 @@ import re
 # Load environment variables
 load_dotenv()
 
+# Largest image (or other in-memory upload) and largest volume accepted, per file
+MAX_UPLOAD_BYTES = int(float(os.getenv('MAX_UPLOAD_MB', '32')) * 1024 * 1024)
+MAX_VOLUME_BYTES = int(float(os.getenv('MAX_VOLUME_MB', '1024')) * 1024 * 1024)
+
+class LimitedBytesIO(io.BytesIO):
+    """In-memory upload that gives up with a 413 once it grows past limit bytes."""
+
+    def __init__(self, limit):
+        super().__init__()
+        self.limit = limit
+
+    def write(self, data):
+        if self.tell() + len(data) > self.limit:
+            raise RequestEntityTooLarge(f'Uploads are limited to {self.limit // (1024 * 1024)} MB')
+        return super().write(data)
+
+class UploadRequest(Request):
+    """Keeps uploaded images in memory; Werkzeug would spool anything over 500 KB to a temp file.
+
+    Volumes (see volumes.py) still go through the temp file, since they are
+    classified from disk anyway. Images are capped at MAX_UPLOAD_MB each and
+    the whole request at MAX_VOLUME_MB (see MAX_CONTENT_LENGTH below).
+    """
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if filename and is_volume_name(filename):
+            return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+        return LimitedBytesIO(MAX_UPLOAD_BYTES)
+
 app = Flask(__name__)
+app.request_class = UploadRequest
+app.config['MAX_CONTENT_LENGTH'] = max(MAX_UPLOAD_BYTES, MAX_VOLUME_BYTES)
 CORS(app, resources={
     r"/*": {
         "origins": ["http://localhost:3000"],  # Add your frontend URL
         "methods": ["GET", "POST", "OPTIONS"],
-        "allow_headers": ["Content-Type"]
+        "allow_headers": ["Content-Type", "X-Session-ID", "X-Profile"],
+        "expose_headers": ["X-Session-ID", "Server-Timing", "Retry-After", "Location"],
+        "supports_credentials": True,  # lets the frontend send the session cookie back
     }
 })
 
-# Set up Together API client
-client = Together(api_key=os.getenv('TOGETHER_API_KEY'))
+# Together API client, created on first use: importing together alone takes ~0.5 s
+# (TOGETHER_BASE_URL points it at another endpoint, e.g. stubs.py)
+client = None
+
+def get_client():
+    global client
+    if client is None:
+        from together import Together
+        client = Together(api_key=os.getenv('TOGETHER_API_KEY'))
+    return client
 
-# Serper API configuration
+# Serper API configuration (SERPER_API_URL / SERPER_TIMEOUT are read in search.py)
 SERPER_API_KEY = os.getenv('SERPER_API_KEY')
-SERPER_API_URL = "https://google.serper.dev/search"
 
-# Global variables
-chat_history = []
-prediction = None
+# Conversation history and last prediction per session (see get_session)
+sessions = create_session_store()
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+    # X-Profile: 1 asks for this request's stage breakdown in a Server-Timing header
+    if request.headers.get('X-Profile') == '1' and metrics.profiling_enabled():
+        metrics.start_profile()
+
+@app.after_request
+def record_request(response):
+    elapsed = time.perf_counter() - g.request_start
+    endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+    metrics.REQUEST_SECONDS.observe(elapsed, endpoint=endpoint, method=request.method)
+    metrics.RESPONSES.inc(endpoint=endpoint, status=str(response.status_code))
+    stages = metrics.finish_profile()
+    if stages is not None:
+        # Streamed bodies (SSE chat) are still running here, so only their setup is included
+        response.headers['Server-Timing'] = metrics.server_timing(stages + [('total', elapsed)])
+    return response
+
+@app.teardown_request
+def clear_profile(exc):
+    metrics.finish_profile()
+
+def model_preload():
+    """MODEL_PRELOAD: 'background' (default) loads the classifier on a thread at import, so
+    routes that don't need it serve at once; '1' loads it before import returns; '0' on first use."""
+    return os.getenv('MODEL_PRELOAD', 'background').lower()
+
+# Bulk decode workers are forked here, before this module starts any thread, when
+# app.py is the server; a plain import (benchmark.py, parity.py, a test client)
+# doesn't fork cpu_count processes unless BULK_DECODE_PRESTART=1. serve.py forks
+# them in each worker, and without either /predict-bulk falls back to a forkserver.
+if __name__ == '__main__' or os.getenv('BULK_DECODE_PRESTART', '0').lower() in ('1', 'true', 'yes'):
+    start_decode_pool()
+
+# Load the classifier once so requests reuse the resident model; a prediction
+# arriving while it loads waits for it. The loader isn't a daemon thread:
+# torch aborts the process if the interpreter exits while it is mid-load.
+if model_preload() == 'background':
+    threading.Thread(target=load_model, name='model-load').start()
+elif model_preload() not in ('0', 'false', 'no'):
+    load_model()
+
+# Micro-batching engine shared by /predict and /image (None when INFERENCE_BATCHING=0)
+engine = create_engine()
+
+# Background workers behind POST /jobs (None when JOB_WORKERS=0)
+job_queue = create_job_queue()
+
+# Repeated uploads of the same bytes are answered from here (None when PREDICTION_CACHE_MB=0)
+prediction_cache = create_prediction_cache()
+
+# Session ids are issued by the server, in this cookie and the X-Session-ID response header
+SESSION_COOKIE = 'session_id'
+
+def requested_session_id(headers, cookies, args, body):
+    # An id the client names explicitly wins over the cookie
+    return (
+        headers.get('X-Session-ID')
+        or args.get('session_id')
+        or (body or {}).get('session_id')
+        or cookies.get(SESSION_COOKIE)
+    )
+
+def get_session(create=False):
+    """Session for this request, from the X-Session-ID header, cookie, or session_id arg/body field.
+
+    Only ids we issued are honoured. Without one, or with an unknown or
+    expired one, this returns None, or with create starts a new session and
+    sends its id back. Only requests that write to a session create one, so
+    read-only requests can't push live sessions out of the store.
+    """
+    session_id = requested_session_id(request.headers, request.cookies, request.args, request.get_json(silent=True))
+    session = sessions.get(session_id) if session_id else None
+    if session is None and create:
+        session = sessions.create()
+        g.new_session_id = session.id
+    return session
+
+def set_session_id(response, session_id):
+    response.headers['X-Session-ID'] = session_id
+    response.set_cookie(SESSION_COOKIE, session_id, max_age=int(sessions.ttl_seconds), httponly=True, samesite='Lax')
+
+@app.after_request
+def issue_session_id(response):
+    session_id = g.pop('new_session_id', None)
+    if session_id is not None:
+        set_session_id(response, session_id)
+    return response
+
+LLM_MODEL = "meta-llama/Llama-3.3-70B-Instruct-Turbo"
+LLM_PARAMS = {
+    "temperature": 0.7,
+    "top_p": 0.7,
+    "top_k": 50,
+    "repetition_penalty": 1,
+    "stop": ["<|eot_id|>", "<|eom_id|>"],
+}
+
+def prepare_messages(session):
+    """Ensure the session has a system prompt and fits the token budget."""
+    chat_history = session.messages
+    if not any(message["role"] == "system" for message in chat_history):
+        chat_history.insert(0, {
+            "role": "system",
+            "content": "You are an intelligent assistant specialized in Alzheimer's disease detection using MRI images. "
+                    "Your goal is to help users understand the severity of Alzheimer's disease based on the MRI scan results. "
+                    "The possible severity levels include 'Non_Demented', 'Very_Mild_Demented', and 'Mild_Demented'. "
+                    "Based on the MRI data, you will classify the severity and provide detailed explanations for each classification, "
+                    "including potential implications and recommendations for further medical consultation. "
+                    "Always emphasize the importance of consulting healthcare professionals for confirmation and personalized advice."
 
-# Global variables
-chat_history = []
-prediction = None
 
-def get_genai():
+        })
+
+    # Keep the prompt inside CHAT_TOKEN_BUDGET
+    return sessions.trim(session)
+
+# Replies to repeated prompts, above all the GET /chat opener per diagnosis (None when LLM_CACHE_SIZE=0)
+llm_cache = create_llm_cache()
+
+def reply_cache_key(chat_history):
+    """Cache key for the reply to chat_history, or None if it shouldn't be cached."""
+    if llm_cache is None or not llm_cache.cacheable(chat_history):
+        return None
+    return llm_cache.key(LLM_MODEL, chat_history, LLM_PARAMS)
+
+def get_genai(session):
     try:
-        if not any(message["role"] == "system" for message in chat_history):
-            chat_history.insert(0, {
-                "role": "system",
-                "content": "You are an intelligent assistant specialized in Alzheimer's disease detection using MRI images. "
-                        "Your goal is to help users understand the severity of Alzheimer's disease based on the MRI scan results. "
-                        "The possible severity levels include 'Non_Demented', 'Very_Mild_Demented', and 'Mild_Demented'. "
-                        "Based on the MRI data, you will classify the severity and provide detailed explanations for each classification, "
-                        "including potential implications and recommendations for further medical consultation. "
-                        "Always emphasize the importance of consulting healthcare professionals for confirmation and personalized advice."
-
-
-            })
-
-        print("Sending messages to API:", chat_history)
-
-        response = client.chat.completions.create(
-            model="meta-llama/Llama-3.3-70B-Instruct-Turbo",
-            messages=chat_history,
-            temperature=0.7,
-            top_p=0.7,
-            top_k=50,
-            repetition_penalty=1,
-            stop=["<|eot_id|>", "<|eom_id|>"]
-        )
-
-        if not response or not hasattr(response, 'choices'):
-            raise Exception("Invalid response from API")
-
-        content = response.choices[0].message.content
-        chat_history.append({"role": "assistant", "content": content})
+        chat_history = prepare_messages(session)
+        key = reply_cache_key(chat_history)
+        content = llm_cache.get(key) if key else None
+
+        if content is None:
+            with metrics.upstream_call('together'):
+                response = get_client().chat.completions.create(model=LLM_MODEL, messages=chat_history, **LLM_PARAMS)
+
+            if not response or not hasattr(response, 'choices'):
+                raise Exception("Invalid response from API")
+
+            content = response.choices[0].message.content
+            if key:
+                llm_cache.put(key, content)
+
+        session.add("assistant", content)
         return content
     except Exception as e:
         print(f"API Error in get_genai: {str(e)}")
         raise
 
+def stream_genai(session):
+    """Like get_genai, but yields the reply piece by piece as Together streams it.
+
+    The assembled reply is only added to the history once the stream has
+    finished; closing the generator early closes the upstream stream too.
+    """
+    chat_history = prepare_messages(session)
+    key = reply_cache_key(chat_history)
+    cached = llm_cache.get(key) if key else None
+    if cached is not None:
+        yield cached
+        session.add("assistant", cached)
+        return
+
+    start = time.perf_counter()
+    with metrics.upstream_call('together'):
+        stream = get_client().chat.completions.create(model=LLM_MODEL, messages=chat_history, stream=True, **LLM_PARAMS)
+
+    parts = []
+    try:
+        for chunk in stream:
+            delta = chunk.choices[0].delta if chunk.choices else None
+            if delta is not None and delta.content:
+                if not parts:
+                    metrics.observe_stage('together_first_token', time.perf_counter() - start)
+                parts.append(delta.content)
+                yield delta.content
+    finally:
+        if hasattr(stream, 'close'):
+            stream.close()
+    metrics.observe_stage('together_stream', time.perf_counter() - start)
+
+    content = ''.join(parts)
+    if key:
+        llm_cache.put(key, content)
+    session.add("assistant", content)
+
+def wants_stream():
+    return request.args.get('stream') in ('1', 'true') or 'text/event-stream' in request.headers.get('Accept', '')
+
+def sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def stream_chat(session, start_turn, since, fmt, sent=False):
+    """Server-sent events for one chat turn: token events, then done (or error).
+
+    done carries the same body as a non-streamed turn in the requested format.
+    If the client disconnects mid-stream the upstream request is closed and
+    the session history is put back the way it was before the turn.
+    """
+    def generate():
+        with session.lock:
+            snapshot = session.snapshot()
+            turn_since = session.version if since is None else since
+            start_turn()
+            tokens = stream_genai(session)
+            try:
+                for delta in tokens:
+                    yield sse('token', {'delta': delta})
+                yield sse('done', chat_payload(session, turn_since, fmt, session.messages[-1]['content'], sent))
+            except GeneratorExit:
+                print(f"Client disconnected from chat stream for session {session.id}")
+                session.restore(snapshot)
+                raise
+            except Exception as e:
+                print(f"API Error in stream_genai: {str(e)}")
+                yield sse('error', {'error': str(e)})
+            finally:
+                tokens.close()
+
+    return Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+        'X-Session-ID': session.id,
+    })
+
 UPLOAD_FOLDER = 'static/uploads'
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg'}
 
@@ -85,14 +323,48 @@ ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg'}
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
-# Check if file is allowed
+# Uploads are decoded from memory; copies are only kept when PERSIST_UPLOADS is on
+upload_writer = create_upload_writer(UPLOAD_FOLDER)
+
+# Check if file is allowed: a 2D image, or a NIfTI volume / DICOM series (see volumes.py)
 def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+    return ('.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS) or is_volume_name(filename)
+
+def read_upload(file):
+    """Read an uploaded file into memory and queue it for persistence if enabled."""
+    data = file.read()
+    if upload_writer is not None:
+        upload_writer.submit(file.filename, data)
+    return data
+
+def classify(data):
+    """Classify uploaded image bytes, serving repeats from the prediction cache."""
+    key = None
+    if prediction_cache is not None:
+        key = prediction_cache.key(data, registry.version)
+        cached = prediction_cache.get(key)
+        if cached is not None:
+            return cached['label']
+
+    # Decode in the request thread so the engine thread only runs the model
+    with timed_stage('decode'):
+        image = open_image(data, get_draft_size())
+    if engine is None:
+        label, logits = predict_batch([image])[0]
+    else:
+        future = engine.submit(image)
+        with timed_stage('inference_wait'):
+            label, logits = future.result()
+        # Preprocess/forward ran on the engine thread for the whole batch
+        metrics.extend_profile(getattr(future, 'stages', None))
+
+    if key is not None:
+        prediction_cache.put(key, label, logits.tolist())
+    return label
 
 @app.route('/find-doctors', methods=['POST'])
 def find_doctors():
     try:
-        print("Received doctor search request")
         data = request.json
         
         if not data:
@@ -104,53 +376,16 @@ def find_doctors():
         if not location or not disease:
             return jsonify({'error': 'Location and disease are required'}), 400
             
-        print(f"Searching for: Disease: {disease}, Location: {location}")
-        
-        # Construct search query
-        query = f"doctors treating {disease} in {location}"
-        
-        # Call Serper API
-        headers = {
-            'X-API-KEY': SERPER_API_KEY,
-            'Content-Type': 'application/json'
-        }
-        
-        payload = {
-            'q': query,
-            'num': 10
-        }
-        
-        print("Calling Serper API...")
-        response = requests.post(SERPER_API_URL, headers=headers, json=payload)
-        response.raise_for_status()
-        search_results = response.json()
+        search_results = cached_search(doctors_payload(disease, location))
         
         # Process and format the results
-        doctors = []
-        
-        # Add places results first (they usually have more detailed information)
-        if 'places' in search_results:
-            for result in search_results['places']:
-                doctors.append({
-                    'title': result.get('title', ''),
-                    'address': result.get('address', ''),
-                    'rating': result.get('rating', None),
-                    'ratingCount': result.get('ratingCount', None)
-                })
-        
-        # Add organic results
-        if 'organic' in search_results:
-            for result in search_results['organic']:
-                doctors.append({
-                    'title': result.get('title', ''),
-                    'link': result.get('link', ''),
-                    'snippet': result.get('snippet', ''),
-                    'position': result.get('position', '')
-                })
+        with timed_stage('extraction'):
+            doctors = parse_doctors(search_results)
         
-        print(f"Found {len(doctors)} doctors")
         return jsonify({'doctors': doctors})
         
+    except CircuitOpen:
+        return jsonify({'error': 'Search is temporarily unavailable, try again later'}), 503
     except requests.exceptions.RequestException as e:
         print(f"Serper API error: {str(e)}")
         return jsonify({'error': 'Error calling search API'}), 500
@@ -166,20 +401,29 @@ def index():
 @app.route('/image', methods=['GET', 'POST'])
 def image():
     if request.method == 'POST':
-        if 'file' not in request.files:
+        # Parsing the multipart body is where the upload is actually received
+        with timed_stage('upload'):
+            files = request.files
+        if 'file' not in files:
             return "No file part", 400
-        file = request.files['file']
+        file = files['file']
 
         if file.filename == '':
             return "No file selected", 400
 
         if file and allowed_file(file.filename):
-            filename = secure_filename(file.filename)
-            file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            file.save(file_path)
+            if is_volume_name(file.filename):
+                try:
+                    return jsonify(classify_volume_file(save_volume(file), delete=True))
+                except (ValueError, RuntimeError) as e:
+                    return f"Could not read volume: {str(e)}", 400
+            data = read_upload(file)
 
             # Call the prediction function
-            prediction = get_prediction(file_path)  # Use the file path
+            try:
+                prediction = classify(data)
+            except EngineBusy:
+                return "Server busy, try again", 503
 
             return jsonify({'predicted_class': prediction})
 
@@ -189,79 +433,319 @@ def image():
 
 @app.route('/predict', methods=['POST'])
 def predict():
-    if 'image' not in request.files:
+    with timed_stage('upload'):
+        files = request.files
+    if 'image' not in files:
         return jsonify({'error': 'No image provided'}), 400
 
-    file = request.files['image']
-    filename = secure_filename(file.filename)
-    file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-    file.save(file_path)
+    file = files['image']
+    # The prediction is kept for GET /chat, so this starts a session if there isn't one
+    session = get_session(create=True)
+    if is_volume_name(file.filename):
+        # Streamed to disk and classified from a sample of slices, never held in memory
+        try:
+            volume = classify_volume_file(save_volume(file), delete=True)
+        except (ValueError, RuntimeError) as e:
+            return jsonify({'error': f'Could not read volume: {str(e)}'}), 400
+        session.prediction = volume['predicted_class']
+        return jsonify({'predicted_class': session.prediction, 'session_id': session.id, 'volume': volume})
+    data = read_upload(file)
 
     # Call the prediction function
-    global prediction
-    prediction = get_prediction(file_path)
+    try:
+        session.prediction = classify(data)
+    except EngineBusy:
+        return jsonify({'error': 'Server busy, try again'}), 503
+
+    return jsonify({'predicted_class': session.prediction, 'session_id': session.id})
+
+@app.route('/jobs', methods=['POST'])
+def submit_job():
+    # Same input as /predict, but answers at once with a job id to poll
+    if job_queue is None:
+        return jsonify({'error': 'Job API is disabled'}), 404
+    with timed_stage('upload'):
+        files = request.files
+    if 'image' not in files:
+        return jsonify({'error': 'No image provided'}), 400
 
-    return jsonify({'predicted_class': prediction})
+    file = files['image']
+    session = get_session(create=True)
 
-@app.route('/chat', methods=['POST', 'GET'])
-def chat():
-    global prediction, chat_history  # Reference global variables
+    path = None
+    if is_volume_name(file.filename):
+        path = save_volume(file)
 
-    if request.method == 'GET':
-        # Reset chat history for new conversation
-        chat_history = []
-        system_prompt = (
-            "You are an intelligent assistant specializing in providing detailed and accurate information about various diseases. "
-            "Your primary objective is to educate users about different health conditions and offer practical guidance, "
-            "including home remedies when safe. Always encourage users to consult a healthcare professional when necessary."
-        )
-        user_prompt = f"I have the following disease: {prediction}. What can you tell me about this?"
-
-        # Add the initial prompts to the chat history
-        chat_history.append({"role": "system", "content": system_prompt})
-        chat_history.append({"role": "user", "content": user_prompt})
+        def run():
+            volume = classify_volume_file(path, delete=True)
+            session.prediction = volume['predicted_class']
+            return {'predicted_class': session.prediction, 'session_id': session.id, 'volume': volume}
+    else:
+        data = read_upload(file)
+
+        def run():
+            session.prediction = classify(data)
+            return {'predicted_class': session.prediction, 'session_id': session.id}
 
+    try:
+        job = job_queue.submit(run)
+    except QueueFull as e:
+        if path is not None:
+            os.remove(path)
+        response = jsonify({'error': 'Too many queued jobs, try again later', 'retry_after': e.retry_after})
+        response.headers['Retry-After'] = str(e.retry_after)
+        return response, 429
+
+    response = jsonify({**job.to_dict(), 'session_id': session.id})
+    response.headers['Location'] = f'/jobs/{job.id}'
+    return response, 202
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    # ?wait=N blocks up to N seconds (capped by JOB_MAX_WAIT) for the result
+    if job_queue is None:
+        return jsonify({'error': 'Job API is disabled'}), 404
+    wait = min(request.args.get('wait', 0, type=float), float(os.getenv('JOB_MAX_WAIT', '30')))
+    job = job_queue.wait(job_id, wait) if wait > 0 else job_queue.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown or expired job'}), 404
+    return jsonify(job.to_dict())
+
+@app.route('/jobs/stats', methods=['GET'])
+def job_stats():
+    if job_queue is None:
+        return jsonify({'enabled': False})
+    return jsonify({'enabled': True, **job_queue.stats()})
+
+@app.route('/predict-bulk', methods=['POST'])
+def predict_bulk():
+    # A whole study: either a zip archive or several images in one multipart request
+    if 'archive' in request.files:
+        archive = request.files['archive'].stream
+        if not zipfile.is_zipfile(archive):
+            return jsonify({'error': 'Archive must be a zip file'}), 400
+        archive.seek(0)
+        items = iter_zip(spool(archive))
+    elif request.files.getlist('images'):
+        items = iter_uploads([
+            (file.filename, spool(file.stream))
+            for file in request.files.getlist('images')
+            if is_image_name(file.filename or '')
+        ])
+    else:
+        return jsonify({'error': 'No archive or images provided'}), 400
+
+    # classify_study clamps it to BULK_MAX_BATCH
+    batch_size = request.args.get('batch_size', 16, type=int)
+    results = classify_study(items, batch_size=batch_size)
+    return Response(stream_with_context(to_ndjson(results)), mimetype='application/x-ndjson')
+
+@app.route('/inference/stats', methods=['GET'])
+def inference_stats():
+    cascade = registry.get().cascade if registry.loaded else None
+    stats = {'model_loaded': registry.loaded, 'cascade': cascade.stats() if cascade is not None else None}
+    if engine is None:
+        return jsonify({'batching': False, **stats})
+    return jsonify({'batching': True, **stats, **engine.stats()})
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    caches = {
+        'predictions': prediction_cache, 'llm': llm_cache, 'search': get_search_cache(), 'geocode': get_geocode_cache(),
+    }
+    return jsonify({
+        name: {'enabled': True, **cache.stats()} if cache is not None else {'enabled': False}
+        for name, cache in caches.items()
+    })
+
+@app.route('/upstream/stats', methods=['GET'])
+def upstream_stats():
+    # Timeouts, retry/hedge settings and circuit breaker state per third-party API
+    return jsonify({name: client.stats() for name, client in upstream_clients().items()})
+
+@app.route('/model/reload', methods=['POST'])
+def model_reload():
+    # Swap or pin the checkpoint without restarting; disabled unless ADMIN_TOKEN is set
+    admin_token = os.getenv('ADMIN_TOKEN')
+    if not admin_token or request.headers.get('X-Admin-Token') != admin_token:
+        return jsonify({'error': 'Forbidden'}), 403
+
+    data = request.json or {}
+    try:
+        version = reload_model(data.get('repo'), data.get('revision'))
+        return jsonify({'status': 'success', 'model_version': version})
+    except Exception as e:
+        print(f"Error reloading model: {str(e)}")
+        return jsonify({'error': str(e), 'model_version': registry.version}), 500
+
+DISEASE_INFO_PROMPT = (
+    "You are an intelligent assistant specializing in providing detailed and accurate information about various diseases. "
+    "Your primary objective is to educate users about different health conditions and offer practical guidance, "
+    "including home remedies when safe. Always encourage users to consult a healthcare professional when necessary."
+)
+
+def start_conversation(session):
+    """Reset the session's chat to a question about its last prediction (GET /chat)."""
+    session.reset([
+        {"role": "system", "content": DISEASE_INFO_PROMPT},
+        {"role": "user", "content": f"I have the following disease: {session.prediction}. What can you tell me about this?"},
+    ])
+
+def llm_prewarm_enabled():
+    return llm_cache is not None and os.getenv('LLM_CACHE_PREWARM', '1').lower() not in ('0', 'false', 'no')
+
+def prewarm_llm_cache():
+    """Generate the GET /chat opener for every label the classifier can predict, unless already cached."""
+    # Labels come from the checkpoint config, so this never loads the model itself
+    for label in registry.labels():
+        session = Session('prewarm')
+        session.prediction = label
+        start_conversation(session)
+        key = reply_cache_key(prepare_messages(session))
+        if key is None or key in llm_cache:
+            continue
         try:
-            response = get_genai()
-            return jsonify({"response": response, "chat_history": chat_history})
+            with metrics.upstream_call('together'):
+                response = get_client().chat.completions.create(model=LLM_MODEL, messages=session.messages, **LLM_PARAMS)
+            llm_cache.put(key, response.choices[0].message.content)
         except Exception as e:
-            print(f"Error in chat GET: {str(e)}")
-            return jsonify({"error": str(e)}), 500
+            print(f"Could not prewarm the chat opener for {label}: {str(e)}")
+
+# Openers are generated in the background so startup isn't held up (serve.py does it before forking instead)
+if llm_prewarm_enabled():
+    threading.Thread(target=prewarm_llm_cache, name='llm-prewarm', daemon=True).start()
+
+CHAT_FORMATS = ('delta', 'compact', 'full')
+COMPACT_ROLES = {'user': 'u', 'assistant': 'a'}
+
+def chat_payload(session, since, fmt, reply=None, sent=False):
+    """Body of a /chat turn (reply set) or of /chat/history.
+
+    delta (default): the messages after version `since`, each tagged with its
+    version, and the session's current version; reset: true means replace the
+    local copy with these messages instead of appending them. A turn's reply
+    is only in response (it is message `version`), and with sent the user
+    message the client just posted (`version` - 1) isn't echoed either.
+    compact: the same with one-letter keys and [version, role, content] rows.
+    full: the old body with the whole chat_history (LLM context, system
+    prompt included).
+    """
+    if fmt == 'full':
+        body = {"chat_history": session.messages, "session_id": session.id, "version": session.version}
+        if reply is not None:
+            body["response"] = reply
+        return body
+
+    entries, reset = session.since(since)
+    if reply is not None:
+        first_known = session.version - (1 if sent else 0)
+        entries = [(version, m) for version, m in entries if version < first_known]
+    if fmt == 'compact':
+        body = {"s": session.id, "v": session.version,
+                "m": [[version, COMPACT_ROLES[m['role']], m['content']] for version, m in entries]}
+        if reply is not None:
+            body["r"] = reply
+        if reset:
+            body["reset"] = True
+        return body
+
+    body = {"session_id": session.id, "version": session.version,
+            "messages": [{"version": version, **m} for version, m in entries]}
+    if reply is not None:
+        body["response"] = reply
+    if reset:
+        body["reset"] = True
+    return body
+
+def chat_options():
+    """(since, format) from the query string, or None for a bad format."""
+    fmt = request.args.get('format', 'delta')
+    return request.args.get('since', type=int), fmt if fmt in CHAT_FORMATS else None
+
+@app.route('/chat', methods=['POST', 'GET'])
+def chat():
+    # ?format=delta|compact|full and ?since=<version>; see chat_payload
+    session = get_session()
+    since, fmt = chat_options()
+    if fmt is None:
+        return jsonify({"error": f"format must be one of {', '.join(CHAT_FORMATS)}"}), 400
+
+    if request.method == 'GET':
+        # The opener asks about the session's prediction, so there has to be one
+        if session is None:
+            return jsonify({"error": "Unknown or expired session, upload a scan first"}), 404
+
+        def start_turn():
+            start_conversation(session)
+
+        if wants_stream():
+            return stream_chat(session, start_turn, since, fmt)
+
+        with session.lock:
+            turn_since = session.version if since is None else since
+            start_turn()
+            try:
+                response = get_genai(session)
+                return jsonify(chat_payload(session, turn_since, fmt, response))
+            except Exception as e:
+                print(f"Error in chat GET: {str(e)}")
+                return jsonify({"error": str(e)}), 500
 
     elif request.method == 'POST':
         user_input = request.json.get('message', '')
         if not user_input:
             return jsonify({"error": "Message is required"}), 400
-
-        chat_history.append({"role": "user", "content": user_input})
-
-        try:
-            response = get_genai()
-            return jsonify({"response": response, "chat_history": chat_history})
-        except Exception as e:
-            print(f"Error in chat POST: {str(e)}")
-            return jsonify({"error": str(e)}), 500
+        if session is None:
+            # Sessions start here (and with a prediction), never on a read
+            session = get_session(create=True)
+
+        def start_turn():
+            session.add("user", user_input)
+
+        if wants_stream():
+            return stream_chat(session, start_turn, since, fmt, sent=True)
+
+        with session.lock:
+            turn_since = session.version if since is None else since
+            start_turn()
+            try:
+                response = get_genai(session)
+                return jsonify(chat_payload(session, turn_since, fmt, response, sent=True))
+            except Exception as e:
+                print(f"Error in chat POST: {str(e)}")
+                return jsonify({"error": str(e)}), 500
+
+@app.route('/chat/history', methods=['GET'])
+def history():
+    # Messages after ?since=<version> (everything, with reset, when omitted)
+    session = get_session()
+    since, fmt = chat_options()
+    if fmt is None:
+        return jsonify({"error": f"format must be one of {', '.join(CHAT_FORMATS)}"}), 400
+    if session is None:
+        # No session yet: an empty history, without creating one
+        return jsonify(chat_payload(Session(None), since, fmt))
+    with session.lock:
+        return jsonify(chat_payload(session, since, fmt))
 
 @app.route('/test-serper', methods=['GET'])
 def test_serper():
     try:
-        headers = {
-            'X-API-KEY': SERPER_API_KEY,
-            'Content-Type': 'application/json'
-        }
-        
         payload = {
             'q': 'doctors in New York',
             'num': 1
         }
         
-        response = requests.post(SERPER_API_URL, headers=headers, json=payload)
-        response.raise_for_status()
+        response = serper_search(payload)
         
         return jsonify({
             'status': 'success',
             'api_key_present': bool(SERPER_API_KEY),
-            'response': response.json()
+            'response': response
         })
     except Exception as e:
         return jsonify({
@@ -285,23 +769,18 @@ def get_location():
         if not OPENCAGE_API_KEY:
             return jsonify({'error': 'Geocoding service not configured'}), 500
 
-        response = requests.get(
-            f'https://api.opencagedata.com/geocode/v1/json?q={latitude}+{longitude}&key={OPENCAGE_API_KEY}'
-        )
-        
-        if response.status_code != 200:
+        # Coordinates are rounded to GEOCODE_PRECISION and served from the cache when possible
+        try:
+            location = reverse_geocode(latitude, longitude, OPENCAGE_API_KEY)
+        except CircuitOpen:
+            return jsonify({'error': 'Geocoding is temporarily unavailable, try again later'}), 503
+        except GeocodeError:
             return jsonify({'error': 'Error getting location details'}), 500
 
-        location_data = response.json()
-        if not location_data.get('results'):
+        if location is None:
             return jsonify({'error': 'Location not found'}), 404
 
-        components = location_data['results'][0]['components']
-        
-        return jsonify({
-            'city': components.get('city') or components.get('town') or components.get('state'),
-            'country': components.get('country')
-        })
+        return jsonify(location)
 
     except Exception as e:
         print(f"Error in get_location: {str(e)}")
@@ -317,203 +796,40 @@ def find_appointments():
         if not location or not disease:
             return jsonify({'error': 'Location and disease are required'}), 400
             
-        print(f"Searching for appointments: Disease: {disease}, Location: {location}")
-        
-        # First search specifically for doctors on medical platforms
-        directory_query = (
-            f"doctor appointment {disease} {location} "
-            "site:marham.pk OR site:healthwire.pk OR site:oladoc.com OR "
-            "site:findmydoctor.pk OR site:doctify.com"
-        )
-        
-        headers = {
-            'X-API-KEY': SERPER_API_KEY,
-            'Content-Type': 'application/json'
-        }
-        
-        directory_payload = {
-            'q': directory_query,
-            'num': 10
-        }
-        
-        # Get directory listings
-        directory_response = requests.post(SERPER_API_URL, headers=headers, json=directory_payload)
-        directory_response.raise_for_status()
-        directory_results = directory_response.json()
-        
-        appointments = []
-        
-        # Process directory results (medical platforms)
-        if 'organic' in directory_results:
-            for result in directory_results['organic']:
-                title = result.get('title', '')
-                snippet = result.get('snippet', '')
-                link = result.get('link', '')
-                
-                # Skip news articles and irrelevant results
-                if any(word in title.lower() for word in ['news', 'article', 'report', 'pdf', 'research']):
-                    continue
-                
-                # Determine booking platform
-                platform = None
-                if 'marham.pk' in link:
-                    platform = 'Marham'
-                elif 'healthwire.pk' in link:
-                    platform = 'Healthwire'
-                elif 'oladoc.com' in link:
-                    platform = 'Oladoc'
-                elif 'findmydoctor.pk' in link:
-                    platform = 'FindMyDoctor'
-                elif 'doctify.com' in link:
-                    platform = 'Doctify'
-                
-                if platform:  # Only add if it's from a medical platform
-                    doctor_info = {
-                        'doctorName': clean_title(title),
-                        'specialty': extract_specialty(snippet),
-                        'location': extract_city(location),
-                        'address': extract_address(snippet),
-                        'phone': extract_phone(snippet),
-                        'bookingPlatform': platform,
-                        'bookingLink': link,
-                        'date': 'Book online',
-                        'time': 'Check availability online',
-                        'type': 'Online Booking',
-                        'snippet': snippet
-                    }
-                    
-                    # Only add if it looks like a valid doctor listing
-                    if is_valid_doctor_listing(doctor_info):
-                        appointments.append(doctor_info)
-        
-        # Search for physical clinics and hospitals
-        places_query = f"neurologist clinic hospital {disease} treatment {location}"
-        places_payload = {
-            'q': places_query,
-            'num': 5,
-            'type': 'places'
-        }
-        
-        places_response = requests.post(SERPER_API_URL, headers=headers, json=places_payload)
-        places_results = places_response.json()
-        
-        # Process places results
-        if 'places' in places_results:
-            for place in places_results['places']:
-                if is_valid_medical_facility(place.get('title', '')):
-                    appointments.append({
-                        'doctorName': clean_title(place.get('title', '')),
-                        'specialty': 'Medical Facility',
-                        'location': extract_city(location),
-                        'address': place.get('address', 'Contact for address'),
-                        'phone': place.get('phoneNumber', 'Contact for number'),
-                        'rating': place.get('rating', None),
-                        'ratingCount': place.get('ratingCount', None),
-                        'type': 'Physical Clinic',
-                        'date': 'Contact clinic',
-                        'time': 'Contact for times',
-                        'website': place.get('website', '')
-                    })
-        
-        print(f"Found {len(appointments)} valid appointments")
-        return jsonify({'appointments': appointments})
+        # Directory listings and physical clinics are searched concurrently
+        results, errors = find_care(disease, location, include=('appointments',))
+        appointments = results['appointments']
+
+        response = {'appointments': appointments}
+        if errors:
+            print(f"Partial appointment results, failed searches: {errors}")
+            response['errors'] = errors
+        return jsonify(response)
         
     except Exception as e:
         print(f"Error in find_appointments: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
-def clean_title(title):
-    """Clean up doctor/facility titles."""
-    # Remove common suffixes and prefixes
-    title = re.sub(r'\s*[-|]\s*.*$', '', title)
-    title = re.sub(r'Best\s+|Top\s+|Leading\s+', '', title)
-    title = re.sub(r'\[PDF\]|\(PDF\)', '', title)
-    title = re.sub(r'Dr\.\s*', 'Dr. ', title)
-    return title.strip()
-
-def extract_city(location):
-    """Extract city from location string."""
-    # Remove country and split by commas
-    parts = location.split(',')
-    return parts[0].strip()
-
-def is_valid_doctor_listing(info):
-    """Check if the listing appears to be a valid doctor."""
-    title = info['doctorName'].lower()
-    snippet = info.get('snippet', '').lower()
-    
-    # Keywords that indicate a valid doctor listing
-    valid_keywords = ['doctor', 'dr.', 'clinic', 'hospital', 'specialist', 'consultant']
-    
-    # Keywords that indicate an invalid listing
-    invalid_keywords = ['news', 'article', 'report', 'research', 'pdf', 'study']
-    
-    return (
-        any(keyword in title or keyword in snippet for keyword in valid_keywords) and
-        not any(keyword in title for keyword in invalid_keywords) and
-        len(info['doctorName']) > 5
-    )
+@app.route('/find-care', methods=['POST'])
+def find_care_route():
+    # /find-doctors and /find-appointments data from one parallel fan-out
+    try:
+        data = request.json or {}
+        location = data.get('location')
+        disease = data.get('disease')
 
-def is_valid_medical_facility(title):
-    """Check if the place is a valid medical facility."""
-    keywords = ['hospital', 'clinic', 'medical center', 'healthcare', 'doctor']
-    return any(keyword in title.lower() for keyword in keywords)
-
-def extract_specialty(text):
-    """Extract medical specialty from text."""
-    specialties = [
-        'Neurologist', 'Geriatrician', 'Psychiatrist', 'General Physician',
-        'Neurosurgeon', 'Mental Health Specialist', 'Memory Specialist',
-        'Brain Specialist', 'Dementia Specialist'
-    ]
-    
-    text_lower = text.lower()
-    for specialty in specialties:
-        if specialty.lower() in text_lower:
-            return specialty
-            
-    # Try to find specialty patterns
-    specialty_pattern = r'(?:specialist|consultant|expert)\s+in\s+([^,.]+)'
-    match = re.search(specialty_pattern, text_lower)
-    if match:
-        return match.group(1).title()
-    
-    return 'Specialist'
-
-def extract_phone(text):
-    """Extract phone number from text using regex."""
-    # Pakistani phone number patterns
-    patterns = [
-        r'(?:\+92|0)[-(]?\d{3}[)-]?\d{7,8}',  # Pakistani format
-        r'[\+]?[(]?\d{3}[)]?[-\s\.]?\d{3}[-\s\.]?\d{4,6}'  # General format
-    ]
-    
-    for pattern in patterns:
-        match = re.search(pattern, text)
-        if match:
-            return match.group(0)
-    
-    return 'Contact for number'
-
-def extract_address(text):
-    """Extract address from text."""
-    address_indicators = ['located at', 'address:', 'located in', 'clinic in', 'hospital in']
-    
-    # First try to find a complete address
-    for indicator in address_indicators:
-        if indicator in text.lower():
-            start_idx = text.lower().index(indicator) + len(indicator)
-            end_idx = text.find('.', start_idx)
-            if end_idx != -1:
-                return text[start_idx:end_idx].strip()
-    
-    # If no complete address found, try to extract location information
-    location_pattern = r'in\s+([^,.]+(?:,[^,.]+)*)'
-    match = re.search(location_pattern, text)
-    if match:
-        return match.group(1).strip()
-    
-    return 'Contact for address'
+        if not location or not disease:
+            return jsonify({'error': 'Location and disease are required'}), 400
+
+        results, errors = find_care(disease, location)
+        if errors:
+            print(f"Partial results, failed searches: {errors}")
+            results['errors'] = errors
+        return jsonify(results)
+
+    except Exception as e:
+        print(f"Error in find_care: {str(e)}")
+        return jsonify({'error': str(e)}), 500
 
 if __name__ == '__main__':
     app.run(debug=True, port=5000)
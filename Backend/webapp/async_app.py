@@ -0,0 +1,486 @@
+"""Asyncio serving mode for the I/O-bound routes.
+
+Usage:
+    python async_app.py --port 5000
+
+/chat, /find-doctors, /find-appointments, /find-care and /get-location run
+as coroutines on one event loop. Serper and OpenCage are called through a
+shared aiohttp session and Together through AsyncTogether, so an upstream
+call in flight costs a socket rather than a thread. /predict hands
+classification to a thread pool (INFERENCE_EXECUTOR_WORKERS) so the model
+never blocks the loop. Sessions, caches, metrics and the model are the ones
+app.py sets up, and responses match the Flask routes.
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+from aiohttp import web
+
+import app as flask_app
+import metrics
+from geocode import GeocodeError, reverse_geocode_async
+from inference import EngineBusy
+from metrics import timed_stage
+from search import cached_search_async, doctors_payload, find_care_async, parse_doctors
+from sessions import Session
+from upstream import CircuitOpen
+from volumes import classify_volume_file, is_volume_name, volume_suffix
+
+HTTP = web.AppKey('http', aiohttp.ClientSession)
+LLM = web.AppKey('llm')  # together.AsyncTogether
+EXECUTOR = web.AppKey('executor', ThreadPoolExecutor)
+
+# Same CORS policy as the Flask app
+ALLOWED_ORIGINS = {'http://localhost:3000'}
+
+
+async def read_json(request):
+    """The JSON body, or None if it's missing or malformed (like request.get_json(silent=True))."""
+    try:
+        return await request.json()
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+
+def get_session(request, body=None, create=False):
+    """Session for this request, as in app.get_session; new ids are sent back in on_prepare."""
+    session_id = flask_app.requested_session_id(request.headers, request.cookies, request.query, body)
+    session = flask_app.sessions.get(session_id) if session_id else None
+    if session is None and create:
+        session = flask_app.sessions.create()
+        request['new_session_id'] = session.id
+    return session
+
+
+def wants_stream(request):
+    return request.query.get('stream') in ('1', 'true') or 'text/event-stream' in request.headers.get('Accept', '')
+
+
+async def get_genai(llm, session):
+    chat_history = flask_app.prepare_messages(session)
+    key = flask_app.reply_cache_key(chat_history)
+    content = flask_app.llm_cache.get(key) if key else None
+
+    if content is None:
+        with metrics.upstream_call('together'):
+            response = await llm.chat.completions.create(
+                model=flask_app.LLM_MODEL, messages=chat_history, **flask_app.LLM_PARAMS)
+
+        if not response or not hasattr(response, 'choices'):
+            raise Exception("Invalid response from API")
+
+        content = response.choices[0].message.content
+        if key:
+            flask_app.llm_cache.put(key, content)
+
+    session.add("assistant", content)
+    return content
+
+
+async def stream_chat(request, session, start_turn, since, fmt, sent=False):
+    """Server-sent events for one chat turn, as in app.stream_chat."""
+    response = web.StreamResponse(headers={
+        'Content-Type': 'text/event-stream',
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+        'X-Session-ID': session.id,
+    })
+    async with session.async_lock:
+        snapshot = session.snapshot()
+        turn_since = session.version if since is None else since
+        start_turn()
+        await response.prepare(request)
+        try:
+            chat_history = flask_app.prepare_messages(session)
+            key = flask_app.reply_cache_key(chat_history)
+            content = flask_app.llm_cache.get(key) if key else None
+
+            if content is not None:
+                await response.write(flask_app.sse('token', {'delta': content}).encode('utf-8'))
+            else:
+                start = time.perf_counter()
+                with metrics.upstream_call('together'):
+                    stream = await request.app[LLM].chat.completions.create(
+                        model=flask_app.LLM_MODEL, messages=chat_history, stream=True, **flask_app.LLM_PARAMS)
+
+                parts = []
+                try:
+                    async for chunk in stream:
+                        delta = chunk.choices[0].delta if chunk.choices else None
+                        if delta is not None and delta.content:
+                            if not parts:
+                                metrics.observe_stage('together_first_token', time.perf_counter() - start)
+                            parts.append(delta.content)
+                            await response.write(flask_app.sse('token', {'delta': delta.content}).encode('utf-8'))
+                finally:
+                    await stream.aclose()
+                metrics.observe_stage('together_stream', time.perf_counter() - start)
+
+                content = ''.join(parts)
+                if key:
+                    flask_app.llm_cache.put(key, content)
+
+            session.add("assistant", content)
+            await response.write(flask_app.sse('done', flask_app.chat_payload(
+                session, turn_since, fmt, session.messages[-1]['content'], sent)).encode('utf-8'))
+        except (ConnectionResetError, asyncio.CancelledError):
+            print(f"Client disconnected from chat stream for session {session.id}")
+            session.restore(snapshot)
+            raise
+        except Exception as e:
+            print(f"API Error in stream_genai: {str(e)}")
+            await response.write(flask_app.sse('error', {'error': str(e)}).encode('utf-8'))
+    return response
+
+
+def chat_options(request):
+    """(since, format) from the query string, as in app.chat_options."""
+    fmt = request.query.get('format', 'delta')
+    try:
+        since = int(request.query['since']) if 'since' in request.query else None
+    except ValueError:
+        since = None
+    return since, fmt if fmt in flask_app.CHAT_FORMATS else None
+
+
+def bad_format():
+    return web.json_response({"error": f"format must be one of {', '.join(flask_app.CHAT_FORMATS)}"}, status=400)
+
+
+async def chat(request):
+    since, fmt = chat_options(request)
+    if fmt is None:
+        return bad_format()
+
+    if request.method == 'GET':
+        session = get_session(request)
+        if session is None:
+            return web.json_response({"error": "Unknown or expired session, upload a scan first"}, status=404)
+
+        def start_turn():
+            flask_app.start_conversation(session)
+    else:
+        body = await read_json(request) or {}
+        user_input = body.get('message', '')
+        if not user_input:
+            return web.json_response({"error": "Message is required"}, status=400)
+        session = get_session(request, body, create=True)
+
+        def start_turn():
+            session.add("user", user_input)
+
+    if wants_stream(request):
+        return await stream_chat(request, session, start_turn, since, fmt, sent=request.method == 'POST')
+
+    async with session.async_lock:
+        turn_since = session.version if since is None else since
+        start_turn()
+        try:
+            response = await get_genai(request.app[LLM], session)
+            return web.json_response(flask_app.chat_payload(
+                session, turn_since, fmt, response, sent=request.method == 'POST'))
+        except Exception as e:
+            print(f"Error in chat {request.method}: {str(e)}")
+            return web.json_response({"error": str(e)}, status=500)
+
+
+async def chat_history(request):
+    since, fmt = chat_options(request)
+    if fmt is None:
+        return bad_format()
+    session = get_session(request)
+    if session is None:
+        return web.json_response(flask_app.chat_payload(Session(None), since, fmt))
+    async with session.async_lock:
+        return web.json_response(flask_app.chat_payload(session, since, fmt))
+
+
+async def find_doctors(request):
+    data = await read_json(request)
+    if not data:
+        return web.json_response({'error': 'No data provided'}, status=400)
+
+    location = data.get('location')
+    disease = data.get('disease')
+    if not location or not disease:
+        return web.json_response({'error': 'Location and disease are required'}, status=400)
+
+    try:
+        search_results = await cached_search_async(request.app[HTTP], doctors_payload(disease, location))
+    except CircuitOpen:
+        return web.json_response({'error': 'Search is temporarily unavailable, try again later'}, status=503)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        print(f"Serper API error: {str(e)}")
+        return web.json_response({'error': 'Error calling search API'}, status=500)
+    except Exception as e:
+        print(f"General error in find_doctors: {str(e)}")
+        return web.json_response({'error': str(e)}, status=500)
+
+    with timed_stage('extraction'):
+        doctors = parse_doctors(search_results)
+    return web.json_response({'doctors': doctors})
+
+
+async def find_appointments(request):
+    try:
+        data = await read_json(request) or {}
+        location = data.get('location')
+        disease = data.get('disease')
+        if not location or not disease:
+            return web.json_response({'error': 'Location and disease are required'}, status=400)
+
+        results, errors = await find_care_async(request.app[HTTP], disease, location, include=('appointments',))
+        response = {'appointments': results['appointments']}
+        if errors:
+            print(f"Partial appointment results, failed searches: {errors}")
+            response['errors'] = errors
+        return web.json_response(response)
+
+    except Exception as e:
+        print(f"Error in find_appointments: {str(e)}")
+        return web.json_response({'error': str(e)}, status=500)
+
+
+async def find_care(request):
+    try:
+        data = await read_json(request) or {}
+        location = data.get('location')
+        disease = data.get('disease')
+        if not location or not disease:
+            return web.json_response({'error': 'Location and disease are required'}, status=400)
+
+        results, errors = await find_care_async(request.app[HTTP], disease, location)
+        if errors:
+            print(f"Partial results, failed searches: {errors}")
+            results['errors'] = errors
+        return web.json_response(results)
+
+    except Exception as e:
+        print(f"Error in find_care: {str(e)}")
+        return web.json_response({'error': str(e)}, status=500)
+
+
+async def get_location(request):
+    try:
+        data = await read_json(request) or {}
+        latitude = data.get('latitude')
+        longitude = data.get('longitude')
+        if not latitude or not longitude:
+            return web.json_response({'error': 'Latitude and longitude are required'}, status=400)
+
+        api_key = os.getenv('OPENCAGE_API_KEY')
+        if not api_key:
+            return web.json_response({'error': 'Geocoding service not configured'}, status=500)
+
+        try:
+            location = await reverse_geocode_async(request.app[HTTP], latitude, longitude, api_key)
+        except CircuitOpen:
+            return web.json_response({'error': 'Geocoding is temporarily unavailable, try again later'}, status=503)
+        except (GeocodeError, aiohttp.ClientError, asyncio.TimeoutError):
+            return web.json_response({'error': 'Error getting location details'}, status=500)
+
+        if location is None:
+            return web.json_response({'error': 'Location not found'}, status=404)
+        return web.json_response(location)
+
+    except Exception as e:
+        print(f"Error in get_location: {str(e)}")
+        return web.json_response({'error': str(e)}, status=500)
+
+
+async def file_part(request, name):
+    """The multipart part for file field name, or None.
+
+    Read parts straight from the request: request.post() would spool files
+    over 1 MB to a temp file first.
+    """
+    if not request.content_type.startswith('multipart/'):
+        return None
+    reader = await request.multipart()
+    async for part in reader:
+        if part.name == name and part.filename:
+            return part
+    return None
+
+
+async def read_part(part):
+    """A part's bytes, read into memory up to MAX_UPLOAD_MB (as in app.py)."""
+    data = bytearray()
+    while chunk := await part.read_chunk():
+        data.extend(chunk)
+        if len(data) > flask_app.MAX_UPLOAD_BYTES:
+            raise web.HTTPRequestEntityTooLarge(flask_app.MAX_UPLOAD_BYTES, len(data))
+    return bytes(data)
+
+
+async def save_part(part, executor):
+    """Stream a volume part to a temp file (keeping its suffix), as volumes.save_volume does; the caller deletes it.
+
+    Volumes are capped at MAX_VOLUME_MB, not the image limit.
+    """
+    loop = asyncio.get_running_loop()
+    fd, path = tempfile.mkstemp(suffix=volume_suffix(part.filename) or '')
+    size = 0
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            while chunk := await part.read_chunk(1024 * 1024):
+                size += len(chunk)
+                if size > flask_app.MAX_VOLUME_BYTES:
+                    raise web.HTTPRequestEntityTooLarge(flask_app.MAX_VOLUME_BYTES, size)
+                await loop.run_in_executor(executor, out.write, chunk)
+    except BaseException:
+        os.remove(path)
+        raise
+    return path
+
+
+async def predict(request):
+    with timed_stage('upload'):
+        part = await file_part(request, 'image')
+        if part is None:
+            return web.json_response({'error': 'No image provided'}, status=400)
+        if is_volume_name(part.filename):
+            path = await save_part(part, request.app[EXECUTOR])
+        else:
+            data = await read_part(part)
+
+    session = get_session(request, create=True)
+    loop = asyncio.get_running_loop()
+    if is_volume_name(part.filename):
+        # Classified from a sample of slices on disk, as in app.predict
+        try:
+            volume = await loop.run_in_executor(
+                request.app[EXECUTOR], metrics.propagate(classify_volume_file), path, True)
+        except (ValueError, RuntimeError) as e:
+            return web.json_response({'error': f'Could not read volume: {str(e)}'}, status=400)
+        session.prediction = volume['predicted_class']
+        return web.json_response({'predicted_class': session.prediction, 'session_id': session.id, 'volume': volume})
+
+    if flask_app.upload_writer is not None:
+        flask_app.upload_writer.submit(part.filename, data)
+
+    try:
+        # Decode, cache lookup and the engine wait all block, so they run off the loop
+        session.prediction = await loop.run_in_executor(
+            request.app[EXECUTOR], metrics.propagate(flask_app.classify), data)
+    except EngineBusy:
+        return web.json_response({'error': 'Server busy, try again'}, status=503)
+
+    return web.json_response({'predicted_class': session.prediction, 'session_id': session.id})
+
+
+async def metrics_endpoint(request):
+    return web.Response(body=metrics.render().encode('utf-8'),
+                        headers={'Content-Type': 'text/plain; version=0.0.4'})
+
+
+@web.middleware
+async def observe(request, handler):
+    request['start'] = time.perf_counter()
+    # Requests on a keep-alive connection share a task, so always reset the profile
+    if request.headers.get('X-Profile') == '1' and metrics.profiling_enabled():
+        metrics.start_profile()
+    else:
+        metrics.finish_profile()
+    if request.method == 'OPTIONS':
+        return web.Response()  # CORS preflight; headers are added in on_prepare
+    return await handler(request)
+
+
+async def on_prepare(request, response):
+    # Runs just before headers go out, for streamed and plain responses alike
+    origin = request.headers.get('Origin')
+    if origin in ALLOWED_ORIGINS:
+        response.headers['Access-Control-Allow-Origin'] = origin
+        response.headers['Access-Control-Expose-Headers'] = 'X-Session-ID, Server-Timing'
+        response.headers['Access-Control-Allow-Credentials'] = 'true'
+        if request.method == 'OPTIONS':
+            response.headers['Access-Control-Allow-Methods'] = 'GET, POST, OPTIONS'
+            response.headers['Access-Control-Allow-Headers'] = 'Content-Type, X-Session-ID, X-Profile'
+    if 'new_session_id' in request:
+        response.headers['X-Session-ID'] = request['new_session_id']
+        # Too late for response.set_cookie here: the cookie jar is already serialized
+        response.headers.add('Set-Cookie', f"{flask_app.SESSION_COOKIE}={request['new_session_id']}; "
+                             f"Max-Age={int(flask_app.sessions.ttl_seconds)}; HttpOnly; Path=/; SameSite=Lax")
+
+    if 'start' not in request:
+        return
+    elapsed = time.perf_counter() - request['start']
+    route = request.match_info.route.resource
+    endpoint = route.canonical if route is not None else 'unmatched'
+    metrics.REQUEST_SECONDS.observe(elapsed, endpoint=endpoint, method=request.method)
+    metrics.RESPONSES.inc(endpoint=endpoint, status=str(response.status))
+    stages = metrics.finish_profile()
+    if stages is not None:
+        response.headers['Server-Timing'] = metrics.server_timing(stages + [('total', elapsed)])
+
+
+async def on_startup(application):
+    from together import AsyncTogether
+
+    connector = aiohttp.TCPConnector(limit=int(os.getenv('ASYNC_MAX_CONNECTIONS', '512')))
+    application[HTTP] = aiohttp.ClientSession(connector=connector)
+    application[LLM] = AsyncTogether(api_key=os.getenv('TOGETHER_API_KEY'))
+    application[EXECUTOR] = ThreadPoolExecutor(
+        max_workers=int(os.getenv('INFERENCE_EXECUTOR_WORKERS', '4')), thread_name_prefix='inference')
+
+
+async def on_cleanup(application):
+    await application[HTTP].close()
+    application[EXECUTOR].shutdown(wait=False)
+
+
+def create_app():
+    application = web.Application(
+        middlewares=[observe],
+        # Bodies read whole (JSON); multipart uploads are bounded in read_part and save_part
+        client_max_size=flask_app.MAX_UPLOAD_BYTES,
+    )
+    application.router.add_route('GET', '/chat', chat)
+    application.router.add_route('POST', '/chat', chat)
+    application.router.add_get('/chat/history', chat_history)
+    application.router.add_post('/find-doctors', find_doctors)
+    application.router.add_post('/find-appointments', find_appointments)
+    application.router.add_post('/find-care', find_care)
+    application.router.add_post('/get-location', get_location)
+    application.router.add_post('/predict', predict)
+    application.router.add_get('/metrics', metrics_endpoint)
+    application.on_response_prepare.append(on_prepare)
+    application.on_startup.append(on_startup)
+    application.on_cleanup.append(on_cleanup)
+    return application
+
+
+def start_background(host='127.0.0.1', port=0):
+    """Serve on a daemon thread with its own event loop; returns (base_url, stop)."""
+    loop = asyncio.new_event_loop()
+    runner = web.AppRunner(create_app())
+    loop.run_until_complete(runner.setup())
+    site = web.TCPSite(runner, host, port)
+    loop.run_until_complete(site.start())
+    bound_host, bound_port = runner.addresses[0][:2]
+    threading.Thread(target=loop.run_forever, name='async-app', daemon=True).start()
+
+    def stop():
+        asyncio.run_coroutine_threadsafe(runner.cleanup(), loop).result(timeout=10)
+        loop.call_soon_threadsafe(loop.stop)
+
+    return f'http://{bound_host}:{bound_port}', stop
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    args = parser.parse_args()
+    web.run_app(create_app(), host=args.host, port=args.port)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+import copy
+import os
+import tempfile
+
+import torch
+
+# Selectable with INFERENCE_BACKEND; each one is built once when the model is loaded
+BACKENDS = ('eager', 'dynamic_int8', 'static_int8', 'torchscript', 'compile', 'onnx')
+
+
+class LogitsModule(torch.nn.Module):
+    """Wraps the HF classifier so it maps pixel_values -> logits tensor.
+
+    Tracing, quantization and ONNX export all need a plain tensor-in,
+    tensor-out module instead of the ModelOutput-returning HF forward.
+    """
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, pixel_values):
+        return self.model(pixel_values=pixel_values, return_dict=False)[0]
+
+
+def selected_backend():
+    name = os.getenv('INFERENCE_BACKEND', 'eager').lower()
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown INFERENCE_BACKEND {name!r}, expected one of {', '.join(BACKENDS)}")
+    return name
+
+
+def build_backend(name, model, example_inputs):
+    """Convert an eval-mode HF model into a pixel_values -> logits callable.
+
+    example_inputs is a (N, 3, H, W) batch used for tracing, export and
+    static-quantization calibration; pass real scans for best int8 accuracy.
+    """
+    module = LogitsModule(model).eval()
+
+    if name == 'eager':
+        return module
+
+    if name == 'dynamic_int8':
+        # Dynamic quantization only covers Linear layers, i.e. the classifier head
+        return torch.ao.quantization.quantize_dynamic(copy.deepcopy(module), {torch.nn.Linear}, dtype=torch.qint8)
+
+    if name == 'static_int8':
+        return _static_int8(module, example_inputs)
+
+    if name == 'torchscript':
+        with torch.no_grad():
+            traced = torch.jit.trace(module, example_inputs, strict=False)
+        return torch.jit.optimize_for_inference(torch.jit.freeze(traced))
+
+    if name == 'compile':
+        compiled = torch.compile(module, dynamic=True)
+        with torch.no_grad():
+            compiled(example_inputs)  # compile now rather than on the first request
+        return compiled
+
+    if name == 'onnx':
+        return OnnxBackend(module, example_inputs)
+
+    raise ValueError(f"Unknown inference backend {name!r}")
+
+
+def _static_int8(module, example_inputs):
+    """Post-training static quantization of convs and linears via FX graph mode."""
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+    from transformers.utils.fx import symbolic_trace
+
+    torch.backends.quantized.engine = 'x86' if 'x86' in torch.backends.quantized.supported_engines else 'qnnpack'
+    # The HF forward has config-driven branches plain torch.fx can't trace; the HF tracer can
+    traced = symbolic_trace(copy.deepcopy(module.model), input_names=['pixel_values'])
+    module = _TracedLogits(traced).eval()
+    prepared = prepare_fx(module, get_default_qconfig_mapping(torch.backends.quantized.engine), (example_inputs,))
+    with torch.no_grad():
+        prepared(example_inputs)  # calibration
+    return convert_fx(prepared)
+
+
+class _TracedLogits(torch.nn.Module):
+    def __init__(self, traced):
+        super().__init__()
+        self.traced = traced
+
+    def forward(self, pixel_values):
+        return self.traced(pixel_values)['logits']
+
+
+class OnnxBackend:
+    """Exports the model to ONNX once and runs it with onnxruntime."""
+
+    def __init__(self, module, example_inputs):
+        try:
+            import onnxruntime
+        except ImportError:
+            raise RuntimeError("The onnx backend needs the onnx and onnxruntime packages installed")
+
+        fd, path = tempfile.mkstemp(suffix='.onnx')
+        os.close(fd)
+        try:
+            with torch.no_grad():
+                torch.onnx.export(
+                    module, (example_inputs,), path,
+                    input_names=['pixel_values'], output_names=['logits'],
+                    dynamic_axes={'pixel_values': {0: 'batch'}, 'logits': {0: 'batch'}},
+                )
+
+            options = onnxruntime.SessionOptions()
+            options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+            self.session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        finally:
+            # The session holds the model in memory; every build, reload and serve.py worker made a new file
+            os.remove(path)
+
+    def __call__(self, pixel_values):
+        logits, = self.session.run(None, {'pixel_values': pixel_values.numpy()})
+        return torch.from_numpy(logits)
@@ -0,0 +1,514 @@
+"""Offline benchmarks for the backend.
+
+Usage:
+    python benchmark.py fanout --latency 0.3 --requests 20
+    python benchmark.py extraction --count 5000 --requests 20
+    python benchmark.py e2e --concurrency 1,4,16 --requests 200 --output before.json
+    python benchmark.py compare before.json after.json
+    python benchmark.py e2e --server async --endpoints chat,find-doctors --concurrency 64,256 --output async.json
+    python benchmark.py e2e --server serve --workers 4 --endpoints predict --output prefork.json
+    python benchmark.py e2e --endpoints predict,jobs --concurrency 64 --requests 500
+    python benchmark.py startup --requests 5
+    python benchmark.py upstream --latency 0.02 --requests 200
+
+The e2e suite runs app.py (or async_app.py with --server async) in-process against stubs.py's fake Together,
+Serper and OpenCage servers and a tiny random classifier, so it needs no
+network access or API keys.
+"""
+import argparse
+import contextlib
+import io
+import json
+import logging
+import os
+import platform
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import stubs
+
+
+def timed(fn, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def percentile(sorted_timings, q):
+    """Nearest-rank percentile of an already sorted list."""
+    index = max(0, min(len(sorted_timings) - 1, int(round(q / 100 * len(sorted_timings))) - 1))
+    return sorted_timings[index]
+
+
+def summarize(timings):
+    timings = sorted(timings)
+    return {
+        'mean_ms': statistics.mean(timings) * 1000,
+        'p50_ms': timings[len(timings) // 2] * 1000,
+        'p95_ms': percentile(timings, 95) * 1000,
+        'p99_ms': percentile(timings, 99) * 1000,
+        'max_ms': timings[-1] * 1000,
+    }
+
+
+def bench_fanout(latency, repeat):
+    """Sequential Serper calls (the old find_appointments) vs the concurrent fan-out."""
+    with stubs.fake_serper(latency=latency) as serper:
+        os.environ['SERPER_API_URL'] = serper.url + '/search'
+        import search
+
+        disease, location = 'Very_Mild_Demented', 'Lahore, Pakistan'
+
+        def sequential():
+            search.serper_search(search.directory_payload(disease, location))
+            search.serper_search(search.places_payload(disease, location))
+
+        def sequential_combined():
+            search.serper_search(search.doctors_payload(disease, location))
+            sequential()
+
+        results = {
+            'appointments_sequential': summarize(timed(sequential, repeat)),
+            'appointments_fan_out': summarize(timed(lambda: search.find_care(disease, location, ('appointments',)), repeat)),
+            'doctors_and_appointments_sequential': summarize(timed(sequential_combined, repeat)),
+            'doctors_and_appointments_fan_out': summarize(timed(lambda: search.find_care(disease, location), repeat)),
+        }
+
+    print(f"Serper stub latency {latency * 1000:.0f} ms, {repeat} runs each")
+    for name, stats in results.items():
+        print(f"{name:38s} mean {stats['mean_ms']:8.1f} ms  p50 {stats['p50_ms']:8.1f} ms  max {stats['max_ms']:8.1f} ms")
+    return results
+
+
+def bench_upstream(latency, repeat):
+    """The shared upstream client against stub servers: pooling, hedging, retries and the circuit breaker."""
+    import requests
+
+    from upstream import CircuitBreaker, UpstreamClient
+
+    payload = search_payload = {'q': 'neurologist Lahore', 'num': 10}
+
+    def run(call):
+        timings, errors = [], 0
+        for _ in range(repeat):
+            start = time.perf_counter()
+            try:
+                response = call()
+                errors += response.status_code != 200
+            except requests.RequestException:
+                errors += 1
+            timings.append(time.perf_counter() - start)
+        return dict(summarize(timings), error_rate=errors / repeat)
+
+    def client(**kwargs):
+        kwargs.setdefault('breaker', CircuitBreaker(failure_threshold=0))
+        return UpstreamClient('bench', **kwargs)
+
+    results = {}
+    with stubs.fake_serper(latency=latency, seed=1) as serper:
+        url = serper.url + '/search'
+        results['new connection per call'] = run(lambda: requests.post(url, json=payload, timeout=10))
+        pooled = client(retries=0)
+        results['pooled keep-alive'] = run(lambda: pooled.post(url, json=payload))
+
+    with stubs.fake_serper(latency=latency, slow_rate=0.05, slow_latency=1.0, seed=2) as serper:
+        url = serper.url + '/search'
+        results['5% slow (1 s), no hedging'] = run(lambda: client(retries=0).post(url, json=search_payload))
+        hedged = client(retries=0, hedge_after=max(0.05, latency * 3))
+        results['5% slow (1 s), hedged'] = run(lambda: hedged.post(url, json=search_payload))
+
+    with stubs.fake_serper(latency=latency, failure_rate=0.2, seed=3) as serper:
+        url = serper.url + '/search'
+        results['20% errors, no retries'] = run(lambda: client(retries=0).post(url, json=payload))
+        retrying = client(retries=2, backoff=0.01)
+        results['20% errors, 2 retries'] = run(lambda: retrying.post(url, json=payload))
+
+    with stubs.fake_serper(latency=max(latency, 0.2), failure_rate=1.0, seed=4) as serper:
+        url = serper.url + '/search'
+        results['provider down, no breaker'] = run(lambda: client(retries=0).post(url, json=payload))
+        breaking = client(retries=0, breaker=CircuitBreaker(failure_threshold=5, reset_timeout=60))
+        results['provider down, breaker'] = run(lambda: breaking.post(url, json=payload))
+
+    print(f"Serper stub latency {latency * 1000:.0f} ms, {repeat} calls each")
+    for name, stats in results.items():
+        print(f"{name:30s} mean {stats['mean_ms']:8.1f}  p50 {stats['p50_ms']:8.1f}  p99 {stats['p99_ms']:8.1f} ms  "
+              f"errors {stats['error_rate']:.1%}")
+    return results
+
+
+def bench_extraction(count, repeat):
+    """reference_search.py's per-result helpers vs the compiled ListingExtractor over count synthetic results."""
+    import reference_search
+    from extraction import ListingExtractor
+
+    directory, places = stubs.synthetic_search_results(count)
+    location = 'Lahore, Pakistan'
+    extractor = ListingExtractor()
+
+    def reference():
+        reference_search.parse_directory_listings(directory, location) + reference_search.parse_places(places, location)
+
+    results = {
+        'reference': summarize(timed(reference, repeat)),
+        'compiled': summarize(timed(lambda: extractor.appointments(directory, places, location), repeat)),
+    }
+
+    print(f"{count} organic + {len(places['places'])} places results, {repeat} runs each")
+    for name, stats in results.items():
+        per_result_us = stats['p50_ms'] * 1000 / (count + len(places['places']))
+        print(f"{name:10s} mean {stats['mean_ms']:8.2f} ms  p50 {stats['p50_ms']:8.2f} ms  ({per_result_us:.2f} us/result)")
+    return results
+
+
+E2E_ENDPOINTS = ('predict', 'chat', 'find-doctors', 'find-appointments', 'get-location')
+CITIES = ['Lahore, Pakistan', 'Karachi, Pakistan', 'Islamabad, Pakistan', 'Rawalpindi, Pakistan']
+
+
+def scan_images(count, seed=0):
+    """count distinct JPEG-encoded random scans, so uploads don't all hit the prediction cache."""
+    import numpy as np
+    from PIL import Image
+
+    rng = np.random.RandomState(seed)
+    images = []
+    for _ in range(count):
+        buffer = io.BytesIO()
+        Image.fromarray(rng.randint(0, 256, size=(256, 256, 3), dtype=np.uint8)).save(buffer, format='JPEG')
+        images.append(buffer.getvalue())
+    return images
+
+
+def e2e_requests(base_url, seed=0):
+    """endpoint -> call(http_session, i) issuing the i-th request against the app."""
+    images = scan_images(32, seed)
+    diseases = stubs.LABELS
+
+    def predict(http, i):
+        return http.post(f'{base_url}/predict', files={'image': (f'scan{i}.jpg', images[i % len(images)], 'image/jpeg')})
+
+    def jobs(http, i):
+        # Submit to the job queue and wait for the result; a 429 rejection is returned as is
+        response = http.post(f'{base_url}/jobs', files={'image': (f'scan{i}.jpg', images[i % len(images)], 'image/jpeg')})
+        if response.status_code != 202:
+            return response
+        return http.get(f"{base_url}/jobs/{response.json()['job_id']}", params={'wait': 30})
+
+    def chat(http, i):
+        # An id the server never issued starts a fresh session, so every call has the same history length
+        return http.post(f'{base_url}/chat', json={'message': 'What are the early signs?'},
+                         headers={'X-Session-ID': f'bench-{seed}-{i}'})
+
+    def find_doctors(http, i):
+        return http.post(f'{base_url}/find-doctors', json={
+            'disease': diseases[i % len(diseases)], 'location': CITIES[i % len(CITIES)]})
+
+    def find_appointments(http, i):
+        return http.post(f'{base_url}/find-appointments', json={
+            'disease': diseases[i % len(diseases)], 'location': CITIES[i % len(CITIES)]})
+
+    def get_location(http, i):
+        rng = random.Random(i)
+        return http.post(f'{base_url}/get-location', json={
+            'latitude': 31.5 + rng.uniform(-0.5, 0.5), 'longitude': 74.3 + rng.uniform(-0.5, 0.5)})
+
+    return {
+        'predict': predict,
+        'jobs': jobs,
+        'chat': chat,
+        'find-doctors': find_doctors,
+        'find-appointments': find_appointments,
+        'get-location': get_location,
+    }
+
+
+def drive(call, concurrency, total):
+    """Issue total requests from concurrency client threads; returns throughput and latency stats."""
+    import requests
+
+    local = threading.local()
+    lock = threading.Lock()
+    timings, statuses = [], {}
+
+    def one(i):
+        http = getattr(local, 'http', None)
+        if http is None:
+            http = local.http = requests.Session()
+        start = time.perf_counter()
+        try:
+            status = call(http, i).status_code
+        except requests.RequestException:
+            status = 'connection_error'
+        elapsed = time.perf_counter() - start
+        with lock:
+            timings.append(elapsed)
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one, range(total)))
+    wall = time.perf_counter() - start
+
+    ok = sum(count for status, count in statuses.items() if status.startswith('2'))
+    return dict(summarize(timings), **{
+        'requests': total,
+        'concurrency': concurrency,
+        'throughput_rps': total / wall,
+        'error_rate': 1 - ok / total,
+        'statuses': statuses,
+    })
+
+
+def e2e_environment(args, model_dir):
+    """Start the fake upstreams and point the app's configuration at them."""
+    servers = {
+        'together': stubs.fake_together(first_token_delay=args.llm_latency, chunk_delay=0.0,
+                                        failure_rate=args.failure_rate, seed=1),
+        'serper': stubs.fake_serper(latency=args.latency, failure_rate=args.failure_rate, seed=2),
+        'opencage': stubs.fake_opencage(latency=args.latency, failure_rate=args.failure_rate, seed=3),
+    }
+    for server in servers.values():
+        server.start()
+
+    os.environ.update({
+        'TOGETHER_BASE_URL': servers['together'].url + '/v1',
+        'SERPER_API_URL': servers['serper'].url + '/search',
+        'OPENCAGE_API_URL': servers['opencage'].url + '/geocode/v1/json',
+        'TOGETHER_API_KEY': 'stub', 'SERPER_API_KEY': 'stub', 'OPENCAGE_API_KEY': 'stub',
+        'MODEL_REPO': stubs.tiny_classifier(model_dir),
+    })
+    os.environ.pop('MODEL_REVISION', None)
+    if not args.caches:
+        # Measure the real request path rather than cache hits
+        os.environ.update({
+            'PREDICTION_CACHE_MB': '0', 'LLM_CACHE_SIZE': '0', 'SERPER_CACHE_TTL': '0', 'GEOCODE_CACHE_TTL': '0',
+        })
+    return servers
+
+
+def start_serve(workers):
+    """Launch serve.py on a free port with the current (stubbed) environment and wait until it answers."""
+    import requests
+
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+    process = subprocess.Popen(
+        [sys.executable, 'serve.py', '--port', str(port), '--workers', str(workers)],
+        cwd=os.path.dirname(os.path.abspath(__file__)), stdout=subprocess.DEVNULL,
+    )
+    base_url = f'http://127.0.0.1:{port}'
+    deadline = time.monotonic() + 120
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'serve.py exited with status {process.returncode}')
+        try:
+            requests.get(base_url + '/metrics', timeout=1)
+            return base_url, process
+        except requests.RequestException:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError('serve.py did not start within 120 s')
+
+
+def process_tree_memory(pid):
+    """RSS and PSS in MB summed over pid and its children (Linux only; None elsewhere).
+
+    PSS splits shared pages between the processes sharing them, so for
+    pre-forked workers it shows how much of the model is really shared.
+    """
+    def children(pid):
+        try:
+            with open(f'/proc/{pid}/task/{pid}/children') as f:
+                return [int(child) for child in f.read().split()]
+        except OSError:
+            return []
+
+    totals = {'processes': 0, 'rss_mb': 0.0, 'pss_mb': 0.0}
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        pending.extend(children(current))
+        try:
+            with open(f'/proc/{current}/smaps_rollup') as f:
+                fields = dict(line.split(':', 1) for line in f if ':' in line)
+        except OSError:
+            return None
+        totals['processes'] += 1
+        totals['rss_mb'] += int(fields['Rss'].split()[0]) / 1024
+        totals['pss_mb'] += int(fields['Pss'].split()[0]) / 1024
+    return totals
+
+
+def bench_e2e(args):
+    """Drive the app's main endpoints at each concurrency level and collect the stats."""
+    from werkzeug.serving import make_server
+
+    # The app logs every request; keep only the report on the terminal
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    with tempfile.TemporaryDirectory() as model_dir, open(os.devnull, 'w') as devnull, \
+            contextlib.redirect_stdout(devnull):
+        servers = e2e_environment(args, model_dir)
+        server_pid = os.getpid()
+        if args.server == 'async':
+            import async_app
+            base_url, stop_app = async_app.start_background()
+        elif args.server == 'serve':
+            base_url, process = start_serve(args.workers)
+            server_pid = process.pid
+
+            def stop_app():
+                process.terminate()
+                process.wait(timeout=30)
+        else:
+            import app
+            httpd = make_server('127.0.0.1', 0, app.app, threaded=True)
+            threading.Thread(target=httpd.serve_forever, daemon=True).start()
+            base_url, stop_app = f'http://127.0.0.1:{httpd.server_port}', httpd.shutdown
+        calls = e2e_requests(base_url)
+        levels = [int(level) for level in args.concurrency.split(',')]
+        endpoints = args.endpoints.split(',')
+
+        results = {}
+        try:
+            for endpoint in endpoints:
+                drive(calls[endpoint], 1, min(5, args.requests))  # warm up connections and lazy setup
+                results[endpoint] = {}
+                for level in levels:
+                    stats = drive(calls[endpoint], level, args.requests)
+                    results[endpoint][str(level)] = stats
+                    print(
+                        f"{endpoint:18s} c={level:<3d} {stats['throughput_rps']:8.1f} req/s  "
+                        f"p50 {stats['p50_ms']:8.1f}  p95 {stats['p95_ms']:8.1f}  p99 {stats['p99_ms']:8.1f} ms  "
+                        f"errors {stats['error_rate']:.1%}", file=sys.__stdout__, flush=True,
+                    )
+            memory = process_tree_memory(server_pid)
+        finally:
+            stop_app()
+            for server in servers.values():
+                server.stop()
+
+    report = {
+        'meta': {
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'server': args.server,
+            'workers': args.workers if args.server == 'serve' else 1,
+            'server_memory': memory,
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'cpu_count': os.cpu_count(),
+            'upstream_latency_s': args.latency,
+            'llm_latency_s': args.llm_latency,
+            'failure_rate': args.failure_rate,
+            'caches': args.caches,
+            'requests_per_level': args.requests,
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Saved results to {args.output}", file=sys.__stdout__)
+    return report
+
+
+STARTUP_PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+torch_at_import = 'torch' in sys.modules
+app.load_model()
+ready = time.perf_counter()
+json.dump({'import_s': imported - start, 'ready_s': ready - start,
+           'torch_at_import': torch_at_import}, sys.stderr)
+"""
+
+
+def bench_startup(runs, size='resnet50'):
+    """Time `import app` (non-model routes can serve) and import-to-model-ready in fresh processes."""
+    with tempfile.TemporaryDirectory() as model_dir:
+        env = dict(os.environ, MODEL_REPO=stubs.tiny_classifier(model_dir, size=size),
+                   TOGETHER_API_KEY='stub', LLM_CACHE_PREWARM='0')
+        samples = []
+        for _ in range(runs):
+            done = subprocess.run([sys.executable, '-c', STARTUP_PROBE], env=env, stdout=subprocess.DEVNULL,
+                                  stderr=subprocess.PIPE, text=True, check=True)
+            samples.append(json.loads(done.stderr.strip().splitlines()[-1]))
+
+    for key in ('import_s', 'ready_s'):
+        values = [sample[key] for sample in samples]
+        print(f"{key:10s} median {statistics.median(values) * 1000:8.1f} ms  "
+              f"min {min(values) * 1000:8.1f}  max {max(values) * 1000:8.1f}")
+    print(f"torch imported by `import app`: {samples[0]['torch_at_import']}")
+
+
+def compare(baseline_path, current_path):
+    """Print throughput and latency changes between two e2e result files."""
+    with open(baseline_path) as f:
+        baseline = json.load(f)['results']
+    with open(current_path) as f:
+        current = json.load(f)['results']
+
+    def change(before, after):
+        return f"{(after - before) / before:+7.1%}" if before else '    n/a'
+
+    print(f"{'endpoint':18s} {'conc':>4s} {'req/s':>16s} {'p50 ms':>16s} {'p95 ms':>16s} {'p99 ms':>16s}")
+    for endpoint, levels in current.items():
+        for level, stats in levels.items():
+            before = baseline.get(endpoint, {}).get(level)
+            if before is None:
+                continue
+            columns = [
+                f"{stats[key]:8.1f} {change(before[key], stats[key])}"
+                for key in ('throughput_rps', 'p50_ms', 'p95_ms', 'p99_ms')
+            ]
+            print(f"{endpoint:18s} {level:>4s} " + ' '.join(columns))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('suite', choices=['fanout', 'extraction', 'e2e', 'compare', 'startup', 'upstream'])
+    parser.add_argument('files', nargs='*', help='compare: baseline.json current.json')
+    parser.add_argument('--latency', type=float, default=0.3, help='injected upstream latency in seconds')
+    parser.add_argument('--requests', type=int, default=20, help='runs per variant')
+    parser.add_argument('--count', type=int, default=5000, help='synthetic search results (extraction)')
+    parser.add_argument('--endpoints', default=','.join(E2E_ENDPOINTS), help='comma-separated endpoints (e2e)')
+    parser.add_argument('--concurrency', default='1,4,16', help='comma-separated client concurrency levels (e2e)')
+    parser.add_argument('--llm-latency', type=float, default=0.5, help='fake Together response time in seconds (e2e)')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='fraction of upstream calls that fail (e2e)')
+    parser.add_argument('--caches', action='store_true', help='keep prediction/LLM/search/geocode caches on (e2e)')
+    parser.add_argument('--server', choices=['flask', 'async', 'serve'], default='flask',
+                        help='threaded Flask app, async_app.py, or pre-fork serve.py in a subprocess (e2e)')
+    parser.add_argument('--workers', type=int, default=2, help='serve.py worker processes (e2e --server serve)')
+    parser.add_argument('--output', help='write e2e results as JSON')
+    args = parser.parse_args()
+
+    if args.suite == 'e2e':
+        bench_e2e(args)
+    elif args.suite == 'compare':
+        if len(args.files) != 2:
+            parser.error('compare needs a baseline and a current results file')
+        compare(*args.files)
+    elif args.suite == 'upstream':
+        bench_upstream(args.latency, args.requests)
+    elif args.suite == 'startup':
+        bench_startup(args.requests)
+    elif args.suite == 'extraction':
+        bench_extraction(args.count, args.requests)
+    else:
+        bench_fanout(args.latency, args.requests)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,208 @@
+"""Classify whole studies (a zip archive or a directory of slices) in one go.
+
+Usage:
+    python bulk.py study.zip > results.ndjson
+    python bulk.py scans/study_42/ --batch-size 16 --workers 4
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import zipfile
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+
+from preprocess import open_image
+
+IMAGE_EXTENSIONS = {'png', 'jpg', 'jpeg'}
+
+# Largest batch a caller may ask for; classify_study holds up to 5 batches of slices (4 decoding, 1 filling)
+BULK_MAX_BATCH = int(os.getenv('BULK_MAX_BATCH', '64'))
+
+_decode_pool = None
+
+
+def is_image_name(name):
+    base = os.path.basename(name)
+    if not base or base.startswith('.') or '__MACOSX' in name:
+        return False
+    return '.' in base and base.rsplit('.', 1)[1].lower() in IMAGE_EXTENSIONS
+
+
+def iter_zip(archive):
+    """Yield (name, bytes) for every image in a zip, one member at a time."""
+    with zipfile.ZipFile(archive) as zf:
+        for info in zf.infolist():
+            if not info.is_dir() and is_image_name(info.filename):
+                yield info.filename, zf.read(info)
+
+
+def iter_directory(path):
+    """Yield (name, bytes) for every image under a directory, in sorted order."""
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for filename in sorted(files):
+            if is_image_name(filename):
+                file_path = os.path.join(root, filename)
+                with open(file_path, 'rb') as f:
+                    yield os.path.relpath(file_path, path), f.read()
+
+
+def iter_uploads(files):
+    """Yield (name, bytes) for a list of (filename, file object) pairs."""
+    for filename, f in files:
+        with f:
+            yield filename, f.read()
+
+
+def spool(stream, max_memory=1024 * 1024):
+    """Copy an upload into a temp file we own.
+
+    Flask closes request files when the view returns, before a streamed
+    response has been consumed, so the bulk endpoint works from its own copy.
+    """
+    tmp = tempfile.SpooledTemporaryFile(max_size=max_memory)
+    shutil.copyfileobj(stream, tmp)
+    tmp.seek(0)
+    return tmp
+
+
+def iter_source(source):
+    """Open a path (zip or directory) or a file-like zip archive."""
+    if isinstance(source, str) and os.path.isdir(source):
+        return iter_directory(source)
+    return iter_zip(source)
+
+
+def decode_image(data, draft_size=None):
+    """Runs in a worker process: bytes -> RGB PIL image."""
+    return open_image(data, draft_size)
+
+
+def start_decode_pool(workers=None):
+    """Create the decode pool and fork all its workers now, while this process has one thread.
+
+    Forking a process that already runs other threads (the model loader,
+    the inference engine, job workers) can leave a child holding a lock
+    nobody will release. A fork-based pool forks every worker on its first
+    submit, so a no-op submit here does it up front; app.py calls this
+    before it starts any thread when run as the server, serve.py in each
+    worker before its own.
+    """
+    global _decode_pool
+    if _decode_pool is None:
+        workers = workers or int(os.getenv('BULK_DECODE_WORKERS', '0')) or os.cpu_count()
+        _decode_pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork'))
+        _decode_pool.submit(int).result()
+    return _decode_pool
+
+
+def get_decode_pool(workers=None):
+    """Process pool shared by every bulk request, sized by BULK_DECODE_WORKERS.
+
+    Without start_decode_pool, threads may already be running, so the
+    workers come from a forkserver instead of a fork of this process.
+    """
+    global _decode_pool
+    if _decode_pool is None:
+        workers = workers or int(os.getenv('BULK_DECODE_WORKERS', '0')) or os.cpu_count()
+        _decode_pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('forkserver'))
+    return _decode_pool
+
+
+def clamp_batch_size(batch_size):
+    return min(max(1, batch_size), BULK_MAX_BATCH)
+
+
+def classify_study(items, batch_size=16, pool=None, max_inflight=None):
+    """Decode slices in parallel, classify them in batches and yield results as they finish.
+
+    items is an iterable of (name, bytes). At most max_inflight slices are
+    being decoded or waiting for a batch at any time, so memory stays flat
+    however many slices the study has. batch_size is clamped to
+    BULK_MAX_BATCH. The last result is a study summary.
+    """
+    from model import predict_batch, get_draft_size
+
+    pool = pool or get_decode_pool()
+    draft_size = get_draft_size()
+    batch_size = clamp_batch_size(batch_size)
+    max_inflight = max_inflight or batch_size * 4
+    pending = deque()
+    batch = []
+    counts = Counter()
+    errors = 0
+
+    def flush():
+        results = predict_batch([image for _, image in batch])
+        for (name, _), (label, logits) in zip(batch, results):
+            counts[label] += 1
+            yield {'slice': name, 'predicted_class': label, 'logits': logits.tolist()}
+        batch.clear()
+
+    def drain(limit):
+        nonlocal errors
+        while len(pending) > limit:
+            name, future = pending.popleft()
+            try:
+                batch.append((name, future.result()))
+            except Exception as e:
+                errors += 1
+                yield {'slice': name, 'error': str(e)}
+                continue
+            if len(batch) >= batch_size:
+                yield from flush()
+
+    try:
+        for name, data in items:
+            pending.append((name, pool.submit(decode_image, data, draft_size)))
+            yield from drain(max_inflight)
+        yield from drain(0)
+        if batch:
+            yield from flush()
+    finally:
+        for _, future in pending:
+            future.cancel()
+
+    total = sum(counts.values())
+    yield {
+        'summary': {
+            'slices': total,
+            'errors': errors,
+            'class_distribution': dict(counts),
+            'class_fractions': {label: count / total for label, count in counts.items()} if total else {},
+            'majority_label': counts.most_common(1)[0][0] if counts else None,
+        }
+    }
+
+
+def to_ndjson(results):
+    for result in results:
+        yield json.dumps(result) + '\n'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Classify every slice of a study and stream NDJSON results.')
+    parser.add_argument('source', help='zip archive or directory of slices')
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--workers', type=int, default=None, help='decode processes (default: all cores)')
+    parser.add_argument('--output', default='-', help='output file (default: stdout)')
+    args = parser.parse_args()
+
+    from model import load_model
+    load_model()
+
+    out = sys.stdout if args.output == '-' else open(args.output, 'w')
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        for line in to_ndjson(classify_study(iter_source(args.source), args.batch_size, pool)):
+            out.write(line)
+            out.flush()
+    if out is not sys.stdout:
+        out.close()
+
+
+if __name__ == '__main__':
+    main()
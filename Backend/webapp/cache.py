@@ -0,0 +1,412 @@
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+class PredictionCache:
+    """Content-addressed cache of predictions keyed by the uploaded bytes.
+
+    Entries live in an in-memory LRU bounded by max_bytes. When disk_dir is
+    set, every entry is also written there as JSON so repeats survive a
+    restart; disk hits are promoted back into memory.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, disk_dir=None):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    @staticmethod
+    def key(data, model_version):
+        """Hash the image bytes together with the model version."""
+        digest = hashlib.sha256(model_version.encode('utf-8'))
+        digest.update(b'\0')
+        digest.update(data)
+        return digest.hexdigest()
+
+    @staticmethod
+    def _entry_size(entry):
+        # Rough footprint: label, one float per logit, dict overhead
+        return len(entry['label']) + 8 * len(entry['logits']) + 200
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+
+        entry = self._read_disk(key)
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._insert(key, entry)
+        return entry
+
+    def put(self, key, label, logits):
+        entry = {'label': label, 'logits': list(logits)}
+        with self._lock:
+            self._insert(key, entry)
+        self._write_disk(key, entry)
+
+    def _insert(self, key, entry):
+        size = self._entry_size(entry)
+        if size > self.max_bytes:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._size -= self._entry_size(old)
+        self._entries[key] = entry
+        self._size += size
+        while self._size > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._size -= self._entry_size(evicted)
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, key[:2], f'{key}.json')
+
+    def _read_disk(self, key):
+        if not self.disk_dir:
+            return None
+        try:
+            with open(self._disk_path(key)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_disk(self, key, entry):
+        if not self.disk_dir:
+            return
+        path = self._disk_path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f'{path}.{threading.get_ident()}.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(entry, f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Prediction cache write failed: {str(e)}")
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._size,
+                'max_bytes': self.max_bytes,
+                'disk_dir': self.disk_dir,
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+            }
+
+
+def create_prediction_cache():
+    """Build a cache from PREDICTION_CACHE_MB / PREDICTION_CACHE_DIR, or None if disabled."""
+    max_mb = float(os.getenv('PREDICTION_CACHE_MB', '64'))
+    if max_mb <= 0:
+        return None
+    return PredictionCache(
+        max_bytes=int(max_mb * 1024 * 1024),
+        disk_dir=os.getenv('PREDICTION_CACHE_DIR') or None,
+    )
+
+
+class LLMResponseCache:
+    """Completions keyed by model, normalized messages and sampling params.
+
+    Only conversations with at most max_turns user messages are stored: the
+    per-diagnosis opener (one turn) by default, plus early follow-ups when
+    max_turns is raised. The full message list is part of the key, so a
+    follow-up only hits when everything before it matched too. With
+    disk_dir set, entries are also kept on disk and survive a restart.
+    """
+
+    def __init__(self, max_entries=256, disk_dir=None, max_turns=1):
+        self.max_entries = max_entries
+        self.disk_dir = disk_dir
+        self.max_turns = max_turns
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    @staticmethod
+    def key(model, messages, params):
+        normalized = {
+            'model': model,
+            'messages': [[m['role'], ' '.join(str(m.get('content') or '').split())] for m in messages],
+            'params': params,
+        }
+        return hashlib.sha256(json.dumps(normalized, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def cacheable(self, messages):
+        return sum(1 for m in messages if m['role'] == 'user') <= self.max_turns
+
+    def get(self, key):
+        with self._lock:
+            content = self._entries.get(key)
+            if content is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return content
+
+        content = self._read_disk(key)
+        with self._lock:
+            if content is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._insert(key, content)
+        return content
+
+    def put(self, key, content):
+        if not content:
+            return
+        with self._lock:
+            self._insert(key, content)
+        self._write_disk(key, content)
+
+    def __contains__(self, key):
+        with self._lock:
+            if key in self._entries:
+                return True
+        return self.disk_dir is not None and os.path.exists(self._disk_path(key))
+
+    def _insert(self, key, content):
+        self._entries[key] = content
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, key[:2], f'{key}.json')
+
+    def _read_disk(self, key):
+        if not self.disk_dir:
+            return None
+        try:
+            with open(self._disk_path(key)) as f:
+                return json.load(f)['content']
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def _write_disk(self, key, content):
+        if not self.disk_dir:
+            return
+        path = self._disk_path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f'{path}.{threading.get_ident()}.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump({'content': content}, f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"LLM cache write failed: {str(e)}")
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'max_turns': self.max_turns,
+                'disk_dir': self.disk_dir,
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+            }
+
+
+def create_llm_cache():
+    """Build a cache from LLM_CACHE_SIZE / LLM_CACHE_DIR / LLM_CACHE_MAX_TURNS, or None if disabled."""
+    max_entries = int(os.getenv('LLM_CACHE_SIZE', '256'))
+    if max_entries <= 0:
+        return None
+    return LLMResponseCache(
+        max_entries=max_entries,
+        disk_dir=os.getenv('LLM_CACHE_DIR') or None,
+        max_turns=int(os.getenv('LLM_CACHE_MAX_TURNS', '1')),
+    )
+
+
+class TTLCache:
+    """Bounded LRU cache for third-party lookups, with stale-while-revalidate.
+
+    get_or_fetch(key, fetch) returns a fresh entry straight away. An entry
+    older than ttl but younger than ttl + stale_ttl is still returned, and one
+    background refresh is started for it. Concurrent misses for the same key
+    share a single fetch. Failed fetches are never cached.
+    """
+
+    def __init__(self, ttl=3600, stale_ttl=86400, max_entries=1024, refresh_workers=4):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> (stored_at, value)
+        self._inflight = {}  # key -> Future shared by everyone waiting on that fetch
+        self._lock = threading.Lock()
+        self._refresh_pool = ThreadPoolExecutor(max_workers=refresh_workers, thread_name_prefix='cache-refresh')
+        self._tasks = set()  # refresh/fetch tasks started by get_or_fetch_async
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.refreshes = 0
+        self.errors = 0
+
+    def get_or_fetch(self, key, fetch):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                age = now - entry[0]
+                if age < self.ttl:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                if age < self.ttl + self.stale_ttl:
+                    self._entries.move_to_end(key)
+                    self.stale_hits += 1
+                    if key not in self._inflight:
+                        self.refreshes += 1
+                        self._inflight[key] = Future()
+                        self._refresh_pool.submit(self._fetch, key, fetch)
+                    return entry[1]
+
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                self.misses += 1
+                future = self._inflight[key] = Future()
+            else:
+                self.coalesced += 1
+
+        if leader:
+            self._fetch(key, fetch)
+        return future.result()
+
+    def _fetch(self, key, fetch):
+        with self._lock:
+            future = self._inflight[key]
+        try:
+            value = fetch()
+        except Exception as e:
+            with self._lock:
+                self.errors += 1
+                del self._inflight[key]
+            future.set_exception(e)
+            return
+
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            del self._inflight[key]
+        future.set_result(value)
+
+    async def get_or_fetch_async(self, key, fetch):
+        """get_or_fetch for a coroutine function, used by the asyncio server.
+
+        Shares entries, in-flight fetches and stats with the threaded path;
+        background refreshes run as tasks on the current event loop.
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                age = now - entry[0]
+                if age < self.ttl:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                if age < self.ttl + self.stale_ttl:
+                    self._entries.move_to_end(key)
+                    self.stale_hits += 1
+                    if key not in self._inflight:
+                        self.refreshes += 1
+                        self._inflight[key] = Future()
+                        self._start_task(self._fetch_async(key, fetch))
+                    return entry[1]
+
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                self.misses += 1
+                future = self._inflight[key] = Future()
+            else:
+                self.coalesced += 1
+
+        if leader:
+            # As a task, so a cancelled (disconnected) caller doesn't abandon the shared fetch
+            self._start_task(self._fetch_async(key, fetch))
+        return await asyncio.shield(asyncio.wrap_future(future))
+
+    def _start_task(self, coro):
+        task = asyncio.get_running_loop().create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _fetch_async(self, key, fetch):
+        with self._lock:
+            future = self._inflight[key]
+        try:
+            value = await fetch()
+        except Exception as e:
+            with self._lock:
+                self.errors += 1
+                del self._inflight[key]
+            future.set_exception(e)
+            return
+
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            del self._inflight[key]
+        future.set_result(value)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'stale_hits': self.stale_hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+                'refreshes': self.refreshes,
+                'errors': self.errors,
+            }
+
+
+def create_ttl_cache(prefix, ttl=3600, stale_ttl=86400, max_entries=1024):
+    """Build a TTLCache from {prefix}_CACHE_TTL / _CACHE_STALE_TTL / _CACHE_SIZE, or None if TTL is 0."""
+    ttl = float(os.getenv(f'{prefix}_CACHE_TTL', str(ttl)))
+    if ttl <= 0:
+        return None
+    return TTLCache(
+        ttl=ttl,
+        stale_ttl=float(os.getenv(f'{prefix}_CACHE_STALE_TTL', str(stale_ttl))),
+        max_entries=int(os.getenv(f'{prefix}_CACHE_SIZE', str(max_entries))),
+    )
@@ -0,0 +1,202 @@
+"""Compiled, batch-capable extraction of doctor listings from search results.
+
+ListingExtractor produces exactly what reference_search.py's per-result helpers
+(clean_title, extract_specialty, extract_phone, extract_address,
+is_valid_doctor_listing, ...) produce, but compiles every pattern once
+and does the least work per result it can.
+Check with: python parity.py extraction
+"""
+import re
+
+# Medical directory sites we link bookings to, in the order they're checked
+BOOKING_PLATFORMS = [
+    ('marham.pk', 'Marham'),
+    ('healthwire.pk', 'Healthwire'),
+    ('oladoc.com', 'Oladoc'),
+    ('findmydoctor.pk', 'FindMyDoctor'),
+    ('doctify.com', 'Doctify'),
+]
+
+# Patterns and keyword lists used to extract and filter listings (reference_search.py's helpers use them too)
+TITLE_CLEANUPS = [
+    (r'\s*[-|]\s*.*$', ''),  # site name / tagline after a dash or pipe
+    (r'Best\s+|Top\s+|Leading\s+', ''),
+    (r'\[PDF\]|\(PDF\)', ''),
+    (r'Dr\.\s*', 'Dr. '),
+]
+SKIP_TITLE_WORDS = ['news', 'article', 'report', 'pdf', 'research']
+VALID_LISTING_KEYWORDS = ['doctor', 'dr.', 'clinic', 'hospital', 'specialist', 'consultant']
+INVALID_LISTING_KEYWORDS = ['news', 'article', 'report', 'research', 'pdf', 'study']
+MEDICAL_FACILITY_KEYWORDS = ['hospital', 'clinic', 'medical center', 'healthcare', 'doctor']
+SPECIALTIES = [
+    'Neurologist', 'Geriatrician', 'Psychiatrist', 'General Physician',
+    'Neurosurgeon', 'Mental Health Specialist', 'Memory Specialist',
+    'Brain Specialist', 'Dementia Specialist'
+]
+SPECIALTY_PATTERN = r'(?:specialist|consultant|expert)\s+in\s+([^,.]+)'
+PHONE_PATTERNS = [
+    r'(?:\+92|0)[-(]?\d{3}[)-]?\d{7,8}',  # Pakistani format
+    r'[\+]?[(]?\d{3}[)]?[-\s\.]?\d{3}[-\s\.]?\d{4,6}'  # General format
+]
+ADDRESS_INDICATORS = ['located at', 'address:', 'located in', 'clinic in', 'hospital in']
+LOCATION_PATTERN = r'in\s+([^,.]+(?:,[^,.]+)*)'
+
+
+def contains_any(text, needles):
+    # Plain substring loops beat a compiled alternation here: re has no multi-string search
+    for needle in needles:
+        if needle in text:
+            return True
+    return False
+
+
+class ListingExtractor:
+    """Builds appointment listings from Serper results with precompiled patterns.
+
+    directory_listings() and places() return exactly what
+    reference_search.parse_directory_listings() and parse_places() return, but
+    lower-case each string once, reject a result before extracting anything
+    from it, and only run a regex when a literal it needs is present.
+    """
+
+    def __init__(self):
+        # Each cleanup is skipped when none of its required literals is in the title
+        self.title_cleanups = [
+            (re.compile(pattern), replacement, guards)
+            for (pattern, replacement), guards in zip(TITLE_CLEANUPS, [('-', '|'), ('Best', 'Top', 'Leading'), ('PDF',), ('Dr.',)])
+        ]
+        self.skip_title_words = tuple(SKIP_TITLE_WORDS)
+        self.valid_keywords = tuple(VALID_LISTING_KEYWORDS)
+        self.invalid_keywords = tuple(INVALID_LISTING_KEYWORDS)
+        self.facility_keywords = tuple(MEDICAL_FACILITY_KEYWORDS)
+        self.specialties = tuple((specialty.lower(), specialty) for specialty in SPECIALTIES)
+        self.specialty_pattern = re.compile(SPECIALTY_PATTERN)
+        self.phone_patterns = [re.compile(pattern) for pattern in PHONE_PATTERNS]
+        self.address_indicators = tuple(ADDRESS_INDICATORS)
+        self.location_pattern = re.compile(LOCATION_PATTERN)
+
+    def clean_title(self, title):
+        for pattern, replacement, guards in self.title_cleanups:
+            if contains_any(title, guards):
+                title = pattern.sub(replacement, title)
+        return title.strip()
+
+    @staticmethod
+    def platform(link):
+        for domain, name in BOOKING_PLATFORMS:
+            if domain in link:
+                return name
+        return None
+
+    def specialty(self, text_lower):
+        for needle, specialty in self.specialties:
+            if needle in text_lower:
+                return specialty
+        if 'in' in text_lower:
+            match = self.specialty_pattern.search(text_lower)
+            if match:
+                return match.group(1).title()
+        return 'Specialist'
+
+    def phone(self, text):
+        for pattern in self.phone_patterns:
+            match = pattern.search(text)
+            if match:
+                return match.group(0)
+        return 'Contact for number'
+
+    def address(self, text, text_lower):
+        for indicator in self.address_indicators:
+            start_idx = text_lower.find(indicator)
+            if start_idx != -1:
+                end_idx = text.find('.', start_idx + len(indicator))
+                if end_idx != -1:
+                    return text[start_idx + len(indicator):end_idx].strip()
+
+        if 'in' in text:
+            match = self.location_pattern.search(text)
+            if match:
+                return match.group(1).strip()
+        return 'Contact for address'
+
+    def directory_listings(self, directory_results, location):
+        """Doctor listings from medical platforms in the directory search."""
+        appointments = []
+        if 'organic' not in directory_results:
+            return appointments
+
+        city = location.split(',')[0].strip()
+        for result in directory_results['organic']:
+            link = result.get('link', '')
+            platform = self.platform(link)
+            if not platform:
+                continue
+
+            title = result.get('title', '')
+            if contains_any(title.lower(), self.skip_title_words):
+                continue
+
+            name = self.clean_title(title)
+            name_lower = name.lower()
+            if len(name) <= 5 or contains_any(name_lower, self.invalid_keywords):
+                continue
+            snippet = result.get('snippet', '')
+            snippet_lower = snippet.lower()
+            if not (contains_any(name_lower, self.valid_keywords) or contains_any(snippet_lower, self.valid_keywords)):
+                continue
+
+            appointments.append({
+                'doctorName': name,
+                'specialty': self.specialty(snippet_lower),
+                'location': city,
+                'address': self.address(snippet, snippet_lower),
+                'phone': self.phone(snippet),
+                'bookingPlatform': platform,
+                'bookingLink': link,
+                'date': 'Book online',
+                'time': 'Check availability online',
+                'type': 'Online Booking',
+                'snippet': snippet
+            })
+
+        return appointments
+
+    def places(self, places_results, location):
+        """Clinics and hospitals from the places search."""
+        appointments = []
+        if 'places' not in places_results:
+            return appointments
+
+        city = location.split(',')[0].strip()
+        for place in places_results['places']:
+            title = place.get('title', '')
+            if not contains_any(title.lower(), self.facility_keywords):
+                continue
+            appointments.append({
+                'doctorName': self.clean_title(title),
+                'specialty': 'Medical Facility',
+                'location': city,
+                'address': place.get('address', 'Contact for address'),
+                'phone': place.get('phoneNumber', 'Contact for number'),
+                'rating': place.get('rating', None),
+                'ratingCount': place.get('ratingCount', None),
+                'type': 'Physical Clinic',
+                'date': 'Contact clinic',
+                'time': 'Contact for times',
+                'website': place.get('website', '')
+            })
+
+        return appointments
+
+    def appointments(self, directory_results, places_results, location):
+        return self.directory_listings(directory_results, location) + self.places(places_results, location)
+
+
+_extractor = None
+
+
+def get_extractor():
+    global _extractor
+    if _extractor is None:
+        _extractor = ListingExtractor()
+    return _extractor
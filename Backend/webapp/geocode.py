@@ -0,0 +1,89 @@
+import os
+
+import metrics
+from cache import create_ttl_cache
+from upstream import get_client
+
+OPENCAGE_API_URL = 'https://api.opencagedata.com/geocode/v1/json'
+
+_geocode_cache = None
+
+
+class GeocodeError(Exception):
+    """OpenCage answered with something other than a 200."""
+
+    def __init__(self, status):
+        super().__init__(f'OpenCage returned {status}')
+        self.status = status
+
+
+def round_coordinates(latitude, longitude):
+    """Snap coordinates to GEOCODE_PRECISION decimals (2 ~ 1 km) so nearby users share cache entries."""
+    precision = int(os.getenv('GEOCODE_PRECISION', '2'))
+    return round(float(latitude), precision), round(float(longitude), precision)
+
+
+def fetch_location(latitude, longitude, api_key):
+    """Reverse-geocode with OpenCage; returns {'city', 'country'} or None if nothing was found."""
+    base_url = os.getenv('OPENCAGE_API_URL', OPENCAGE_API_URL)
+    with metrics.upstream_call('opencage'):
+        response = get_client('opencage').get(f'{base_url}?q={latitude}+{longitude}&key={api_key}')
+
+        if response.status_code != 200:
+            raise GeocodeError(response.status_code)
+
+        location_data = response.json()
+    return parse_location(location_data)
+
+
+async def fetch_location_async(http, latitude, longitude, api_key):
+    """fetch_location on an aiohttp ClientSession, for the asyncio server."""
+    import aiohttp
+
+    base_url = os.getenv('OPENCAGE_API_URL', OPENCAGE_API_URL)
+    with metrics.upstream_call('opencage'), get_client('opencage').guarded():
+        async with http.get(
+            f'{base_url}?q={latitude}+{longitude}&key={api_key}',
+            timeout=aiohttp.ClientTimeout(total=float(os.getenv('OPENCAGE_TIMEOUT', '10')))
+        ) as response:
+            if response.status != 200:
+                raise GeocodeError(response.status)
+            location_data = await response.json()
+    return parse_location(location_data)
+
+
+def parse_location(location_data):
+    if not location_data.get('results'):
+        return None
+
+    components = location_data['results'][0]['components']
+    return {
+        'city': components.get('city') or components.get('town') or components.get('state'),
+        'country': components.get('country')
+    }
+
+
+def get_geocode_cache():
+    """TTL cache for reverse geocoding, configured by GEOCODE_CACHE_* (None when disabled)."""
+    global _geocode_cache
+    if _geocode_cache is None:
+        _geocode_cache = create_ttl_cache('GEOCODE', ttl=86400, stale_ttl=7 * 86400) or False
+    return _geocode_cache or None
+
+
+def reverse_geocode(latitude, longitude, api_key):
+    cache = get_geocode_cache()
+    if cache is None:
+        return fetch_location(latitude, longitude, api_key)
+    # Rounded only when cached: the answer is shared by everyone in the same cell
+    latitude, longitude = round_coordinates(latitude, longitude)
+    return cache.get_or_fetch((latitude, longitude), lambda: fetch_location(latitude, longitude, api_key))
+
+
+async def reverse_geocode_async(http, latitude, longitude, api_key):
+    cache = get_geocode_cache()
+    if cache is None:
+        return await fetch_location_async(http, latitude, longitude, api_key)
+    latitude, longitude = round_coordinates(latitude, longitude)
+    return await cache.get_or_fetch_async(
+        (latitude, longitude), lambda: fetch_location_async(http, latitude, longitude, api_key))
@@ -0,0 +1,114 @@
+import os
+import queue
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future
+
+import metrics
+from model import predict_batch
+
+
+class EngineBusy(Exception):
+    """Raised when the inference queue is full."""
+
+
+class InferenceEngine:
+    """Groups concurrent classification requests into micro-batches.
+
+    Callers submit decoded images from their request threads; a single worker
+    thread collects up to max_batch_size of them, waiting at most max_wait_ms
+    after the first one arrives, and runs one forward pass for the whole batch.
+    """
+
+    def __init__(self, max_batch_size=8, max_wait_ms=10, max_queue_size=256, predict_fn=predict_batch):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.predict_fn = predict_fn
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._histogram = Counter()
+        self._stats_lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='inference-engine', daemon=True)
+            self._thread.start()
+        return self
+
+    def submit(self, image):
+        """Queue an RGB image and return a Future resolving to (label, logits)."""
+        future = Future()
+        try:
+            self._queue.put_nowait((image, future))
+        except queue.Full:
+            raise EngineBusy('Inference queue is full')
+        return future
+
+    def predict(self, image, timeout=None):
+        """Classify one image and return its label."""
+        label, _ = self.submit(image).result(timeout=timeout)
+        return label
+
+    def stats(self):
+        with self._stats_lock:
+            histogram = dict(sorted(self._histogram.items()))
+        batches = sum(histogram.values())
+        images = sum(size * count for size, count in histogram.items())
+        return {
+            'max_batch_size': self.max_batch_size,
+            'max_wait_ms': self.max_wait * 1000,
+            'queue_depth': self._queue.qsize(),
+            'batches': batches,
+            'images': images,
+            'mean_batch_size': images / batches if batches else 0,
+            'batch_size_histogram': histogram,
+        }
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            images = [image for image, _ in batch]
+            metrics.start_profile()
+            try:
+                results = self.predict_fn(images)
+            except Exception as e:
+                print(f"Inference error: {str(e)}")
+                for _, future in batch:
+                    future.set_exception(e)
+            else:
+                # Stage timings for the batch, picked up by profiled requests
+                stages = metrics.finish_profile()
+                for (_, future), result in zip(batch, results):
+                    future.stages = stages
+                    future.set_result(result)
+            finally:
+                metrics.finish_profile()
+
+            with self._stats_lock:
+                self._histogram[len(batch)] += 1
+
+
+def create_engine():
+    """Build an engine from the INFERENCE_* environment settings, or None if disabled."""
+    if os.getenv('INFERENCE_BATCHING', '1').lower() in ('0', 'false', 'no'):
+        return None
+
+    return InferenceEngine(
+        max_batch_size=int(os.getenv('INFERENCE_MAX_BATCH_SIZE', '8')),
+        max_wait_ms=float(os.getenv('INFERENCE_MAX_WAIT_MS', '10')),
+        max_queue_size=int(os.getenv('INFERENCE_MAX_QUEUE_SIZE', '256')),
+    ).start()
@@ -0,0 +1,170 @@
+import math
+import os
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import metrics
+
+
+class QueueFull(Exception):
+    """Raised by JobQueue.submit when the queue is at capacity."""
+
+    def __init__(self, retry_after):
+        super().__init__('Job queue is full')
+        self.retry_after = retry_after
+
+
+class Job:
+    def __init__(self, fn):
+        self.id = uuid.uuid4().hex
+        self.fn = fn
+        self.status = 'queued'
+        self.result = None
+        self.error = None
+        self.submitted_at = time.monotonic()
+        self.started_at = None
+        self.finished_at = None
+        self.done = threading.Event()
+
+    def to_dict(self):
+        data = {'job_id': self.id, 'status': self.status}
+        if self.started_at is not None:
+            data['wait_ms'] = round((self.started_at - self.submitted_at) * 1000, 1)
+        if self.finished_at is not None:
+            data['run_ms'] = round((self.finished_at - self.started_at) * 1000, 1)
+        if self.status == 'done':
+            data['result'] = self.result
+        elif self.status == 'failed':
+            data['error'] = self.error
+        return data
+
+
+class JobQueue:
+    """Runs submitted callables on a fixed pool of worker threads.
+
+    Jobs wait in a queue of at most max_queue_size; submitting to a full
+    queue raises QueueFull right away instead of letting the backlog grow.
+    Finished jobs are kept for result_ttl seconds so clients can fetch them.
+    """
+
+    def __init__(self, workers=4, max_queue_size=64, result_ttl=600):
+        self.workers = workers
+        self.max_queue_size = max_queue_size
+        self.result_ttl = result_ttl
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._jobs = OrderedDict()  # job id -> Job, in submission order
+        self._lock = threading.Lock()
+        self._threads = []
+        self._busy = 0
+        self._service_time = None  # moving average of run time, for Retry-After
+        self._counts = {'submitted': 0, 'completed': 0, 'failed': 0, 'rejected': 0}
+        self._wait_total = 0.0
+
+    def start(self):
+        for i in range(self.workers - len(self._threads)):
+            thread = threading.Thread(target=self._run, name=f'job-worker-{len(self._threads)}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def submit(self, fn):
+        """Queue fn() and return its Job, or raise QueueFull."""
+        job = Job(fn)
+        with self._lock:
+            self._expire()
+            try:
+                self._queue.put_nowait(job)
+            except queue.Full:
+                self._counts['rejected'] += 1
+                metrics.JOBS.inc(outcome='rejected')
+                raise QueueFull(self.retry_after())
+            self._jobs[job.id] = job
+            self._counts['submitted'] += 1
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def wait(self, job_id, timeout):
+        """The job after it finishes or timeout seconds pass, whichever is first (None if unknown)."""
+        job = self.get(job_id)
+        if job is not None:
+            job.done.wait(timeout)
+        return job
+
+    def retry_after(self):
+        """Seconds until a queue slot is likely to free up, at least 1."""
+        service_time = self._service_time or 1.0
+        return max(1, math.ceil(self._queue.qsize() * service_time / max(1, self.workers)))
+
+    def depth(self):
+        return self._queue.qsize()
+
+    def stats(self):
+        with self._lock:
+            counts = dict(self._counts)
+            started = counts['completed'] + counts['failed']
+            return {
+                'workers': self.workers,
+                'busy_workers': self._busy,
+                'max_queue_size': self.max_queue_size,
+                'queue_depth': self._queue.qsize(),
+                **counts,
+                'mean_wait_ms': round(self._wait_total / started * 1000, 1) if started else 0,
+                'mean_run_ms': round((self._service_time or 0) * 1000, 1),
+                'retained_jobs': len(self._jobs),
+            }
+
+    def _expire(self):
+        cutoff = time.monotonic() - self.result_ttl
+        for job_id, job in list(self._jobs.items()):
+            if job.finished_at is not None and job.finished_at < cutoff:
+                del self._jobs[job_id]
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            job.started_at = time.monotonic()
+            wait = job.started_at - job.submitted_at
+            metrics.JOB_WAIT_SECONDS.observe(wait)
+            with self._lock:
+                self._busy += 1
+            job.status = 'running'
+
+            try:
+                job.result = job.fn()
+                job.status = 'done'
+            except Exception as e:
+                print(f"Job {job.id} failed: {str(e)}")
+                job.error = str(e)
+                job.status = 'failed'
+            job.finished_at = time.monotonic()
+            job.fn = None  # drop the upload bytes the closure holds
+
+            run_time = job.finished_at - job.started_at
+            with self._lock:
+                self._busy -= 1
+                self._counts['completed' if job.status == 'done' else 'failed'] += 1
+                self._wait_total += wait
+                self._service_time = run_time if self._service_time is None else 0.8 * self._service_time + 0.2 * run_time
+            metrics.JOBS.inc(outcome='completed' if job.status == 'done' else 'failed')
+            job.done.set()
+
+
+def create_job_queue():
+    """Build a job queue from the JOB_* environment settings, or None if JOB_WORKERS=0."""
+    workers = int(os.getenv('JOB_WORKERS', '4'))
+    if workers <= 0:
+        return None
+
+    job_queue = JobQueue(
+        workers=workers,
+        max_queue_size=int(os.getenv('JOB_QUEUE_SIZE', '64')),
+        result_ttl=float(os.getenv('JOB_RESULT_TTL', '600')),
+    ).start()
+    metrics.registry.gauge('backup_plan_job_queue_depth', 'Prediction jobs waiting for a worker', job_queue.depth)
+    return job_queue
@@ -0,0 +1,355 @@
+"""Request-stage timings and counters, exposed in Prometheus text format at /metrics.
+
+Code times a stage with `with timed_stage('decode'):` (or observe_stage).
+Every observation feeds the stage_seconds histogram. While a request is
+being profiled (X-Profile: 1), it is also collected for that request's
+Server-Timing header.
+
+Under serve.py every worker process has its own registry. share() makes
+each worker write a snapshot of it to a shared directory, and render() then
+answers a scrape with the sum over all of them, whichever worker it reaches.
+"""
+import bisect
+import contextvars
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+class Counter:
+    def __init__(self, name, help, label_names=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[name] for name in self.label_names)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def snapshot(self):
+        with self._lock:
+            return {'kind': 'counter', 'help': self.help, 'label_names': self.label_names,
+                    'values': [[list(key), value] for key, value in self._values.items()]}
+
+    def merge(self, snapshot):
+        """Add the values of another process's snapshot of this counter."""
+        with self._lock:
+            for key, value in snapshot['values']:
+                key = tuple(key)
+                self._values[key] = self._values.get(key, 0) + value
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f'{self.name}{_labels(self.label_names, key)} {value}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, label_names=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self._series = {}  # label values -> [bucket counts..., +Inf count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.label_names)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 2)
+            series[index] += 1
+            series[-1] += value
+
+    def snapshot(self):
+        with self._lock:
+            return {'kind': 'histogram', 'help': self.help, 'label_names': self.label_names, 'buckets': self.buckets,
+                    'values': [[list(key), list(series)] for key, series in self._series.items()]}
+
+    def merge(self, snapshot):
+        """Add the observations of another process's snapshot of this histogram."""
+        with self._lock:
+            for key, values in snapshot['values']:
+                series = self._series.setdefault(tuple(key), [0] * (len(self.buckets) + 2))
+                for i, value in enumerate(values):
+                    series[i] += value
+
+    def reset(self):
+        with self._lock:
+            self._series.clear()
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            series = sorted((key, list(values)) for key, values in self._series.items())
+        for key, values in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), values):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{_labels(self.label_names, key, [("le", bound)])} {cumulative}')
+            lines.append(f'{self.name}_sum{_labels(self.label_names, key)} {values[-1]}')
+            lines.append(f'{self.name}_count{_labels(self.label_names, key)} {cumulative}')
+        return lines
+
+
+class Gauge:
+    """A value read when /metrics is scraped, e.g. a queue depth."""
+
+    def __init__(self, name, help, fn):
+        self.name = name
+        self.help = help
+        self.fn = fn
+
+    def snapshot(self):
+        return {'kind': 'gauge', 'help': self.help, 'value': self.fn()}
+
+    def reset(self):
+        pass
+
+    def render(self):
+        return [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} gauge', f'{self.name} {self.fn()}']
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, cls, name, *args, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, *args, **kwargs)
+            return metric
+
+    def counter(self, name, help, label_names=()):
+        return self._get_or_create(Counter, name, help, label_names)
+
+    def histogram(self, name, help, label_names=(), buckets=DEFAULT_BUCKETS):
+        return self._get_or_create(Histogram, name, help, label_names, buckets)
+
+    def gauge(self, name, help, fn):
+        """Register fn as the source of a gauge; a later call with the same name replaces it."""
+        with self._lock:
+            metric = self._metrics[name] = Gauge(name, help, fn)
+            return metric
+
+    def snapshot(self, gauges=True):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return {metric.name: metric.snapshot() for metric in metrics if gauges or not isinstance(metric, Gauge)}
+
+    def reset(self):
+        """Zero every counter and histogram (a forked worker drops what it inherited)."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        for metric in metrics:
+            metric.reset()
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+def merge_snapshots(snapshots):
+    """A Registry holding the sum of several processes' snapshots; gauges are summed too."""
+    merged = Registry()
+    gauges = {}
+    for snapshot in snapshots:
+        for name, data in snapshot.items():
+            if data['kind'] == 'counter':
+                merged.counter(name, data['help'], data['label_names']).merge(data)
+            elif data['kind'] == 'histogram':
+                merged.histogram(name, data['help'], data['label_names'], data['buckets']).merge(data)
+            else:
+                gauges[name] = gauges.get(name, 0) + data['value']
+                total = gauges[name]
+                merged.gauge(name, data['help'], lambda total=total: total)
+    return merged
+
+
+registry = Registry()
+
+# Directory the worker processes share their snapshots through (see share)
+_shared_dir = None
+
+
+def write_snapshot(directory, gauges=True):
+    """Write this process's metrics to <directory>/<pid>.json, replacing its previous snapshot."""
+    path = os.path.join(directory, f'{os.getpid()}.json')
+    with open(path + '.tmp', 'w') as f:
+        json.dump(registry.snapshot(gauges), f)
+    os.replace(path + '.tmp', path)
+
+
+def share(directory, interval=1.0):
+    """Aggregate metrics across processes through directory (serve.py calls this in each worker).
+
+    The counts inherited from the parent are dropped (the parent writes its
+    own snapshot before forking), and a thread refreshes this worker's
+    snapshot every interval seconds. Snapshots of workers that exited still
+    count towards counters and histograms, but not gauges.
+    """
+    global _shared_dir
+    registry.reset()
+    _shared_dir = directory
+
+    def flush():
+        while True:
+            try:
+                write_snapshot(directory)
+            except OSError as e:
+                print(f"Could not write metrics snapshot: {str(e)}")
+            time.sleep(interval)
+
+    threading.Thread(target=flush, name='metrics-flush', daemon=True).start()
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def render():
+    """The /metrics body: this process's metrics, or after share() the sum over every process."""
+    if _shared_dir is None:
+        return registry.render()
+    write_snapshot(_shared_dir)  # our own numbers are always current
+    snapshots = []
+    for filename in sorted(os.listdir(_shared_dir)):
+        if not filename.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(_shared_dir, filename)) as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if not _alive(int(filename[:-len('.json')])):
+            snapshot = {name: data for name, data in snapshot.items() if data['kind'] != 'gauge'}
+        snapshots.append(snapshot)
+    return merge_snapshots(snapshots).render()
+
+STAGE_SECONDS = registry.histogram('backup_plan_stage_seconds', 'Time spent in each stage of the request path', ('stage',))
+UPSTREAM_REQUESTS = registry.counter(
+    'backup_plan_upstream_requests_total', 'Calls to third-party APIs by outcome', ('upstream', 'outcome'))
+UPSTREAM_RETRIES = registry.counter('backup_plan_upstream_retries_total', 'Retried third-party calls', ('upstream',))
+UPSTREAM_HEDGES = registry.counter(
+    'backup_plan_upstream_hedges_total', 'Hedged third-party calls by which request answered first', ('upstream', 'winner'))
+UPSTREAM_CIRCUIT_REJECTIONS = registry.counter(
+    'backup_plan_upstream_circuit_rejections_total', 'Calls failed fast by an open circuit breaker', ('upstream',))
+REQUEST_SECONDS = registry.histogram(
+    'backup_plan_http_request_seconds', 'Time to produce the response (headers) per endpoint', ('endpoint', 'method'))
+RESPONSES = registry.counter('backup_plan_http_responses_total', 'Responses by endpoint and status', ('endpoint', 'status'))
+JOB_WAIT_SECONDS = registry.histogram('backup_plan_job_wait_seconds', 'Time a prediction job spent queued before a worker took it')
+JOBS = registry.counter('backup_plan_jobs_total', 'Prediction jobs by outcome (completed, failed, rejected)', ('outcome',))
+CASCADE = registry.counter(
+    'backup_plan_cascade_images_total', 'Images through the cascade by outcome (accepted, escalated)', ('outcome',))
+
+# A context variable rather than a thread-local so the asyncio server (async_app.py) can profile too
+_profile = contextvars.ContextVar('profile', default=None)
+
+
+def profiling_enabled():
+    return os.getenv('REQUEST_PROFILING', '1').lower() not in ('0', 'false', 'no')
+
+
+def start_profile():
+    _profile.set([])
+
+
+def finish_profile():
+    stages = _profile.get()
+    _profile.set(None)
+    return stages
+
+
+def extend_profile(stages):
+    """Add stages measured on another thread (e.g. the inference engine) to this thread's profile."""
+    current = _profile.get()
+    if current is not None and stages:
+        current.extend(stages)
+
+
+def propagate(fn):
+    """Wrap fn so stages it times on a pool thread land in the caller's profile."""
+    stages = _profile.get()
+    if stages is None:
+        return fn
+
+    def run(*args, **kwargs):
+        token = _profile.set(stages)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _profile.reset(token)
+
+    return run
+
+
+def observe_stage(stage, seconds):
+    STAGE_SECONDS.observe(seconds, stage=stage)
+    stages = _profile.get()
+    if stages is not None:
+        stages.append((stage, seconds))
+
+
+@contextmanager
+def timed_stage(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - start)
+
+
+def server_timing(stages):
+    """Format (stage, seconds) pairs as a Server-Timing header value (durations in ms)."""
+    return ', '.join(f'{stage};dur={seconds * 1000:.2f}' for stage, seconds in stages)
+
+
+@contextmanager
+def upstream_call(upstream):
+    """Time one third-party call as a stage named after the upstream and count its outcome."""
+    start = time.perf_counter()
+    outcome = 'error'
+    try:
+        yield
+        outcome = 'ok'
+    finally:
+        observe_stage(upstream, time.perf_counter() - start)
+        UPSTREAM_REQUESTS.inc(upstream=upstream, outcome=outcome)
@@ -1,38 +1,425 @@
+from PIL import Image
+import json
+import os
+import threading
 
+import metrics
+from metrics import timed_stage
+from preprocess import BatchPreprocessor, draft_decode_enabled
 
-from PIL import Image
-import torch
-from transformers import AutoModelForImageClassification, AutoImageProcessor
+# torch, transformers and backends.py are imported when the model is first
+# loaded, so importing this module (and app.py) stays cheap
+
+# Checkpoint used when MODEL_REPO / MODEL_REVISION are not set
+DEFAULT_REPO = "evanrsl/resnet-Alzheimer"
+
+# Written next to the weights by save_snapshot: which repo@revision the snapshot pins
+SNAPSHOT_FILE = 'snapshot.json'
+
+# How the cascade scores its cheap pass: top-1 minus top-2 probability, or top-1 probability
+CASCADE_GATES = ('margin', 'confidence')
 
 prediction = str()
 chat_history = []
 
-# Provide an image and get back a prediction
-def get_prediction(image_path):
-    # Using the updated pre-trained model (resnet-Alzheimer)
-    repo_name = "evanrsl/resnet-Alzheimer"
-    
-    # Load the image processor and model from Hugging Face
-    image_processor = AutoImageProcessor.from_pretrained(repo_name)
-    model = AutoModelForImageClassification.from_pretrained(repo_name)
-
-    # Load and preprocess the test image
-    image = Image.open(image_path)
-    encoding = image_processor(image.convert("RGB"), return_tensors="pt")
-
-    # Make a prediction
+
+class LoadedModel:
+    """Everything built from one checkpoint, swapped in and out as a unit."""
+
+    def __init__(self, image_processor, model, preprocess, forward, backend):
+        self.image_processor = image_processor
+        self.model = model
+        self.preprocess = preprocess
+        self.forward = forward  # pixel_values -> logits, for the selected backend
+        self.backend = backend
+        self.cascade = None  # Cascade when INFERENCE_CASCADE is on
+        self.version = None  # cache key component, fixed when the model is built
+
+    def pixel_values(self, images):
+        if self.preprocess is not None:
+            return self.preprocess(images)
+        return self.image_processor(images, return_tensors="pt")["pixel_values"]
+
+
+class Cascade:
+    """Cheap first pass for predict_batch: the classifier int8-quantized and/or on downscaled input.
+
+    Images whose gate score reaches threshold keep the cheap answer; the rest
+    are escalated to the full model. Calibrate threshold with
+    `python parity.py cascade --images labeled/`.
+    """
+
+    def __init__(self, preprocess, forward, threshold, gate='margin', backend='eager'):
+        self.preprocess = preprocess
+        self.forward = forward
+        self.backend = backend
+        self.threshold = threshold
+        self.gate = gate
+        self._counts = {'accepted': 0, 'escalated': 0}
+        self._lock = threading.Lock()
+
+    def scores(self, logits):
+        """Gate score per row of logits: softmax margin or confidence."""
+        import torch
+
+        probabilities = torch.softmax(logits.float(), dim=-1)
+        top = probabilities.topk(min(2, probabilities.shape[-1]), dim=-1).values
+        if self.gate == 'confidence' or top.shape[-1] < 2:
+            return top[:, 0]
+        return top[:, 0] - top[:, 1]
+
+    def escalations(self, logits):
+        """Indices of the rows whose cheap answer isn't confident enough."""
+        escalate = (self.scores(logits) < self.threshold).nonzero().flatten().tolist()
+        with self._lock:
+            self._counts['accepted'] += len(logits) - len(escalate)
+            self._counts['escalated'] += len(escalate)
+        metrics.CASCADE.inc(len(logits) - len(escalate), outcome='accepted')
+        metrics.CASCADE.inc(len(escalate), outcome='escalated')
+        return escalate
+
+    def stats(self):
+        with self._lock:
+            counts = dict(self._counts)
+        total = counts['accepted'] + counts['escalated']
+        return {
+            'backend': self.backend,
+            'input_size': [self.preprocess.crop_height, self.preprocess.crop_width],
+            'gate': self.gate,
+            'threshold': self.threshold,
+            **counts,
+            'escalation_rate': round(counts['escalated'] / total, 4) if total else 0,
+        }
+
+
+class ModelRegistry:
+    """Keeps one loaded checkpoint resident for the whole process."""
+
+    def __init__(self, repo_name=None, revision=None):
+        # MODEL_LOCAL_DIR (a save_snapshot directory) wins over the hub repo
+        self.repo_name = repo_name or os.getenv('MODEL_LOCAL_DIR') or os.getenv('MODEL_REPO', DEFAULT_REPO)
+        self.revision = revision or os.getenv('MODEL_REVISION') or None
+        self._loaded = None
+        self._lock = threading.Lock()
+
+    @property
+    def version(self):
+        """repo@revision plus backend and cascade settings; computed once per loaded model."""
+        if self._loaded is not None:
+            return self._loaded.version
+        from backends import selected_backend
+        return model_version(self.repo_name, self.revision, selected_backend(), cascade_settings())
+
+    def labels(self):
+        """The class labels, read from the checkpoint's config.json if the model isn't loaded yet.
+
+        Never loads the model (or imports torch), so it's cheap to call at startup.
+        """
+        if self._loaded is not None:
+            return list(self._loaded.model.config.id2label.values())
+        if os.path.isdir(self.repo_name):
+            path = os.path.join(self.repo_name, 'config.json')
+        else:
+            from huggingface_hub import hf_hub_download
+            path = hf_hub_download(self.repo_name, 'config.json', revision=self.revision)
+        with open(path) as f:
+            id2label = json.load(f)['id2label']
+        return [id2label[key] for key in sorted(id2label, key=int)]
+
+    @property
+    def loaded(self):
+        return self._loaded is not None
+
+    def _build(self, repo_name, revision):
+        from backends import build_backend, selected_backend
+
+        if os.path.isdir(repo_name):
+            image_processor, model = load_local(repo_name)
+        else:
+            from transformers import AutoModelForImageClassification, AutoImageProcessor
+            image_processor = AutoImageProcessor.from_pretrained(repo_name, revision=revision)
+            model = AutoModelForImageClassification.from_pretrained(repo_name, revision=revision)
+        model.eval()
+        preprocess = BatchPreprocessor.from_processor(image_processor)
+        if preprocess is None:
+            print("Image processor config not supported by the batched path, using AutoImageProcessor")
+
+        backend = selected_backend()
+        loaded = LoadedModel(image_processor, model, preprocess, None, backend)
+        example_inputs = loaded.pixel_values(example_images()).clone()
+        print(f"Building {backend} inference backend")
+        loaded.forward = build_backend(backend, model, example_inputs)
+        cascade = cascade_settings()
+        loaded.cascade = build_cascade(loaded, cascade)
+        loaded.version = model_version(repo_name, revision, backend, cascade if loaded.cascade else None)
+        warm_up(loaded)
+        return loaded
+
+    def load(self):
+        """Load the configured checkpoint if it is not resident yet."""
+        if self._loaded is None:
+            with self._lock:
+                if self._loaded is None:
+                    print(f"Loading model {self.version}")
+                    self._loaded = self._build(self.repo_name, self.revision)
+        return self._loaded
+
+    def get(self):
+        """Return the resident LoadedModel."""
+        return self._loaded or self.load()
+
+    def reload(self, repo_name=None, revision=None):
+        """Load a (possibly different) checkpoint and swap it in atomically.
+
+        Requests already running keep the model they started with; new requests
+        see the new one as soon as it has been warmed up.
+        """
+        repo_name = repo_name or self.repo_name
+        with self._lock:
+            print(f"Reloading model {repo_name}@{revision or 'main'}")
+            loaded = self._build(repo_name, revision)
+            self.repo_name, self.revision = repo_name, revision
+            self._loaded = loaded
+        return self.version
+
+
+def model_version(repo_name, revision, backend, cascade=None):
+    """The version string prediction cache keys are built from."""
+    pin = snapshot_pin(repo_name)
+    version = f"{pin['repo']}@{pin['revision']}" if pin else f"{repo_name}@{revision or 'main'}"
+    if backend != 'eager':
+        version += f"+{backend}"
+    if cascade is not None:
+        # Cascaded labels can differ from the full model's, so they are cached apart
+        version += f"+cascade-{cascade['backend']}-{cascade['size'] or 'full'}-{cascade['gate']}{cascade['threshold']:g}"
+    return version
+
+
+def cascade_settings():
+    """cascade_config() when INFERENCE_CASCADE is on, else None."""
+    if os.getenv('INFERENCE_CASCADE', '0').lower() not in ('1', 'true', 'yes'):
+        return None
+    return cascade_config()
+
+
+def cascade_config():
+    """Cascade settings from CASCADE_BACKEND / _SIZE / _GATE / _THRESHOLD.
+
+    The cheap pass defaults to static_int8 at the model's own input size.
+    CASCADE_SIZE downscales it too, which is only safe for checkpoints that
+    hold up at lower resolution; check with parity.py cascade.
+    """
+    from backends import BACKENDS
+
+    gate = os.getenv('CASCADE_GATE', 'margin').lower()
+    if gate not in CASCADE_GATES:
+        raise ValueError(f"Unknown CASCADE_GATE {gate!r}, expected one of {', '.join(CASCADE_GATES)}")
+    backend = os.getenv('CASCADE_BACKEND', 'static_int8').lower()
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown CASCADE_BACKEND {backend!r}, expected one of {', '.join(BACKENDS)}")
+    return {
+        'size': int(os.getenv('CASCADE_SIZE', '0')) or None,
+        'gate': gate,
+        'threshold': float(os.getenv('CASCADE_THRESHOLD', '0.5')),
+        'backend': backend,
+    }
+
+
+def build_cascade(loaded, settings=None):
+    """The Cascade for a loaded model, or None when it's off or the processor has no batched path."""
+    from backends import build_backend
+
+    settings = settings or cascade_settings()
+    if settings is None:
+        return None
+    if loaded.preprocess is None:
+        print("Image processor config not supported by the batched path, cascade disabled")
+        return None
+
+    preprocess = loaded.preprocess.scaled(settings['size'] or loaded.preprocess.crop_height)
+    print(f"Building {settings['backend']} cascade pass at {preprocess.crop_height}px")
+    forward = build_backend(settings['backend'], loaded.model, preprocess(example_images()).clone())
+    return Cascade(preprocess, forward, settings['threshold'], settings['gate'], settings['backend'])
+
+
+def snapshot_pin(path):
+    """The {'repo', 'revision'} a snapshot directory was saved from, or None."""
+    if not os.path.isdir(path):
+        return None  # a hub id
+    try:
+        with open(os.path.join(path, SNAPSHOT_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def weights_file(path):
+    """MODEL_WEIGHTS_FILE if set, else the snapshot's model.safetensors (or pytorch_model.bin)."""
+    configured = os.getenv('MODEL_WEIGHTS_FILE')
+    if configured:
+        return configured
+    for name in ('model.safetensors', 'pytorch_model.bin'):
+        if os.path.exists(os.path.join(path, name)):
+            return os.path.join(path, name)
+    return None
+
+
+def load_weights(path):
+    """Memory-mapped weights: safetensors, or a torch.save'd state dict (mmap=True)."""
+    import torch
+
+    if path.endswith('.safetensors'):
+        from safetensors.torch import load_file
+        return load_file(path)
+    return torch.load(path, mmap=True, weights_only=True, map_location='cpu')
+
+
+def load_local(path):
+    """Load the processor and classifier from a local directory, never asking the hub.
+
+    The model is created on the meta device and the mmapped weights are
+    assigned to it, skipping the random initialisation from_pretrained does
+    first. Falls back to from_pretrained(local_files_only=True) if the weights
+    don't cover every parameter and buffer.
+    """
+    import torch
+    from transformers import AutoConfig, AutoImageProcessor, AutoModelForImageClassification
+
+    image_processor = AutoImageProcessor.from_pretrained(path, local_files_only=True)
+    weights = weights_file(path)
+    if weights is not None:
+        config = AutoConfig.from_pretrained(path, local_files_only=True)
+        with torch.device('meta'):
+            model = AutoModelForImageClassification.from_config(config)
+        try:
+            model.load_state_dict(load_weights(weights), assign=True)
+        except RuntimeError as e:
+            print(f"Weights in {weights} don't match the config, loading with from_pretrained: {str(e)}")
+        else:
+            if not any(t.is_meta for t in list(model.parameters()) + list(model.buffers())):
+                return image_processor, model
+    return image_processor, AutoModelForImageClassification.from_pretrained(path, local_files_only=True)
+
+
+def save_snapshot(path, repo_name=None, revision=None):
+    """Download a checkpoint once and save it as a local snapshot for MODEL_LOCAL_DIR."""
+    from transformers import AutoImageProcessor, AutoModelForImageClassification
+
+    repo_name = repo_name or os.getenv('MODEL_REPO', DEFAULT_REPO)
+    revision = revision or os.getenv('MODEL_REVISION') or None
+    AutoImageProcessor.from_pretrained(repo_name, revision=revision).save_pretrained(path)
+    AutoModelForImageClassification.from_pretrained(repo_name, revision=revision).save_pretrained(
+        path, safe_serialization=True)
+    with open(os.path.join(path, SNAPSHOT_FILE), 'w') as f:
+        json.dump({'repo': repo_name, 'revision': revision or 'main'}, f)
+    return path
+
+
+registry = ModelRegistry()
+
+
+def example_images():
+    """Images used to trace/calibrate backends: INFERENCE_CALIBRATION_DIR, or blank + noise."""
+    calibration_dir = os.getenv('INFERENCE_CALIBRATION_DIR')
+    if calibration_dir:
+        from bulk import iter_directory
+        from preprocess import open_image
+        return [open_image(data) for _, data in iter_directory(calibration_dir)]
+
+    import torch
+
+    generator = torch.Generator().manual_seed(0)
+    noise = [
+        Image.fromarray(torch.randint(0, 256, (224, 224, 3), dtype=torch.uint8, generator=generator).numpy())
+        for _ in range(3)
+    ]
+    return [Image.new("RGB", (224, 224))] + noise
+
+
+def warm_up(loaded):
+    """Run one dummy forward pass so the first real request isn't the slow one."""
+    import torch
+
     with torch.no_grad():
-        outputs = model(**encoding)
-        logits = outputs.logits
+        loaded.forward(loaded.pixel_values([Image.new("RGB", (224, 224))]))
+        if loaded.cascade is not None:
+            loaded.cascade.forward(loaded.cascade.preprocess([Image.new("RGB", (224, 224))]))
+
+
+def load_model():
+    return registry.load()
+
+
+def get_draft_size():
+    """Target size for reduced-size JPEG decoding, or None when JPEG_DRAFT_DECODE is off."""
+    if not draft_decode_enabled():
+        return None
+    preprocess = registry.get().preprocess
+    return preprocess.draft_size if preprocess is not None else None
+
+
+def reload_model(repo_name=None, revision=None):
+    return registry.reload(repo_name, revision)
+
+
+def run_forward(pixel_values, forward, images, stage_prefix=''):
+    """logits for images through one preprocess + forward pair, timed as stages."""
+    import torch
+
+    with timed_stage(stage_prefix + 'preprocess'):
+        inputs = pixel_values(images)
+    with torch.no_grad(), timed_stage(stage_prefix + 'forward'):
+        return forward(inputs)
 
-    # Get the predicted class index
-    predicted_class_idx = logits.argmax(-1).item()
 
-    # Get the class name from the model's configuration
-    predicted_class_name = model.config.id2label[predicted_class_idx]
+def predict_batch(images):
+    """Classify a list of RGB PIL images in one forward pass.
+
+    With the cascade on, the whole batch goes through the cheap pass first and
+    only the images it isn't sure about get a second pass through the full model.
+    Returns a list of (label, logits) pairs in the same order as the input,
+    the logits being from whichever pass decided the label.
+    """
+    loaded = registry.get()
+    cascade = loaded.cascade
+    if cascade is None:
+        logits = run_forward(loaded.pixel_values, loaded.forward, images)
+    else:
+        logits = run_forward(cascade.preprocess, cascade.forward, images, 'cascade_')
+        escalate = cascade.escalations(logits)
+        if escalate:
+            logits[escalate] = run_forward(loaded.pixel_values, loaded.forward, [images[i] for i in escalate])
+
+    id2label = loaded.model.config.id2label
+    predicted_idx = logits.argmax(-1).tolist()
+    return [(id2label[idx], row) for idx, row in zip(predicted_idx, logits)]
+
+
+# Provide an image and get back a prediction
+def get_prediction(image_path):
+    from volumes import is_volume_name, classify_volume_file
+
+    if is_volume_name(image_path) or os.path.isdir(image_path):
+        # NIfTI volume or DICOM series: one diagnosis from a sample of brain slices
+        predicted_class_name = classify_volume_file(image_path)['predicted_class']
+    else:
+        # Load and preprocess the test image
+        image = Image.open(image_path)
+        predicted_class_name, _ = predict_batch([image.convert("RGB")])[0]
 
     # Set prediction as a global variable so it can be used elsewhere
     global prediction
     prediction = predicted_class_name
 
     return predicted_class_name
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Save the classifier as a local snapshot for MODEL_LOCAL_DIR.')
+    parser.add_argument('path', help='directory to write the snapshot to')
+    parser.add_argument('--repo', default=None, help=f'hub repo (default MODEL_REPO or {DEFAULT_REPO})')
+    parser.add_argument('--revision', default=None, help='commit, tag or branch to pin (default MODEL_REVISION or main)')
+    args = parser.parse_args()
+    print(f"Snapshot saved to {save_snapshot(args.path, args.repo, args.revision)}")
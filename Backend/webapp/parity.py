@@ -0,0 +1,316 @@
+"""Numerical parity checks for the optimized inference paths.
+
+Usage:
+    python parity.py preprocess                 # synthetic fixture images
+    python parity.py preprocess --images scans/ # your own images
+    python parity.py backends --images scans/   # labels, logits and latency per backend
+    python parity.py extraction --count 5000    # compiled listing extraction vs reference_search.py
+    python parity.py cascade --images labeled/  # calibrate CASCADE_THRESHOLD (one subdirectory per label)
+    python parity.py bulk --count 500           # /predict-bulk memory stays bounded for any batch_size
+
+Exits with status 1 when any check is outside tolerance.
+"""
+import argparse
+import io
+import itertools
+import os
+import statistics
+import sys
+import time
+
+import numpy as np
+from PIL import Image
+
+import torch
+
+from backends import BACKENDS, build_backend
+from bulk import iter_directory
+from preprocess import BatchPreprocessor, open_image
+
+
+def synthetic_images():
+    """Fixture set covering the shapes and modes uploads come in."""
+    rng = np.random.RandomState(0)
+    shapes = [(224, 224), (256, 256), (300, 200), (200, 300), (512, 384), (97, 143), (1024, 1024)]
+    images = []
+    for height, width in shapes:
+        pixels = rng.randint(0, 256, size=(height, width, 3), dtype=np.uint8)
+        images.append((f'rgb_{height}x{width}', Image.fromarray(pixels)))
+    images.append(('grayscale', Image.fromarray(rng.randint(0, 256, size=(240, 180), dtype=np.uint8))))
+    images.append(('rgba', Image.fromarray(rng.randint(0, 256, size=(180, 240, 4), dtype=np.uint8))))
+    return [(name, image.convert("RGB")) for name, image in images]
+
+
+def load_images(path):
+    if path is None:
+        return synthetic_images()
+    images = []
+    for name, data in iter_directory(path):
+        try:
+            images.append((name, open_image(data)))
+        except OSError as e:
+            print(f"Skipping {name}: {str(e)}")
+    return images
+
+
+def check_preprocess(image_processor, images, atol=1e-5):
+    """Compare BatchPreprocessor against the HF processor image by image."""
+    preprocess = BatchPreprocessor.from_processor(image_processor)
+    if preprocess is None:
+        print(f"{type(image_processor).__name__} config is not handled by BatchPreprocessor")
+        return False
+
+    expected = image_processor([image for _, image in images], return_tensors="pt")["pixel_values"]
+    actual = preprocess([image for _, image in images])
+
+    ok = True
+    for i, (name, _) in enumerate(images):
+        diff = (expected[i] - actual[i]).abs().max().item()
+        status = 'ok' if diff <= atol else 'MISMATCH'
+        ok = ok and diff <= atol
+        print(f"{name:24s} max abs diff {diff:.2e} {status}")
+    return ok
+
+
+def time_forward(forward, pixel_values, repeat):
+    """Median wall time of one forward pass in milliseconds."""
+    timings = []
+    with torch.no_grad():
+        forward(pixel_values)
+        for _ in range(repeat):
+            start = time.perf_counter()
+            forward(pixel_values)
+            timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+
+def check_backends(loaded, images, backends=BACKENDS, atol=1e-3, repeat=20):
+    """Compare each backend's labels and logits against eager, and time them.
+
+    Exact-precision backends must match eager logits within atol; int8
+    backends are only required to agree on every label.
+    """
+    pixel_values = loaded.pixel_values([image for _, image in images]).clone()
+    single = pixel_values[:1].clone()
+    eager = build_backend('eager', loaded.model, pixel_values)
+    with torch.no_grad():
+        expected = eager(pixel_values)
+    expected_labels = expected.argmax(-1)
+
+    ok = True
+    print(f"{'backend':14s} {'labels':>9s} {'max |dlogit|':>13s} {'batch=1 ms':>11s} {'batch=%d ms' % len(images):>11s}")
+    for name in backends:
+        try:
+            forward = build_backend(name, loaded.model, pixel_values)
+            with torch.no_grad():
+                logits = forward(pixel_values)
+        except Exception as e:
+            print(f"{name:14s} unavailable: {str(e)}")
+            continue
+
+        agree = (logits.argmax(-1) == expected_labels).sum().item()
+        diff = (logits - expected).abs().max().item()
+        passed = agree == len(images) and (name.endswith('int8') or diff <= atol)
+        ok = ok and passed
+        print(
+            f"{name:14s} {agree:>4d}/{len(images):<4d} {diff:13.2e} "
+            f"{time_forward(forward, single, repeat):11.2f} {time_forward(forward, pixel_values, repeat):11.2f}"
+            f"{'' if passed else '  MISMATCH'}"
+        )
+    return ok
+
+
+def image_labels(images, id2label):
+    """Ground truth from the first directory of each name (Mild_Demented/scan1.jpg), or None if unlabeled."""
+    names = set(id2label.values())
+    labels = [name.split(os.sep)[0] if os.sep in name else None for name, _ in images]
+    return labels if all(label in names for label in labels) else None
+
+
+def batched_logits(pixel_values, forward, images, batch_size=16):
+    with torch.no_grad():
+        return torch.cat([
+            forward(pixel_values(images[start:start + batch_size])) for start in range(0, len(images), batch_size)])
+
+
+def cpu_ms_per_image(predict, images, repeat):
+    """Mean process CPU time to classify one image at a time, in milliseconds."""
+    predict(images[:1])
+    start = time.process_time()
+    for _ in range(repeat):
+        for image in images:
+            predict([image])
+    return (time.process_time() - start) * 1000 / (repeat * len(images))
+
+
+def check_cascade(loaded, images, settings, repeat=3):
+    """Calibrate the cascade threshold on a fixture set and report what it saves.
+
+    The calibrated threshold is the lowest one at which the cascade gets
+    every image right that the full-resolution model gets right; with
+    unlabeled images the full model's labels stand in for the ground truth.
+    Passes when the configured threshold loses nothing either.
+    """
+    import model
+    from model import build_cascade
+
+    cascade = build_cascade(loaded, settings)
+    if cascade is None:
+        return False
+    id2label = loaded.model.config.id2label
+    label2id = {label: i for i, label in id2label.items()}
+
+    pil_images = [image for _, image in images]
+    full_logits = batched_logits(loaded.pixel_values, loaded.forward, pil_images)
+    cheap_logits = batched_logits(cascade.preprocess, cascade.forward, pil_images)
+    full, cheap = full_logits.argmax(-1), cheap_logits.argmax(-1)
+    scores = cascade.scores(cheap_logits)
+
+    labels = image_labels(images, id2label)
+    if labels is None:
+        print("Images aren't in one subdirectory per label; using the full model's labels as ground truth")
+        truth = full
+    else:
+        truth = torch.tensor([label2id[label] for label in labels])
+
+    # Accepting any of these cheap answers would lose an image the full model gets right
+    harmful = (cheap != truth) & (full == truth)
+    calibrated = float(np.ceil(scores[harmful].max().item() * 100 + 1e-6) / 100) if harmful.any() else 0.0
+
+    def outcome(threshold):
+        escalate = scores < threshold
+        predicted = torch.where(escalate, full, cheap)
+        return escalate.float().mean().item(), (predicted == truth).float().mean().item()
+
+    print(f"{len(images)} images, {settings['backend']} cascade at {cascade.preprocess.crop_height}px, {cascade.gate} gate")
+    print(f"full model accuracy       {(full == truth).float().mean().item():.3f}")
+    print(f"cheap-pass accuracy       {(cheap == truth).float().mean().item():.3f}")
+    print(f"{'threshold':>20s} {'escalated':>10s} {'accuracy':>9s} {'lost':>5s}")
+    for name, threshold in (('calibrated', calibrated), ('configured', settings['threshold'])):
+        escalated, accuracy = outcome(threshold)
+        lost = (harmful & (scores >= threshold)).sum().item()
+        print(f"{name:>10s} {threshold:9.2f} {escalated:10.1%} {accuracy:9.3f} {lost:5d}")
+
+    # Timed at the calibrated threshold, the one this check recommends
+    cascade.threshold = calibrated
+    resident = loaded.cascade
+    try:
+        loaded.cascade = None
+        full_ms = cpu_ms_per_image(model.predict_batch, pil_images, repeat)
+        loaded.cascade = cascade
+        cascade_ms = cpu_ms_per_image(model.predict_batch, pil_images, repeat)
+    finally:
+        loaded.cascade = resident
+    print(f"CPU per image: full {full_ms:.1f} ms, cascade {cascade_ms:.1f} ms at the calibrated threshold {cascade.threshold:.2f} "
+          f"({cascade.stats()['escalation_rate']:.1%} escalated)")
+    print(f"Set CASCADE_THRESHOLD={calibrated:g} "
+          f"(CASCADE_BACKEND={settings['backend']}, CASCADE_SIZE={settings['size'] or 0}, CASCADE_GATE={cascade.gate})")
+    return not (harmful & (scores >= settings['threshold'])).any().item()
+
+
+def check_bulk(images, count=500, batch_size=10 ** 6):
+    """Classify a count-slice study with an oversized batch_size, as a client of /predict-bulk could ask.
+
+    Passes when every slice gets a result and no more than 5 * BULK_MAX_BATCH
+    slices (4 batches decoding, 1 being filled) were ever submitted for
+    decoding without a result yet.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    import bulk
+
+    encoded = []
+    for name, image in images:
+        buffer = io.BytesIO()
+        image.save(buffer, format='PNG')
+        encoded.append((name, buffer.getvalue()))
+    slices = [(f'{i:05d}_{name}.png', data) for i, (name, data) in zip(range(count), itertools.cycle(encoded))]
+
+    submitted = 0
+
+    class CountingPool:
+        def __init__(self, pool):
+            self.pool = pool
+
+        def submit(self, *args):
+            nonlocal submitted
+            submitted += 1
+            return self.pool.submit(*args)
+
+    peak = results = 0
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        for result in bulk.classify_study(iter(slices), batch_size=batch_size, pool=CountingPool(pool)):
+            if 'summary' in result:
+                summary = result['summary']
+                continue
+            peak = max(peak, submitted - results)
+            results += 1
+
+    limit = 5 * bulk.BULK_MAX_BATCH
+    print(f"{count} slices, batch_size={batch_size} requested, BULK_MAX_BATCH={bulk.BULK_MAX_BATCH}")
+    print(f"results {results} ({summary['errors']} errors), peak in flight {peak} (limit {limit})")
+    return results == count and peak <= limit
+
+
+def check_extraction(count=5000, seed=0):
+    """Compare ListingExtractor with reference_search.py's parsers on synthetic and stub results."""
+    import reference_search
+    import stubs
+    from extraction import ListingExtractor
+
+    extractor = ListingExtractor()
+    cases = [('synthetic', stubs.synthetic_search_results(count, seed), 'Lahore, Pakistan')]
+    cases.append(('stub', (stubs.serper_results({'num': 10}), stubs.serper_results({'type': 'places'})), 'Karachi'))
+    cases.append(('empty', ({}, {}), ''))
+
+    ok = True
+    for name, (directory, places), location in cases:
+        expected = (reference_search.parse_directory_listings(directory, location)
+                    + reference_search.parse_places(places, location))
+        actual = extractor.appointments(directory, places, location)
+        mismatches = sum(a != b for a, b in zip(expected, actual)) + abs(len(expected) - len(actual))
+        ok = ok and mismatches == 0
+        print(f"{name:10s} {len(expected):6d} listings  {mismatches} mismatches {'ok' if not mismatches else 'MISMATCH'}")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('check', choices=['preprocess', 'backends', 'extraction', 'cascade', 'bulk'])
+    parser.add_argument('--images', default=None, help='directory of images (default: synthetic fixtures)')
+    parser.add_argument('--atol', type=float, default=None, help='default 1e-5 (preprocess) / 1e-3 (backends)')
+    parser.add_argument('--backends', default=','.join(BACKENDS), help='comma-separated backends to compare')
+    parser.add_argument('--repeat', type=int, default=None, help='timed runs per backend (20) or fixture set (cascade, 3)')
+    parser.add_argument('--count', type=int, default=None, help='synthetic search results (extraction, 5000) or slices (bulk, 500)')
+    parser.add_argument('--size', type=int, default=None, help='cascade input size (default CASCADE_SIZE or full)')
+    parser.add_argument('--gate', choices=['margin', 'confidence'], default=None, help='default CASCADE_GATE or margin')
+    parser.add_argument('--threshold', type=float, default=None, help='default CASCADE_THRESHOLD or 0.5')
+    args = parser.parse_args()
+
+    if args.check == 'extraction':
+        ok = check_extraction(args.count or 5000)
+        print('PASS' if ok else 'FAIL')
+        sys.exit(0 if ok else 1)
+
+    from model import registry
+    loaded = registry.get()
+    images = load_images(args.images)
+
+    if args.check == 'preprocess':
+        ok = check_preprocess(loaded.image_processor, images, args.atol or 1e-5)
+    elif args.check == 'cascade':
+        from model import cascade_config
+        settings = cascade_config()
+        overrides = {'size': args.size, 'gate': args.gate, 'threshold': args.threshold}
+        settings.update({key: value for key, value in overrides.items() if value is not None})
+        ok = check_cascade(loaded, images, settings, args.repeat or 3)
+    elif args.check == 'bulk':
+        ok = check_bulk(images, args.count or 500)
+    else:
+        ok = check_backends(loaded, images, args.backends.split(','), args.atol or 1e-3, args.repeat or 20)
+    print('PASS' if ok else 'FAIL')
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
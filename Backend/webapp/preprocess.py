@@ -0,0 +1,129 @@
+import io
+import os
+import threading
+
+import numpy as np
+from PIL import Image
+
+# torch is imported inside BatchPreprocessor: open_image callers shouldn't pay for it
+
+
+class BatchPreprocessor:
+    """Batched replacement for the checkpoint's AutoImageProcessor.
+
+    Resizing and cropping stay per image in PIL (the same calls the Hugging
+    Face processor makes, so the pixels match exactly); rescale, normalize and
+    the HWC -> CHW transpose then run once over the whole batch as tensor ops.
+    Each thread reuses its own preallocated uint8 and float32 buffers, so the
+    returned tensor is only valid until that thread's next call.
+    """
+
+    def __init__(self, resize_shortest_edge, crop_size, resample, rescale_factor, image_mean, image_std):
+        import torch
+
+        self.resize_shortest_edge = resize_shortest_edge  # None: resize straight to crop_size
+        self.crop_height, self.crop_width = crop_size
+        self.resample = resample
+        self.rescale_factor = rescale_factor
+        self.image_mean = torch.tensor(image_mean, dtype=torch.float32).view(1, 3, 1, 1)
+        self.image_std = torch.tensor(image_std, dtype=torch.float32).view(1, 3, 1, 1)
+        self._local = threading.local()
+
+    @classmethod
+    def from_processor(cls, image_processor):
+        """Mirror a ConvNext-style (shortest_edge + crop_pct) or fixed-size processor.
+
+        Returns None for configurations this fast path does not reproduce, in
+        which case callers should keep using the processor itself.
+        """
+        p = image_processor
+        if not (getattr(p, 'do_resize', False) and getattr(p, 'do_rescale', False) and getattr(p, 'do_normalize', False)):
+            return None
+        if getattr(p, 'do_center_crop', False) or getattr(p, 'do_pad', False):
+            return None
+
+        size = p.size or {}
+        resample = Image.Resampling(int(p.resample))
+        common = dict(resample=resample, rescale_factor=p.rescale_factor, image_mean=p.image_mean, image_std=p.image_std)
+
+        if 'shortest_edge' in size and hasattr(p, 'crop_pct'):
+            edge = size['shortest_edge']
+            if edge < 384:
+                return cls(int(edge / p.crop_pct), (edge, edge), **common)
+            return cls(None, (edge, edge), **common)
+        if 'height' in size and 'width' in size:
+            return cls(None, (size['height'], size['width']), **common)
+        return None
+
+    def scaled(self, height):
+        """The same pipeline with crops height pixels high, for a cheaper downscaled pass."""
+        factor = height / self.crop_height
+        resize_shortest_edge = round(self.resize_shortest_edge * factor) if self.resize_shortest_edge else None
+        return BatchPreprocessor(
+            resize_shortest_edge, (height, round(self.crop_width * factor)), self.resample, self.rescale_factor,
+            self.image_mean.flatten().tolist(), self.image_std.flatten().tolist(),
+        )
+
+    @property
+    def draft_size(self):
+        """Smallest (width, height) a decoded image must keep before resizing."""
+        edge = self.resize_shortest_edge or max(self.crop_height, self.crop_width)
+        return edge, edge
+
+    def resize(self, image):
+        """Resize (and center crop) one RGB PIL image exactly as the HF processor does."""
+        if self.resize_shortest_edge is None:
+            return image.resize((self.crop_width, self.crop_height), resample=self.resample)
+
+        width, height = image.size
+        short, long = (width, height) if width <= height else (height, width)
+        new_short, new_long = self.resize_shortest_edge, int(self.resize_shortest_edge * long / short)
+        new_width, new_height = (new_short, new_long) if width <= height else (new_long, new_short)
+        image = image.resize((new_width, new_height), resample=self.resample)
+
+        top = (new_height - self.crop_height) // 2
+        left = (new_width - self.crop_width) // 2
+        return image.crop((left, top, left + self.crop_width, top + self.crop_height))
+
+    def _buffers(self, batch_size):
+        import torch
+
+        pixels, values = getattr(self._local, 'buffers', (None, None))
+        if pixels is None or pixels.shape[0] < batch_size:
+            pixels = np.empty((batch_size, self.crop_height, self.crop_width, 3), dtype=np.uint8)
+            values = torch.empty((batch_size, 3, self.crop_height, self.crop_width), dtype=torch.float32)
+            self._local.buffers = (pixels, values)
+        return pixels[:batch_size], values[:batch_size]
+
+    def __call__(self, images):
+        """Turn a list of RGB PIL images into a (N, 3, H, W) pixel_values tensor."""
+        import torch
+
+        pixels, values = self._buffers(len(images))
+        for i, image in enumerate(images):
+            pixels[i] = np.asarray(self.resize(image))
+
+        # Same arithmetic as the HF processor: x * rescale_factor, then (x - mean) / std
+        values.copy_(torch.from_numpy(pixels).permute(0, 3, 1, 2))
+        values.mul_(self.rescale_factor).sub_(self.image_mean).div_(self.image_std)
+        return values
+
+
+def open_image(data, draft_size=None):
+    """Decode image bytes to RGB.
+
+    With draft_size set, JPEGs are decoded at the smallest DCT scale that still
+    covers it, which is much cheaper for large scans but no longer
+    bit-identical to a full decode.
+    """
+    image = Image.open(io.BytesIO(data))
+    if draft_size is not None and image.format == 'JPEG':
+        width, height = image.size
+        scale = max(draft_size[0], draft_size[1]) / min(width, height)
+        if scale < 1:
+            image.draft('RGB', (int(width * scale) + 1, int(height * scale) + 1))
+    return image.convert("RGB")
+
+
+def draft_decode_enabled():
+    return os.getenv('JPEG_DRAFT_DECODE', '0').lower() in ('1', 'true', 'yes')
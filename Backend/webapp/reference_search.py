@@ -0,0 +1,151 @@
+"""Reference appointment parsers, kept only as the baseline for extraction.ListingExtractor.
+
+find_care() in search.py uses the compiled extractor, which must give the
+same output as these helpers: python parity.py extraction checks it, and
+python benchmark.py extraction times the two.
+"""
+import re
+
+from extraction import (
+    ADDRESS_INDICATORS, BOOKING_PLATFORMS, INVALID_LISTING_KEYWORDS, LOCATION_PATTERN, MEDICAL_FACILITY_KEYWORDS,
+    PHONE_PATTERNS, SKIP_TITLE_WORDS, SPECIALTIES, SPECIALTY_PATTERN, TITLE_CLEANUPS, VALID_LISTING_KEYWORDS,
+)
+
+
+def parse_directory_listings(directory_results, location):
+    """Doctor listings from medical platforms in the directory search."""
+    appointments = []
+    if 'organic' not in directory_results:
+        return appointments
+
+    for result in directory_results['organic']:
+        title = result.get('title', '')
+        snippet = result.get('snippet', '')
+        link = result.get('link', '')
+
+        # Skip news articles and irrelevant results
+        if any(word in title.lower() for word in SKIP_TITLE_WORDS):
+            continue
+
+        # Determine booking platform
+        platform = None
+        for domain, name in BOOKING_PLATFORMS:
+            if domain in link:
+                platform = name
+                break
+
+        if platform:  # Only add if it's from a medical platform
+            doctor_info = {
+                'doctorName': clean_title(title),
+                'specialty': extract_specialty(snippet),
+                'location': extract_city(location),
+                'address': extract_address(snippet),
+                'phone': extract_phone(snippet),
+                'bookingPlatform': platform,
+                'bookingLink': link,
+                'date': 'Book online',
+                'time': 'Check availability online',
+                'type': 'Online Booking',
+                'snippet': snippet
+            }
+
+            # Only add if it looks like a valid doctor listing
+            if is_valid_doctor_listing(doctor_info):
+                appointments.append(doctor_info)
+
+    return appointments
+
+
+def parse_places(places_results, location):
+    """Clinics and hospitals from the places search."""
+    appointments = []
+    if 'places' not in places_results:
+        return appointments
+
+    for place in places_results['places']:
+        if is_valid_medical_facility(place.get('title', '')):
+            appointments.append({
+                'doctorName': clean_title(place.get('title', '')),
+                'specialty': 'Medical Facility',
+                'location': extract_city(location),
+                'address': place.get('address', 'Contact for address'),
+                'phone': place.get('phoneNumber', 'Contact for number'),
+                'rating': place.get('rating', None),
+                'ratingCount': place.get('ratingCount', None),
+                'type': 'Physical Clinic',
+                'date': 'Contact clinic',
+                'time': 'Contact for times',
+                'website': place.get('website', '')
+            })
+
+    return appointments
+
+
+def clean_title(title):
+    """Clean up doctor/facility titles."""
+    # Remove common suffixes and prefixes
+    for pattern, replacement in TITLE_CLEANUPS:
+        title = re.sub(pattern, replacement, title)
+    return title.strip()
+
+def extract_city(location):
+    """Extract city from location string."""
+    # Remove country and split by commas
+    parts = location.split(',')
+    return parts[0].strip()
+
+def is_valid_doctor_listing(info):
+    """Check if the listing appears to be a valid doctor."""
+    title = info['doctorName'].lower()
+    snippet = info.get('snippet', '').lower()
+    
+    return (
+        any(keyword in title or keyword in snippet for keyword in VALID_LISTING_KEYWORDS) and
+        not any(keyword in title for keyword in INVALID_LISTING_KEYWORDS) and
+        len(info['doctorName']) > 5
+    )
+
+def is_valid_medical_facility(title):
+    """Check if the place is a valid medical facility."""
+    return any(keyword in title.lower() for keyword in MEDICAL_FACILITY_KEYWORDS)
+
+def extract_specialty(text):
+    """Extract medical specialty from text."""
+    text_lower = text.lower()
+    for specialty in SPECIALTIES:
+        if specialty.lower() in text_lower:
+            return specialty
+            
+    # Try to find specialty patterns
+    match = re.search(SPECIALTY_PATTERN, text_lower)
+    if match:
+        return match.group(1).title()
+    
+    return 'Specialist'
+
+def extract_phone(text):
+    """Extract phone number from text using regex."""
+    # Pakistani format first, then a general one
+    for pattern in PHONE_PATTERNS:
+        match = re.search(pattern, text)
+        if match:
+            return match.group(0)
+    
+    return 'Contact for number'
+
+def extract_address(text):
+    """Extract address from text."""
+    # First try to find a complete address
+    for indicator in ADDRESS_INDICATORS:
+        if indicator in text.lower():
+            start_idx = text.lower().index(indicator) + len(indicator)
+            end_idx = text.find('.', start_idx)
+            if end_idx != -1:
+                return text[start_idx:end_idx].strip()
+    
+    # If no complete address found, try to extract location information
+    match = re.search(LOCATION_PATTERN, text)
+    if match:
+        return match.group(1).strip()
+    
+    return 'Contact for address'
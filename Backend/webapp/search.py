@@ -0,0 +1,239 @@
+import asyncio
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import metrics
+from cache import create_ttl_cache
+from extraction import get_extractor
+from upstream import get_client
+
+DEFAULT_SERPER_API_URL = "https://google.serper.dev/search"
+
+_executor = None
+_search_cache = None
+
+
+class SearchError(Exception):
+    """Raised when every search in a fan-out failed."""
+
+    def __init__(self, errors):
+        super().__init__('; '.join(f"{name}: {error}" for name, error in errors.items()))
+        self.errors = errors
+
+
+def search_timeout():
+    return float(os.getenv('SERPER_TIMEOUT', '10'))
+
+
+def serper_search(payload, timeout=None):
+    """POST one query to Serper and return the decoded JSON.
+
+    Goes through the shared 'serper' client (upstream.py): pooled connections,
+    retries within the timeout and a circuit breaker.
+    """
+    headers = {
+        'X-API-KEY': os.getenv('SERPER_API_KEY'),
+        'Content-Type': 'application/json'
+    }
+    with metrics.upstream_call('serper'):
+        response = get_client('serper').post(
+            os.getenv('SERPER_API_URL', DEFAULT_SERPER_API_URL),
+            headers=headers, json=payload, timeout=timeout or search_timeout()
+        )
+        response.raise_for_status()
+        return response.json()
+
+
+async def serper_search_async(http, payload, timeout=None):
+    """serper_search on an aiohttp ClientSession, for the asyncio server."""
+    import aiohttp
+
+    headers = {
+        'X-API-KEY': os.getenv('SERPER_API_KEY'),
+        'Content-Type': 'application/json'
+    }
+    with metrics.upstream_call('serper'), get_client('serper').guarded():
+        async with http.post(
+            os.getenv('SERPER_API_URL', DEFAULT_SERPER_API_URL),
+            headers=headers, json=payload, timeout=aiohttp.ClientTimeout(total=timeout or search_timeout())
+        ) as response:
+            response.raise_for_status()
+            return await response.json()
+
+
+def normalize_payload(payload):
+    """Cache key for a Serper payload: case and whitespace in the query don't matter."""
+    normalized = dict(payload)
+    normalized['q'] = ' '.join(str(payload.get('q', '')).lower().split())
+    return json.dumps(normalized, sort_keys=True)
+
+
+def get_search_cache():
+    """TTL cache for Serper results, configured by SERPER_CACHE_* (None when disabled)."""
+    global _search_cache
+    if _search_cache is None:
+        _search_cache = create_ttl_cache('SERPER') or False
+    return _search_cache or None
+
+
+def cached_search(payload, timeout=None):
+    """serper_search, answered from the TTL cache when the same query was seen recently."""
+    cache = get_search_cache()
+    if cache is None:
+        return serper_search(payload, timeout)
+    return cache.get_or_fetch(normalize_payload(payload), lambda: serper_search(payload, timeout))
+
+
+async def cached_search_async(http, payload, timeout=None):
+    cache = get_search_cache()
+    if cache is None:
+        return await serper_search_async(http, payload, timeout)
+    return await cache.get_or_fetch_async(normalize_payload(payload), lambda: serper_search_async(http, payload, timeout))
+
+
+def get_executor():
+    """Thread pool shared by all fan-outs, bounded by SERPER_MAX_WORKERS."""
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=int(os.getenv('SERPER_MAX_WORKERS', '16')), thread_name_prefix='serper')
+    return _executor
+
+
+def fan_out(payloads, timeout=None):
+    """Run several Serper searches concurrently.
+
+    payloads maps a name to a Serper payload. Returns (results, errors), both
+    keyed by name; a search that fails or misses the deadline only shows up
+    in errors, so callers can still use whatever did come back.
+    """
+    timeout = timeout or search_timeout()
+    search = metrics.propagate(cached_search)
+    futures = {name: get_executor().submit(search, payload, timeout) for name, payload in payloads.items()}
+    done, _ = wait(futures.values(), timeout=timeout)
+
+    results, errors = {}, {}
+    for name, future in futures.items():
+        if future not in done:
+            future.cancel()
+            errors[name] = 'timed out'
+        elif future.exception() is not None:
+            errors[name] = str(future.exception())
+        else:
+            results[name] = future.result()
+    return results, errors
+
+
+async def fan_out_async(http, payloads, timeout=None):
+    """fan_out as coroutines on one aiohttp session instead of pool threads."""
+    timeout = timeout or search_timeout()
+    tasks = {
+        name: asyncio.ensure_future(cached_search_async(http, payload, timeout))
+        for name, payload in payloads.items()
+    }
+    done, _ = await asyncio.wait(tasks.values(), timeout=timeout)
+
+    results, errors = {}, {}
+    for name, task in tasks.items():
+        if task not in done:
+            task.cancel()
+            errors[name] = 'timed out'
+        elif task.exception() is not None:
+            errors[name] = str(task.exception())
+        else:
+            results[name] = task.result()
+    return results, errors
+
+
+def doctors_payload(disease, location):
+    return {
+        'q': f"doctors treating {disease} in {location}",
+        'num': 10
+    }
+
+
+def directory_payload(disease, location):
+    # Search specifically for doctors on medical platforms
+    return {
+        'q': (
+            f"doctor appointment {disease} {location} "
+            "site:marham.pk OR site:healthwire.pk OR site:oladoc.com OR "
+            "site:findmydoctor.pk OR site:doctify.com"
+        ),
+        'num': 10
+    }
+
+
+def places_payload(disease, location):
+    # Physical clinics and hospitals
+    return {
+        'q': f"neurologist clinic hospital {disease} treatment {location}",
+        'num': 5,
+        'type': 'places'
+    }
+
+
+def parse_doctors(search_results):
+    doctors = []
+
+    # Add places results first (they usually have more detailed information)
+    if 'places' in search_results:
+        for result in search_results['places']:
+            doctors.append({
+                'title': result.get('title', ''),
+                'address': result.get('address', ''),
+                'rating': result.get('rating', None),
+                'ratingCount': result.get('ratingCount', None)
+            })
+
+    # Add organic results
+    if 'organic' in search_results:
+        for result in search_results['organic']:
+            doctors.append({
+                'title': result.get('title', ''),
+                'link': result.get('link', ''),
+                'snippet': result.get('snippet', ''),
+                'position': result.get('position', '')
+            })
+
+    return doctors
+
+
+def find_care(disease, location, include=('doctors', 'appointments')):
+    """Fetch doctors and/or appointments for one (disease, location) in a single fan-out.
+
+    Returns (data, errors). data has a list for each requested kind, built
+    from whichever searches succeeded. Raises SearchError if they all failed.
+    """
+    results, errors = fan_out(care_payloads(disease, location, include))
+    return build_care(results, errors, location, include)
+
+
+async def find_care_async(http, disease, location, include=('doctors', 'appointments')):
+    results, errors = await fan_out_async(http, care_payloads(disease, location, include))
+    return build_care(results, errors, location, include)
+
+
+def care_payloads(disease, location, include):
+    payloads = {}
+    if 'doctors' in include:
+        payloads['doctors'] = doctors_payload(disease, location)
+    if 'appointments' in include:
+        payloads['directory'] = directory_payload(disease, location)
+        payloads['places'] = places_payload(disease, location)
+    return payloads
+
+
+def build_care(results, errors, location, include):
+    if not results:
+        raise SearchError(errors)
+
+    data = {}
+    with metrics.timed_stage('extraction'):
+        if 'doctors' in include:
+            data['doctors'] = parse_doctors(results.get('doctors', {}))
+        if 'appointments' in include:
+            data['appointments'] = get_extractor().appointments(
+                results.get('directory', {}), results.get('places', {}), location
+            )
+    return data, errors
@@ -0,0 +1,181 @@
+"""Pre-fork production server: one model load, N worker processes.
+
+Usage:
+    python serve.py --workers 4 --port 5000
+    SERVE_WORKERS=4 SERVE_TORCH_THREADS=2 python serve.py
+
+The parent binds the listening socket and imports app.py once, which loads
+and warms up the model. It then forks the workers. The weights are
+inherited copy-on-write, and gc.freeze() keeps the collector from touching
+(and so copying) the objects created before the fork. Each worker runs
+werkzeug's threaded server on the shared socket, and the kernel spreads
+connections between them.
+
+The cores are split between the workers: each gets SERVE_TORCH_THREADS
+intra-op threads (default cpu_count // workers) and SERVE_INTEROP_THREADS
+inter-op threads (default 1). The parent stays at one thread so no OpenMP
+pool exists when it forks.
+
+Sessions, caches and /jobs queues are per worker. Chat follow-ups and job
+polls need to reach the worker that served the first request, so put a
+proxy with affinity on X-Session-ID in front, or use --workers 1 for chat-
+and job-heavy deployments. /metrics is not: the workers share snapshots
+through a temp directory (see metrics.share), so any worker answers a
+scrape with the totals of all of them.
+"""
+import argparse
+import gc
+import os
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import time
+
+import torch
+
+# A worker that dies sooner than this after starting is restarted only after this delay
+RESTART_BACKOFF = 5.0
+
+
+def worker_threads(workers):
+    return int(os.getenv('SERVE_TORCH_THREADS') or max(1, (os.cpu_count() or 1) // workers))
+
+
+def run_worker(index, sock, threads, interop_threads, metrics_dir):
+    """Body of one forked worker; never returns."""
+    from werkzeug.serving import make_server
+
+    import app
+    import metrics
+    from backends import build_backend
+    from bulk import start_decode_pool
+    from inference import create_engine
+    from jobs import create_job_queue
+    from model import example_images, registry
+    from uploads import create_upload_writer
+
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+    # Before any thread of this worker starts: the bulk decode workers are forked from it
+    start_decode_pool()
+
+    torch.set_num_threads(threads)
+    try:
+        torch.set_num_interop_threads(interop_threads)
+    except RuntimeError:
+        pass  # already fixed for this process; keep the inherited setting
+
+    # Threads don't survive fork: start this worker's own engine, job workers, upload writer and metrics flush
+    metrics.share(metrics_dir)
+    app.engine = create_engine()
+    app.job_queue = create_job_queue()
+    app.upload_writer = create_upload_writer(app.UPLOAD_FOLDER)
+
+    loaded = registry.get()
+    if loaded.backend == 'onnx':
+        # onnxruntime sessions own thread pools, so each worker needs its own
+        loaded.forward = build_backend('onnx', loaded.model, loaded.pixel_values(example_images()))
+    cascade = loaded.cascade
+    if cascade is not None and cascade.backend == 'onnx':
+        cascade.forward = build_backend('onnx', loaded.model, cascade.preprocess(example_images()))
+
+    server = make_server(sock.getsockname()[0], sock.getsockname()[1], app.app, threaded=True, fd=sock.fileno())
+    print(f"Worker {index} (pid {os.getpid()}) serving with {threads} torch threads")
+    server.serve_forever()
+
+
+def spawn(index, sock, threads, interop_threads, metrics_dir):
+    pid = os.fork()
+    if pid == 0:
+        code = 0
+        try:
+            run_worker(index, sock, threads, interop_threads, metrics_dir)
+        except BaseException as e:
+            print(f"Worker {index} exiting: {str(e)}")
+            code = 1
+        finally:
+            os._exit(code)
+    return pid
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default=os.getenv('SERVE_HOST', '127.0.0.1'))
+    parser.add_argument('--port', type=int, default=int(os.getenv('SERVE_PORT', '5000')))
+    parser.add_argument('--workers', type=int, default=int(os.getenv('SERVE_WORKERS', '2')))
+    args = parser.parse_args()
+
+    workers = max(1, args.workers)
+    threads = worker_threads(workers)
+    interop_threads = int(os.getenv('SERVE_INTEROP_THREADS', '1'))
+
+    sock = socket.create_server((args.host, args.port), backlog=1024)
+
+    # One thread while loading and warming up, so the parent never starts an OpenMP pool
+    torch.set_num_threads(1)
+    # Nothing may be loading on a background thread when we fork, so both happen here instead
+    saved = {name: os.environ.get(name) for name in ('LLM_CACHE_PREWARM', 'MODEL_PRELOAD', 'BULK_DECODE_PRESTART')}
+    os.environ.update(LLM_CACHE_PREWARM='0', MODEL_PRELOAD='0', BULK_DECODE_PRESTART='0')
+    import app
+    for name, value in saved.items():
+        if value is None:
+            os.environ.pop(name)
+        else:
+            os.environ[name] = value
+    app.load_model()  # once, before forking
+    if app.llm_prewarm_enabled():
+        # Every worker inherits the chat openers
+        app.prewarm_llm_cache()
+    # The workers drop the counts they inherit, so the parent's own (the model load, the prewarm) are kept here
+    import metrics
+    metrics_dir = tempfile.mkdtemp(prefix='backup-plan-metrics-')
+    metrics.write_snapshot(metrics_dir, gauges=False)
+    gc.freeze()
+
+    started = {}
+    children = {}
+    for i in range(workers):
+        pid = spawn(i, sock, threads, interop_threads, metrics_dir)
+        children[pid], started[i] = i, time.monotonic()
+    print(f"Serving on http://{args.host}:{sock.getsockname()[1]} with {workers} workers x {threads} torch threads")
+
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        index = children.pop(pid, None)
+        if index is None or stopping:
+            continue
+        print(f"Worker {index} (pid {pid}) died with status {status}, restarting")
+        if time.monotonic() - started[index] < RESTART_BACKOFF:
+            time.sleep(RESTART_BACKOFF)  # don't spin on a worker that crashes at startup
+            if stopping:
+                continue
+        children[spawn(index, sock, threads, interop_threads, metrics_dir)] = index
+        started[index] = time.monotonic()
+
+    sock.close()
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,199 @@
+import asyncio
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+
+def estimate_tokens(message):
+    """Cheap token estimate (~4 characters per token plus per-message overhead)."""
+    return len(message.get('content') or '') // 4 + 4
+
+
+SUMMARY_PREFIX = 'Earlier in this conversation the user asked about: '
+
+
+def is_summary(message):
+    return message['role'] == 'system' and message['content'].startswith(SUMMARY_PREFIX)
+
+
+def summarize_turns(messages, max_chars=600):
+    """Extractive stand-in for dropped turns: the questions the user asked."""
+    questions = []
+    for m in messages:
+        if is_summary(m):
+            questions.append(m['content'][len(SUMMARY_PREFIX):])
+        elif m['role'] == 'user':
+            questions.append(m['content'].strip().replace('\n', ' '))
+    summary = SUMMARY_PREFIX + '; '.join(questions)
+    if len(summary) > max_chars:
+        summary = summary[:max_chars - 3] + '...'
+    return {'role': 'system', 'content': summary}
+
+
+def trim_history(messages, max_tokens):
+    """Fit a conversation into max_tokens.
+
+    System prompts are always kept, then the most recent turns that fit. Older
+    turns are replaced with a one-line summary of what the user asked.
+    """
+    system = [m for m in messages if m['role'] == 'system' and not is_summary(m)]
+    previous_summaries = [m for m in messages if is_summary(m)]
+    turns = [m for m in messages if m['role'] != 'system']
+    budget = max_tokens - sum(estimate_tokens(m) for m in system)
+
+    kept = []
+    for message in reversed(turns):
+        cost = estimate_tokens(message)
+        if kept and cost > budget:
+            break
+        kept.append(message)
+        budget -= cost
+    kept.reverse()
+
+    dropped = turns[:len(turns) - len(kept)]
+    if not dropped:
+        return system + previous_summaries + kept
+
+    # Drop an orphaned assistant reply so the kept history starts with a user turn
+    while len(kept) > 1 and kept[0]['role'] == 'assistant':
+        dropped.append(kept.pop(0))
+
+    summary = summarize_turns(previous_summaries + dropped)
+    summary_cost = estimate_tokens(summary)
+    return system + ([summary] if summary_cost <= budget else []) + kept
+
+
+class Session:
+    """One user's conversation.
+
+    messages is the LLM context (system prompts and trimming summaries
+    included). Alongside it, every user and assistant message gets the next
+    version number, so clients can fetch just what changed since the version
+    they last saw (see since()).
+    """
+
+    def __init__(self, session_id):
+        self.id = session_id
+        self.messages = []
+        self.prediction = None
+        self.last_seen = time.monotonic()
+        self.lock = threading.Lock()
+        self.async_lock = asyncio.Lock()  # used instead of lock by async_app.py
+        self.version = 0
+        self.log = []  # (version, message) for the user/assistant messages still in messages
+        self.floor = 0  # versions up to here are gone (new conversation, trimmed or rolled back)
+
+    def add(self, role, content):
+        message = {"role": role, "content": content}
+        self.messages.append(message)
+        self.version += 1
+        self.log.append((self.version, message))
+        return message
+
+    def reset(self, messages):
+        """Start a new conversation with these messages."""
+        self.messages = []
+        self.log = []
+        self.floor = self.version
+        for message in messages:
+            if message['role'] == 'system':
+                self.messages.append(message)
+            else:
+                self.add(message['role'], message['content'])
+
+    def snapshot(self):
+        return list(self.messages), list(self.log)
+
+    def restore(self, snapshot):
+        """Undo a turn that didn't complete. Versions stay monotonic; clients past the floor resync."""
+        self.messages, self.log = list(snapshot[0]), list(snapshot[1])
+        self.floor = self.version
+
+    def prune_log(self):
+        """Drop log entries whose messages were trimmed out of the context."""
+        present = {id(message) for message in self.messages}
+        kept = [entry for entry in self.log if id(entry[1]) in present]
+        if len(kept) != len(self.log):
+            self.floor = max(self.floor, max(v for v, m in self.log if id(m) not in present))
+            self.log = kept
+
+    def since(self, version):
+        """(messages after version as (version, message) pairs, reset).
+
+        reset is True when the client's copy can't be patched (messages up to
+        its version were dropped or rolled back, or it is ahead of us); the
+        pairs are then the whole retained history, to replace that copy with.
+        """
+        if version is None or version <= self.floor or version > self.version:
+            return list(self.log), True
+        return [entry for entry in self.log if entry[0] > version], False
+
+
+class SessionStore:
+    """Conversation state per session id, expired after ttl_seconds of inactivity.
+
+    At most max_sessions are kept; beyond that the least recently used session
+    is evicted. Each session's history is bounded by the token budget, so the
+    store's memory is bounded too.
+    """
+
+    def __init__(self, ttl_seconds=1800, max_sessions=1000, token_budget=3000):
+        self.ttl_seconds = ttl_seconds
+        self.max_sessions = max_sessions
+        self.token_budget = token_budget
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self.evicted = 0
+
+    @staticmethod
+    def new_id():
+        return uuid.uuid4().hex
+
+    def get(self, session_id):
+        """Return the live session for session_id, or None if we never issued it or it expired."""
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            session = self._sessions.get(session_id)
+            if session is not None:
+                self._sessions.move_to_end(session_id)
+                session.last_seen = now
+            return session
+
+    def create(self):
+        """Start a session under a new, unguessable id."""
+        session = Session(self.new_id())
+        with self._lock:
+            self._sessions[session.id] = session
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+                self.evicted += 1
+        return session
+
+    def _expire(self, now):
+        while self._sessions:
+            session_id, session = next(iter(self._sessions.items()))
+            if now - session.last_seen < self.ttl_seconds:
+                break
+            del self._sessions[session_id]
+            self.evicted += 1
+
+    def trim(self, session):
+        """Apply the token budget to a session's history in place."""
+        session.messages = trim_history(session.messages, self.token_budget)
+        session.prune_log()
+        return session.messages
+
+    def stats(self):
+        with self._lock:
+            return {'sessions': len(self._sessions), 'evicted': self.evicted}
+
+
+def create_session_store():
+    return SessionStore(
+        ttl_seconds=float(os.getenv('CHAT_SESSION_TTL', '1800')),
+        max_sessions=int(os.getenv('CHAT_MAX_SESSIONS', '1000')),
+        token_budget=int(os.getenv('CHAT_TOKEN_BUDGET', '3000')),
+    )
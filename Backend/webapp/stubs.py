@@ -0,0 +1,328 @@
+"""Local stand-ins for the third-party APIs the backend calls.
+
+Usage:
+    python stubs.py together --port 8001
+    python stubs.py serper --port 8002 --latency 0.3
+    python stubs.py opencage --port 8003 --latency 0.1 --failure-rate 0.05
+    python stubs.py serper --port 8002 --latency 0.05 --slow-rate 0.05 --slow-latency 2
+    python stubs.py model --path /tmp/tiny-model
+    TOGETHER_BASE_URL=http://127.0.0.1:8001/v1 SERPER_API_URL=http://127.0.0.1:8002/search \
+        OPENCAGE_API_URL=http://127.0.0.1:8003/geocode/v1/json MODEL_REPO=/tmp/tiny-model python app.py
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CANNED_REPLY = (
+    "Very mild dementia is the earliest stage where changes in memory are noticeable. "
+    "Common signs include misplacing items and difficulty finding words. "
+    "Please consult a neurologist to confirm the diagnosis and discuss next steps."
+)
+
+
+class StubServer:
+    """Runs a ThreadingHTTPServer on a background thread."""
+
+    def __init__(self, handler, host='127.0.0.1', port=0):
+        self.httpd = ThreadingHTTPServer((host, port), handler)
+        self.httpd.daemon_threads = True
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out in separate writes; with Nagle on, a kept-alive
+    # client connection stalls ~40 ms on delayed ACKs before seeing the body
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_json(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length) or b'{}')
+
+    def send_json(self, data, status=200):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def fake_together(reply=CANNED_REPLY, first_token_delay=0.0, chunk_delay=0.0, failure_rate=0.0,
+                  host='127.0.0.1', port=0, seed=None):
+    """Fake Together chat completions endpoint; base URL is server.url + '/v1'.
+
+    Streaming requests get the reply word by word as SSE chunks, after
+    first_token_delay and then chunk_delay between chunks. failure_rate of
+    requests return a 500 instead.
+    """
+    rng = random.Random(seed)
+    words = reply.split(' ')
+    chunks = [word + ' ' for word in words[:-1]] + [words[-1]]
+
+    class Handler(StubHandler):
+        def do_POST(self):
+            if not self.path.rstrip('/').endswith('/chat/completions'):
+                return self.send_json({'error': 'not found'}, 404)
+            payload = self.read_json()
+            model = payload.get('model', 'stub')
+            if rng.random() < failure_rate:
+                time.sleep(first_token_delay)
+                return self.send_json({'error': {'message': 'stub failure'}}, 500)
+
+            if not payload.get('stream'):
+                time.sleep(first_token_delay + chunk_delay * len(chunks))
+                return self.send_json({
+                    'id': 'stub', 'object': 'chat.completion', 'created': int(time.time()), 'model': model,
+                    'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': reply}, 'finish_reason': 'stop'}],
+                })
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            self.close_connection = True
+            time.sleep(first_token_delay)
+            try:
+                for i, chunk in enumerate(chunks):
+                    if i:
+                        time.sleep(chunk_delay)
+                    data = {
+                        'id': 'stub', 'object': 'chat.completion.chunk', 'created': int(time.time()), 'model': model,
+                        'choices': [{'index': 0, 'delta': {'content': chunk}, 'finish_reason': None}],
+                    }
+                    self.wfile.write(f'data: {json.dumps(data)}\n\n'.encode('utf-8'))
+                    self.wfile.flush()
+                self.wfile.write(b'data: [DONE]\n\n')
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+
+    return StubServer(Handler, host, port)
+
+
+def serper_results(payload):
+    """Canned Serper response shaped like the real one for the given query."""
+    query = payload.get('q', '')
+    if payload.get('type') == 'places':
+        return {'places': [
+            {
+                'title': f'City Neurology Clinic {i}', 'address': f'{i} Main Boulevard',
+                'rating': 4.5, 'ratingCount': 120 + i, 'phoneNumber': '042-1234567',
+                'website': f'https://clinic{i}.example.com',
+            }
+            for i in range(payload.get('num', 5))
+        ]}
+
+    domains = ['marham.pk', 'healthwire.pk', 'oladoc.com', 'findmydoctor.pk', 'doctify.com']
+    return {
+        'searchParameters': {'q': query},
+        'organic': [
+            {
+                'title': f'Dr. Ayesha Khan {i} - Neurologist | {domains[i % len(domains)]}',
+                'link': f'https://www.{domains[i % len(domains)]}/doctors/neurologist/dr-{i}',
+                'snippet': (
+                    f'Dr. Ayesha Khan is a Neurologist and memory specialist located at Block {i}, '
+                    'Gulberg, Lahore. Call 0300-1234567 to book an appointment.'
+                ),
+                'position': i + 1,
+            }
+            for i in range(payload.get('num', 10))
+        ],
+    }
+
+
+SNIPPET_PARTS = [
+    'Dr. {name} is a {specialty} located at {address}.',
+    'Consultant in {field}, available at {address}',
+    'Expert in {field}. Call {phone} to book an appointment.',
+    'Top rated clinic in {city}, address: {address}. Phone: {phone}',
+    'Read the latest news article about dementia research in {city}',
+    '{name} practices at City Hospital in {city}, {address}',
+    'Memory specialist, hospital in {city}. {phone}',
+    'PDF report: brain health study published {year}',
+    'Book online with {name}; no phone listed',
+]
+NAMES = ['Ayesha Khan', 'Omar Farooq', 'Sara Malik', 'Bilal Ahmed', 'Hina Raza', 'Ali', 'Zainab Qureshi']
+SPECIALTY_WORDS = ['Neurologist', 'Psychiatrist', 'Geriatrician', 'neurosurgeon', 'General Physician', 'physician', 'Brain Specialist']
+FIELDS = ['memory disorders', 'geriatric care', 'Dementia Care', 'neurology, psychiatry', 'sleep medicine']
+TITLE_FORMATS = [
+    'Dr. {name} - {specialty} | {site}',
+    'Best {specialty}s in {city} | {site}',
+    'Top {specialty} in {city} - Book Appointment',
+    '[PDF] Dementia research {year}',
+    'Dr.{name} ({specialty})',
+    '{name} Clinic',
+    'News: {specialty} shortage in {city}',
+    'Leading Doctor {name} | Hospital',
+    'Ali',
+]
+PHONES = ['0300-1234567', '+92-42-35761234', '(042) 111-222-333', '042 3576 1234', '+1 (212) 555-0199', '12345']
+CITIES = ['Lahore', 'Karachi', 'Islamabad', 'Rawalpindi', 'Faisalabad']
+SITES = ['marham.pk', 'healthwire.pk', 'oladoc.com', 'findmydoctor.pk', 'doctify.com', 'example.com', 'dawn.com']
+PLACE_TITLES = ['{city} Neurology Clinic', 'General Hospital {city}', 'Mind Care Medical Center', 'HealthCare Pharmacy',
+                'Dr. {name} Clinic', 'Pharmacy {city}', 'Doctor Hospital - {city}']
+
+
+def synthetic_search_results(count, seed=0):
+    """count random organic + places results mixing valid listings, news and edge cases."""
+    rng = random.Random(seed)
+
+    def fill(template):
+        city = rng.choice(CITIES)
+        return template.format(
+            name=rng.choice(NAMES), specialty=rng.choice(SPECIALTY_WORDS), field=rng.choice(FIELDS),
+            address=f'{rng.randint(1, 300)} {rng.choice(["Main Boulevard", "Mall Road", "Block C, Gulberg"])}, {city}',
+            phone=rng.choice(PHONES), city=city, site=rng.choice(SITES), year=rng.randint(2015, 2025),
+        )
+
+    organic = []
+    for i in range(count):
+        site = rng.choice(SITES)
+        parts = rng.sample(SNIPPET_PARTS, rng.randint(0, 3))
+        organic.append({
+            'title': fill(rng.choice(TITLE_FORMATS)),
+            'link': f'https://www.{site}/doctors/{i}',
+            'snippet': ' '.join(fill(part) for part in parts),
+            'position': i + 1,
+        })
+    places = [
+        {
+            'title': fill(rng.choice(PLACE_TITLES)), 'address': fill('{address}'),
+            'rating': round(rng.uniform(3, 5), 1), 'ratingCount': rng.randint(0, 500),
+            'phoneNumber': rng.choice(PHONES), 'website': f'https://{rng.choice(SITES)}/{i}',
+        }
+        for i in range(count // 4)
+    ]
+    return {'organic': organic}, {'places': places}
+
+
+def injected_delay(rng, latency, slow_rate, slow_latency):
+    """latency, or slow_latency for a slow_rate fraction of requests (a latency tail)."""
+    return slow_latency if slow_rate and rng.random() < slow_rate else latency
+
+
+def fake_serper(latency=0.0, failure_rate=0.0, host='127.0.0.1', port=0, seed=None, slow_rate=0.0, slow_latency=2.0):
+    """Fake Serper search endpoint at server.url + '/search'.
+
+    Every request waits latency seconds (slow_latency for slow_rate of them);
+    failure_rate of them return a 500.
+    """
+    rng = random.Random(seed)
+
+    class Handler(StubHandler):
+        def do_POST(self):
+            payload = self.read_json()
+            time.sleep(injected_delay(rng, latency, slow_rate, slow_latency))
+            if rng.random() < failure_rate:
+                return self.send_json({'message': 'stub failure'}, 500)
+            self.send_json(serper_results(payload))
+
+    return StubServer(Handler, host, port)
+
+
+def fake_opencage(latency=0.0, failure_rate=0.0, host='127.0.0.1', port=0, seed=None, slow_rate=0.0,
+                  slow_latency=2.0):
+    """Fake OpenCage reverse geocoding at server.url + '/geocode/v1/json'.
+
+    Every request waits latency seconds (slow_latency for slow_rate of them);
+    failure_rate of them return a 500.
+    """
+    rng = random.Random(seed)
+
+    class Handler(StubHandler):
+        def do_GET(self):
+            time.sleep(injected_delay(rng, latency, slow_rate, slow_latency))
+            if rng.random() < failure_rate:
+                return self.send_json({'status': {'code': 500, 'message': 'stub failure'}}, 500)
+            self.send_json({
+                'results': [{'components': {'city': 'Lahore', 'state': 'Punjab', 'country': 'Pakistan'}}],
+                'status': {'code': 200, 'message': 'OK'},
+            })
+
+    return StubServer(Handler, host, port)
+
+
+LABELS = ['Mild_Demented', 'Moderate_Demented', 'Non_Demented', 'Very_Mild_Demented']
+
+
+def tiny_classifier(path, seed=0, size='tiny'):
+    """Save a randomly initialised ResNet with the real model's labels; use it as MODEL_REPO=path.
+
+    size='resnet50' builds one with the real checkpoint's ResNet-50 shape, for
+    measuring load times; the default is a tiny network that loads instantly.
+    """
+    import torch
+    from transformers import ConvNextImageProcessor, ResNetConfig, ResNetForImageClassification
+
+    torch.manual_seed(seed)
+    shape = {} if size == 'resnet50' else dict(
+        embedding_size=16, hidden_sizes=[16, 32, 32, 64], depths=[1, 1, 1, 1], layer_type='basic',
+    )
+    config = ResNetConfig(
+        **shape, id2label=dict(enumerate(LABELS)), label2id={label: i for i, label in enumerate(LABELS)},
+    )
+    ResNetForImageClassification(config).eval().save_pretrained(path)
+    ConvNextImageProcessor(size={'shortest_edge': 224}, crop_pct=0.875, resample=3).save_pretrained(path)
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('service', choices=['together', 'serper', 'opencage', 'model'])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--first-token-delay', type=float, default=0.2)
+    parser.add_argument('--chunk-delay', type=float, default=0.02)
+    parser.add_argument('--latency', type=float, default=0.3)
+    parser.add_argument('--failure-rate', type=float, default=0.0)
+    parser.add_argument('--slow-rate', type=float, default=0.0, help='fraction of slow requests (serper, opencage)')
+    parser.add_argument('--slow-latency', type=float, default=2.0)
+    parser.add_argument('--path', default='tiny-model', help='where to save the stand-in classifier (model)')
+    parser.add_argument('--size', choices=['tiny', 'resnet50'], default='tiny', help='stand-in classifier shape (model)')
+    args = parser.parse_args()
+
+    if args.service == 'model':
+        print(f"Tiny classifier saved to {tiny_classifier(args.path, size=args.size)}")
+        return
+    if args.service == 'together':
+        server = fake_together(first_token_delay=args.first_token_delay, chunk_delay=args.chunk_delay,
+                               failure_rate=args.failure_rate, host=args.host, port=args.port)
+        print(f"Fake Together listening on {server.url}/v1")
+    elif args.service == 'serper':
+        server = fake_serper(latency=args.latency, failure_rate=args.failure_rate, host=args.host, port=args.port,
+                             slow_rate=args.slow_rate, slow_latency=args.slow_latency)
+        print(f"Fake Serper listening on {server.url}/search")
+    else:
+        server = fake_opencage(latency=args.latency, failure_rate=args.failure_rate, host=args.host, port=args.port,
+                               slow_rate=args.slow_rate, slow_latency=args.slow_latency)
+        print(f"Fake OpenCage listening on {server.url}/geocode/v1/json")
+    server.httpd.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
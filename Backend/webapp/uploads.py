@@ -0,0 +1,53 @@
+import os
+import queue
+import threading
+
+from werkzeug.utils import secure_filename
+
+
+class UploadWriter:
+    """Persists uploaded files from a background thread.
+
+    Requests hand over the bytes they already hold in memory and return
+    immediately; if the writer falls behind by more than max_pending files,
+    new uploads are dropped rather than slowing requests down.
+    """
+
+    def __init__(self, folder, max_pending=64):
+        self.folder = folder
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=max_pending)
+        os.makedirs(folder, exist_ok=True)
+        self._thread = threading.Thread(target=self._run, name='upload-writer', daemon=True)
+        self._thread.start()
+
+    def submit(self, filename, data):
+        filename = secure_filename(filename or '')
+        if not filename:
+            return False
+        try:
+            self._queue.put_nowait((filename, data))
+            return True
+        except queue.Full:
+            self.dropped += 1
+            print(f"Upload writer busy, not persisting {filename}")
+            return False
+
+    def _run(self):
+        while True:
+            filename, data = self._queue.get()
+            file_path = os.path.join(self.folder, filename)
+            tmp_path = f'{file_path}.tmp'
+            try:
+                with open(tmp_path, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp_path, file_path)
+            except OSError as e:
+                print(f"Error persisting upload {filename}: {str(e)}")
+
+
+def create_upload_writer(folder):
+    """Return a writer when PERSIST_UPLOADS is enabled, otherwise None."""
+    if os.getenv('PERSIST_UPLOADS', '0').lower() not in ('1', 'true', 'yes'):
+        return None
+    return UploadWriter(folder, max_pending=int(os.getenv('PERSIST_UPLOADS_MAX_PENDING', '64')))
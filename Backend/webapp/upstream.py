@@ -0,0 +1,275 @@
+import os
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+# Statuses worth another try: the provider is overloaded or briefly broken
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def is_upstream_failure(error):
+    """Whether an exception from any HTTP library means the upstream is unwell.
+
+    Connection errors and timeouts are; errors carrying a status (aiohttp's
+    ClientResponseError, GeocodeError) only for RETRY_STATUSES. Anything else,
+    such as a 4xx or a parse error, is the caller's problem, not the upstream's.
+    """
+    if isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout, TimeoutError)):
+        return True
+    status = getattr(error, 'status', None)
+    if isinstance(status, int):
+        return status in RETRY_STATUSES
+    try:
+        import aiohttp
+    except ImportError:
+        return False
+    return isinstance(error, aiohttp.ClientConnectionError)
+
+
+class CircuitOpen(requests.exceptions.RequestException):
+    """Raised without calling the upstream while its circuit breaker is open."""
+
+
+class CircuitBreaker:
+    """Stops calling an upstream after failure_threshold failures in a row.
+
+    Once open it fails fast for reset_timeout seconds, then lets a single trial
+    call through (half-open): success closes it again, failure reopens it.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._trial_running = False
+        self._times_opened = 0
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state()
+
+    def _state(self):
+        if self._opened_at is None:
+            return 'closed'
+        if time.monotonic() - self._opened_at >= self.reset_timeout:
+            return 'half_open'
+        return 'open'
+
+    def allow(self):
+        """True if a call may go ahead now."""
+        if self.failure_threshold <= 0:
+            return True
+        with self._lock:
+            state = self._state()
+            if state == 'closed':
+                return True
+            if state == 'half_open' and not self._trial_running:
+                self._trial_running = True
+                return True
+            return False
+
+    def release(self):
+        """End a call without a verdict (e.g. the client went away), freeing the half-open trial."""
+        with self._lock:
+            self._trial_running = False
+
+    def record(self, ok):
+        with self._lock:
+            self._trial_running = False
+            if ok:
+                self._failures = 0
+                self._opened_at = None
+                return
+            self._failures += 1
+            if self._opened_at is not None or self._failures >= self.failure_threshold > 0:
+                if self._opened_at is None:
+                    self._times_opened += 1
+                self._opened_at = time.monotonic()  # (re)start the cool-down
+
+    def stats(self):
+        with self._lock:
+            return {
+                'state': self._state(),
+                'consecutive_failures': self._failures,
+                'times_opened': self._times_opened,
+                'failure_threshold': self.failure_threshold,
+                'reset_timeout_s': self.reset_timeout,
+            }
+
+
+class UpstreamClient:
+    """Outbound HTTP for one third-party API.
+
+    Keeps a pool of keep-alive connections, bounds every call by a connect
+    timeout and an overall deadline, retries connection errors, timeouts and
+    RETRY_STATUSES with full-jitter exponential backoff, and fails fast through
+    a CircuitBreaker while the provider is down. With hedge_after set, an
+    attempt that hasn't answered in that many seconds gets a duplicate request,
+    and whichever answers first wins; only use it for idempotent calls.
+    """
+
+    def __init__(self, name, timeout=10.0, connect_timeout=3.05, retries=2, backoff=0.2, max_backoff=2.0,
+                 hedge_after=None, pool_size=32, breaker=None):
+        self.name = name
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.hedge_after = hedge_after
+        self.breaker = breaker or CircuitBreaker()
+        # urllib3's pool is thread-safe; the session holds no per-request state we rely on
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._hedge_pool = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix=f'{name}-hedge') \
+            if hedge_after else None
+
+    def request(self, method, url, timeout=None, **kwargs):
+        """Send the request and return the response (which may still be an error status).
+
+        Raises CircuitOpen without sending anything while the breaker is open,
+        and requests' own exceptions when every attempt failed.
+        """
+        deadline = time.monotonic() + (timeout or self.timeout)
+        attempt = 0
+        while True:
+            if not self.breaker.allow():
+                metrics.UPSTREAM_CIRCUIT_REJECTIONS.inc(upstream=self.name)
+                raise CircuitOpen(f'{self.name} circuit breaker is open')
+
+            remaining = deadline - time.monotonic()
+            error = response = None
+            try:
+                response = self._attempt(method, url, remaining, kwargs)
+            except requests.exceptions.RequestException as e:
+                error = e
+            failed = error is not None or response.status_code in RETRY_STATUSES
+            self.breaker.record(not failed)
+            if not failed:
+                return response
+
+            # Full jitter: anywhere between 0 and the exponential cap
+            delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+            if response is not None and response.headers.get('Retry-After', '').isdigit():
+                delay = max(delay, float(response.headers['Retry-After']))
+            if attempt >= self.retries or time.monotonic() + delay >= deadline:
+                if error is not None:
+                    raise error
+                return response
+            attempt += 1
+            metrics.UPSTREAM_RETRIES.inc(upstream=self.name)
+            time.sleep(delay)
+
+    @contextmanager
+    def guarded(self):
+        """Breaker only, for calls made with another HTTP library (the aiohttp paths).
+
+        Exceptions count as failures by the same rule as request(): see
+        is_upstream_failure. A cancelled call counts neither way.
+        """
+        if not self.breaker.allow():
+            metrics.UPSTREAM_CIRCUIT_REJECTIONS.inc(upstream=self.name)
+            raise CircuitOpen(f'{self.name} circuit breaker is open')
+        try:
+            yield
+        except Exception as e:
+            self.breaker.record(not is_upstream_failure(e))
+            raise
+        except BaseException:
+            self.breaker.release()
+            raise
+        self.breaker.record(True)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def _send(self, method, url, remaining, kwargs):
+        return self.session.request(
+            method, url, timeout=(min(self.connect_timeout, remaining), remaining), **kwargs)
+
+    def _attempt(self, method, url, remaining, kwargs):
+        if remaining <= 0:
+            raise requests.exceptions.Timeout(f'{self.name} deadline exceeded')
+        if self._hedge_pool is None or remaining <= self.hedge_after:
+            return self._send(method, url, remaining, kwargs)
+
+        primary = self._hedge_pool.submit(self._send, method, url, remaining, kwargs)
+        done, _ = wait([primary], timeout=self.hedge_after)
+        if done:
+            return primary.result()
+
+        hedge = self._hedge_pool.submit(self._send, method, url, remaining - self.hedge_after, kwargs)
+        pending = {primary, hedge}
+        first_error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None and future.result().status_code not in RETRY_STATUSES:
+                    metrics.UPSTREAM_HEDGES.inc(upstream=self.name, winner='hedge' if future is hedge else 'primary')
+                    return future.result()
+                first_error = first_error or future
+        # Both failed: report the first one that came back
+        return first_error.result()
+
+    def stats(self):
+        return {
+            'timeout_s': self.timeout,
+            'connect_timeout_s': self.connect_timeout,
+            'retries': self.retries,
+            'hedge_after_s': self.hedge_after,
+            'circuit': self.breaker.stats(),
+        }
+
+
+def create_client(name, prefix, timeout=10.0):
+    """UpstreamClient configured by {prefix}_TIMEOUT / _CONNECT_TIMEOUT / _RETRIES / _RETRY_BACKOFF /
+    _HEDGE_AFTER / _POOL_SIZE / _BREAKER_THRESHOLD / _BREAKER_RESET."""
+    def setting(key, default):
+        return float(os.getenv(f'{prefix}_{key}', str(default)))
+
+    return UpstreamClient(
+        name,
+        timeout=setting('TIMEOUT', timeout),
+        connect_timeout=setting('CONNECT_TIMEOUT', 3.05),
+        retries=int(setting('RETRIES', 2)),
+        backoff=setting('RETRY_BACKOFF', 0.2),
+        hedge_after=setting('HEDGE_AFTER', 0) or None,
+        pool_size=int(setting('POOL_SIZE', 32)),
+        breaker=CircuitBreaker(
+            failure_threshold=int(setting('BREAKER_THRESHOLD', 5)),
+            reset_timeout=setting('BREAKER_RESET', 30),
+        ),
+    )
+
+
+def get_client(name):
+    """The shared client for 'serper' or 'opencage', built on first use."""
+    client = _clients.get(name)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(name)
+            if client is None:
+                client = _clients[name] = create_client(name, name.upper())
+    return client
+
+
+def clients():
+    return dict(_clients)
@@ -0,0 +1,277 @@
+"""Classify 3D MRI volumes (NIfTI files or DICOM series) from a sample of their slices.
+
+Usage:
+    python volumes.py scan.nii.gz
+    python volumes.py dicom_series/ --slices 24 --batch-size 8
+
+Volumes are never read whole. NIfTI files are opened through nibabel's
+memory-mapped array proxy and DICOM series one file at a time, so only the
+slices we look at are pulled into memory. A strided pass over evenly spaced
+candidate slices finds the brain region, VOLUME_SLICES slices are sampled
+across it, windowed to 8 bits in one array operation and classified in
+batches, and the per-slice softmax probabilities are averaged into a single
+diagnosis for the volume.
+
+NIfTI support needs nibabel and DICOM support needs pydicom; both are optional.
+"""
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import zipfile
+
+import numpy as np
+from PIL import Image
+
+from metrics import timed_stage
+
+NIFTI_SUFFIXES = ('.nii', '.nii.gz')
+DICOM_SUFFIXES = ('.dcm',)
+
+
+def volume_suffix(name):
+    """The volume file suffix of name ('.nii.gz', '.nii', '.dcm', '.zip'), or None."""
+    lower = (name or '').lower()
+    for suffix in NIFTI_SUFFIXES[::-1] + DICOM_SUFFIXES + ('.zip',):
+        if lower.endswith(suffix):
+            return suffix
+    return None
+
+
+def is_volume_name(name):
+    return volume_suffix(name) is not None
+
+
+class NiftiVolume:
+    """A NIfTI image, sliced along its third (normally axial) axis."""
+
+    def __init__(self, path):
+        try:
+            import nibabel
+        except ImportError:
+            raise RuntimeError("NIfTI volumes need the nibabel package installed")
+
+        try:
+            image = nibabel.load(path, mmap=True, keep_file_open=True)
+        except nibabel.filebasedimages.ImageFileError as e:
+            raise ValueError('Not a readable NIfTI file') from e
+        # Array proxy: indexing reads only the requested voxels. Keeping the file open
+        # lets a .nii.gz be read forward once instead of re-inflated for every slice
+        self._data = image.dataobj
+        self.shape = image.shape[:3]
+        self._extra = (0,) * (len(image.shape) - 3)  # first frame of a 4D series
+        self.num_slices = self.shape[2]
+        self.window = None
+
+    def read(self, index, step=1):
+        """Slice index as a float32 array, every step-th voxel, rotated to the usual viewing orientation."""
+        data = np.asarray(self._data[(slice(None, None, step), slice(None, None, step), index) + self._extra])
+        return np.rot90(data.astype(np.float32, copy=False))
+
+    def close(self):
+        self._data = None
+
+
+class DicomSeries:
+    """A DICOM series (directory, zip archive or single file), one file per slice."""
+
+    def __init__(self, path):
+        try:
+            import pydicom
+        except ImportError:
+            raise RuntimeError("DICOM series need the pydicom package installed")
+        self._pydicom = pydicom
+
+        self._zip = None
+        if os.path.isdir(path):
+            sources = [os.path.join(root, f) for root, _, files in os.walk(path) for f in files]
+        elif zipfile.is_zipfile(path):
+            self._zip = zipfile.ZipFile(path)
+            sources = [i.filename for i in self._zip.infolist() if not i.is_dir() and '__MACOSX' not in i.filename]
+        else:
+            sources = [path]
+
+        # Headers only, to order the slices; pixel data is read per slice later
+        headers = []
+        for source in sources:
+            try:
+                header = self._dcmread(source, stop_before_pixels=True)
+            except pydicom.errors.InvalidDicomError:
+                continue
+            if 'Rows' in header:
+                headers.append((self._position(header), source, header))
+        if not headers:
+            raise ValueError('No DICOM images found')
+        headers.sort(key=lambda h: h[0])
+
+        self._sources = [source for _, source, _ in headers]
+        first = headers[0][2]
+        self.num_slices = len(self._sources)
+        self.shape = (int(first.Rows), int(first.Columns), self.num_slices)
+        self.window = self._header_window(first)
+
+    def _dcmread(self, source, **kwargs):
+        if self._zip is not None:
+            with self._zip.open(source) as f:
+                return self._pydicom.dcmread(f, **kwargs)
+        return self._pydicom.dcmread(source, **kwargs)
+
+    @staticmethod
+    def _position(header):
+        position = header.get('ImagePositionPatient')
+        if position is not None:
+            return float(position[2])
+        return float(header.get('InstanceNumber', 0))
+
+    @staticmethod
+    def _header_window(header):
+        from pydicom.multival import MultiValue
+
+        center, width = header.get('WindowCenter'), header.get('WindowWidth')
+        if center is None or width is None:
+            return None
+        # Multi-valued windows list alternatives; the first is the default
+        center, width = (float(v[0]) if isinstance(v, MultiValue) else float(v) for v in (center, width))
+        return center - width / 2, center + width / 2
+
+    def read(self, index, step=1):
+        dataset = self._dcmread(self._sources[index])
+        data = dataset.pixel_array[::step, ::step].astype(np.float32)
+        slope, intercept = float(dataset.get('RescaleSlope', 1)), float(dataset.get('RescaleIntercept', 0))
+        if slope != 1 or intercept != 0:
+            data = data * slope + intercept
+        return data
+
+    def close(self):
+        if self._zip is not None:
+            self._zip.close()
+
+
+def open_volume(path):
+    """NiftiVolume for .nii/.nii.gz, DicomSeries for a directory, zip archive or .dcm file."""
+    if (volume_suffix(path) or '') in NIFTI_SUFFIXES:
+        return NiftiVolume(path)
+    return DicomSeries(path)
+
+
+def save_volume(file):
+    """Stream an uploaded volume to a temp file (keeping its suffix) and return the path.
+
+    The caller deletes it. Uploads are never read into memory whole.
+    """
+    fd, path = tempfile.mkstemp(suffix=volume_suffix(file.filename) or '')
+    with os.fdopen(fd, 'wb') as out:
+        shutil.copyfileobj(file.stream, out, 1024 * 1024)
+    return path
+
+
+def brain_slices(volume, count, candidates=64, probe_step=4):
+    """Pick count slice indices spread over the brain, plus the intensity window to use.
+
+    Evenly spaced candidate slices are read at 1/probe_step resolution. Voxels
+    above a tenth of the bright end are foreground; the brain spans the
+    candidates that are at least half as full as the fullest one. Without a
+    window in the file, the 1st-99th percentile of foreground voxels is used.
+    """
+    n = volume.num_slices
+    indices = np.unique(np.linspace(0, n - 1, min(n, candidates)).round().astype(int))
+    probes = [volume.read(int(i), probe_step) for i in indices]
+
+    voxels = np.concatenate([p.ravel() for p in probes])
+    threshold = np.percentile(voxels, 99.5) * 0.1
+    fractions = np.array([(p > threshold).mean() for p in probes])
+    if fractions.max() == 0:
+        raise ValueError('No brain found in the volume')
+    inside = indices[fractions >= fractions.max() * 0.5]
+    first, last = int(inside.min()), int(inside.max())
+
+    window = volume.window
+    if window is None:
+        foreground = voxels[voxels > threshold]
+        window = tuple(np.percentile(foreground, (1, 99))) if foreground.size else (float(voxels.min()), float(voxels.max()))
+
+    chosen = np.unique(np.linspace(first, last, min(count, last - first + 1)).round().astype(int))
+    return [int(i) for i in chosen], (first, last), window
+
+
+def window_slices(stack, low, high):
+    """(N, H, W) float intensities -> uint8, clipped to [low, high], in one vectorized pass."""
+    scale = 255.0 / max(high - low, 1e-6)
+    out = np.subtract(stack, low, dtype=np.float32)
+    out *= scale
+    np.clip(out, 0, 255, out=out)
+    return out.astype(np.uint8)
+
+
+def classify_volume(volume, slices=None, batch_size=None):
+    """Classify a volume from a sample of its brain slices.
+
+    Returns the averaged diagnosis with the class probabilities and what each
+    sampled slice was classified as.
+    """
+    import torch
+
+    from model import predict_batch, registry
+
+    slices = slices or int(os.getenv('VOLUME_SLICES', '16'))
+    batch_size = batch_size or int(os.getenv('VOLUME_BATCH_SIZE', '8'))
+
+    with timed_stage('volume_read'):
+        indices, brain_range, (low, high) = brain_slices(volume, slices)
+        stack = np.stack([volume.read(i) for i in indices])
+    with timed_stage('windowing'):
+        pixels = window_slices(stack, low, high)
+    del stack
+
+    logits = []
+    per_slice = []
+    for start in range(0, len(indices), batch_size):
+        images = [Image.fromarray(p).convert('RGB') for p in pixels[start:start + batch_size]]
+        for index, (label, row) in zip(indices[start:start + batch_size], predict_batch(images)):
+            logits.append(row)
+            per_slice.append({'slice': index, 'predicted_class': label})
+
+    probabilities = torch.softmax(torch.stack(logits).float(), dim=-1).mean(0)
+    id2label = registry.get().model.config.id2label
+    return {
+        'predicted_class': id2label[int(probabilities.argmax())],
+        'probabilities': {id2label[i]: round(float(p), 4) for i, p in enumerate(probabilities)},
+        'num_slices': volume.num_slices,
+        'brain_slice_range': list(brain_range),
+        'slices': per_slice,
+    }
+
+
+def classify_volume_file(path, delete=False):
+    """open_volume + classify_volume, optionally removing the (temp) file afterwards."""
+    try:
+        volume = open_volume(path)
+        try:
+            return classify_volume(volume)
+        finally:
+            volume.close()
+    finally:
+        if delete:
+            os.remove(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Classify a NIfTI volume or DICOM series.')
+    parser.add_argument('source', help='.nii/.nii.gz file, or a DICOM directory, zip or .dcm file')
+    parser.add_argument('--slices', type=int, default=None, help='slices to sample (default VOLUME_SLICES or 16)')
+    parser.add_argument('--batch-size', type=int, default=None)
+    args = parser.parse_args()
+
+    from model import load_model
+    load_model()
+
+    volume = open_volume(args.source)
+    try:
+        print(json.dumps(classify_volume(volume, args.slices, args.batch_size), indent=2))
+    finally:
+        volume.close()
+
+
+if __name__ == '__main__':
+    main()
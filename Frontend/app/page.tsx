@@ -69,12 +69,14 @@ export default function Page() {
             toast.success('Image successfully classified!')
 
             // Get LLM response
+            // withCredentials sends the backend's session cookie back, so follow-ups stay in one conversation
             const llmResponse = await axios.post<ChatResponse>(
                 'http://localhost:5000/chat',
                 {
                     message: `I have the following disease: ${predictedDisease}. What can you tell me about this?`,
                     language: selectedLanguage
-                }
+                },
+                { withCredentials: true }
             )
 
             setLlmResponse(llmResponse.data.response)